@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+""" End to end timings of the lookup tools against a synthetic library:
+    loading the database, cold, warm and incremental scans, searches of
+    varying selectivity, saving, and printing results.  Videos are sparse
+    files, so a large library costs little disk, and MediaInfo is replaced
+    by the stub in bench/stub.  Results are written as json, to compare
+    runs across commits.
+
+    Usage: bench_library.py [options] > results.json
+"""
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import random
+import logging
+import optparse
+import platform
+import itertools
+import contextlib
+import subprocess
+import importlib
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(HERE, "stub"), os.path.join(HERE, "..", "bin")]
+import hashing  # noqa: E402
+from metacache import MetaCache  # noqa: E402
+
+WORDS = ("the of and night day house blue red man woman last first city "
+         "river dead live time game king queen lost found home road war "
+         "star light dark fire water stone wind ghost love").split()
+GENRES = ("Action", "Comedy", "Drama", "Fantasy", "Horror", "SciFi")
+EPISODES_PER_SHOW = 60
+
+# Searches and the share of the library they match.  Every 10th title
+# has "alpha" in it, every 100th "beta", and each one a unique "n<number>"
+SELECTIVITY = (("unique", None), ("1pct", "beta"), ("10pct", "alpha"),
+               ("all", ""))
+
+
+def title_words(rnd, n):
+    words = [rnd.choice(WORDS).capitalize() for w in range(2)]
+    if n % 10 == 0:
+        words.append("Alpha")
+    if n % 100 == 0:
+        words.append("Beta")
+    words.append("N%06d" % n)
+    return words
+
+
+def layout(kind, root, n, rnd):
+    """ Path of the n'th video of a library, named the way parse() expects """
+    words = title_words(rnd, n)
+    if kind == "movies":
+        title = ".".join(words)
+        return os.path.join(root, GENRES[n % len(GENRES)], "%s.%d" % (title, 1950 + n % 70),
+                            "%s.mkv" % title)
+    show = "Show_%s_%d" % (rnd.choice(WORDS).capitalize(), n // EPISODES_PER_SHOW)
+    season, episode = divmod(n % EPISODES_PER_SHOW, 12)
+    return os.path.join(root, show, "%s.S%02dE%02d.%s.720p.mkv" % (
+        show, season + 1, episode + 1, "_".join(words)))
+
+
+def make_video(path, size):
+    """ A sparse file of size bytes, unique in its first block """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as fh:
+        fh.write(path.encode("utf8"))
+        fh.truncate(size)
+    return
+
+
+def sidecar(path):
+    return path.rsplit(".", 1)[0] + ".md5"
+
+
+def generate(kind, root, count, file_size, sidecars, first=0, seed=1):
+    """ Make sure root holds count videos, numbered from first, and that
+        each has an md5 sidecar if sidecars is set and none otherwise.
+        Existing videos are kept, so a tree is only built once.  Returns
+        the number of files created.
+    """
+    rnd = random.Random("%s-%d" % (seed, first))
+    created = 0
+    for n in range(first, first + count):
+        path = layout(kind, root, n, rnd)
+        size = file_size * rnd.randint(50, 150) // 100
+        if not os.path.isfile(path) or os.path.getsize(path) != size:
+            make_video(path, size)
+            created += 1
+        md5file = sidecar(path)
+        if sidecars and not os.path.isfile(md5file):
+            md5sum, size = hashing.md5sum(path)
+            with open(md5file, 'w') as fh:
+                fh.write(hashing.format_sidecar(os.path.basename(path), {'md5': md5sum}))
+        elif not sidecars and os.path.isfile(md5file):
+            os.unlink(md5file)  # Left behind by the last run's scans
+    return created
+
+
+class Bench(object):
+    """ Runs the phases for one tool, appending a result dict per timing """
+
+    def __init__(self, kind, module, root, dbfile, options, results):
+        self.kind = kind
+        self.module = module
+        self.root = root
+        self.dbfile = dbfile
+        self.options = options
+        self.results = results
+
+    def record(self, phase, seconds, cpu=None, **extra):
+        result = {"name": "%s.%s" % (self.kind, phase), "seconds": round(seconds, 6)}
+        if cpu is not None:
+            result["cpu"] = round(cpu, 6)
+        result.update(extra)
+        self.results.append(result)
+        sys.stderr.write("%-28s %10.3fs %s\n" % (result["name"], seconds,
+                                                 json.dumps(extra) if extra else ""))
+        return result
+
+    def timed(self, phase, func, **extra):
+        wall, cpu = time.perf_counter(), time.process_time()
+        value = func()
+        self.record(phase, time.perf_counter() - wall, time.process_time() - cpu, **extra)
+        return value
+
+    def best(self, phase, func, repeat, **extra):
+        """ Fastest of repeat runs, for the quick phases """
+        times = []
+        for r in range(repeat):
+            start = time.perf_counter()
+            value = func()
+            times.append(time.perf_counter() - start)
+        self.record(phase, min(times), repeat=repeat, median=round(sorted(times)[repeat // 2], 6),
+                    **extra)
+        return value
+
+    def open(self):
+        db = self.module.open_db(self.dbfile)
+        db.metacache = MetaCache(self.dbfile + ".meta")
+        return db
+
+    def close(self, db):
+        db.close()
+        db.metacache.close()
+        return
+
+    def scan(self, phase):
+        db = self.open()
+        o = self.options
+        self.timed(phase, lambda: db.scan(self.root, jobs=o.jobs, readers=o.readers,
+                                          probe_jobs=o.probe_jobs))
+        self.results[-1]["entries"] = db.count()
+        self.close(db)
+        return
+
+    def run(self, count):
+        o = self.options
+        for suffix in ("", ".journal", ".meta", ".lock", "-wal", "-shm"):
+            if os.path.exists(self.dbfile + suffix):
+                os.unlink(self.dbfile + suffix)
+
+        self.scan("scan.cold")
+        self.scan("scan.warm")
+        extra = max(1, count * o.incremental // 100)
+        newroot = os.path.join(self.root, "Incremental")
+        generate(self.kind, newroot, extra, o.file_size, o.sidecars, first=count)
+        try:
+            self.scan("scan.incremental")
+        finally:
+            shutil.rmtree(newroot)  # Their entries stay, scans don't drop missing files
+
+        db = self.timed("load", self.open)
+        total = db.count()
+        for name, text in SELECTIVITY:
+            text = "n%06d" % (count // 2) if text is None else text
+            found = self.best("search.%s" % name, lambda: db.search(text), o.repeat)
+            self.results[-1]["results"] = len(found)
+        self.best("search.top20_size", lambda: list(itertools.islice(
+            db.matches("", order="size_bytes"), 20)), o.repeat)
+        self.best("search.min_size", lambda: list(db.matches(
+            "", ranges={"size_bytes": (o.file_size, None)})), o.repeat)
+
+        everything = db.search("")
+        for format in ("table", "jsonl"):
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                self.timed("dump.%s" % format, lambda: self.module.printresults(
+                    everything, format=format), results=len(everything))
+            self.results[-1]["bytes"] = len(out.getvalue())
+
+        changed = max(1, total * o.incremental // 100)
+        for md5sum, entry in itertools.islice(db.entries(), changed):
+            db.update(md5sum, entry)
+        db.journal = True
+        self.timed("save.journal", db.save, entries=changed)
+        db.journal = False
+        db.dirty = True
+        self.timed("save.snapshot", db.save, entries=total)
+        self.close(db)
+        return
+
+
+def commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=HERE,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(options):
+    logging.getLogger().setLevel(getattr(logging, options.log_level.upper()))
+    os.makedirs(options.workdir, exist_ok=True)
+    tools = (("movies", "lookup", options.movies), ("tv", "lookup-tv", options.episodes))
+    results = []
+    for kind, module, count in tools:
+        if not count:
+            continue
+        root = os.path.join(options.workdir, kind)
+        start = time.perf_counter()
+        created = generate(kind, root, count, options.file_size, options.sidecars)
+        sys.stderr.write("%s: %d videos under %s, %d created in %.1fs\n" % (
+            kind, count, root, created, time.perf_counter() - start))
+        dbfile = os.path.join(options.workdir, "%s.%s" % (kind, options.backend))
+        Bench(kind, importlib.import_module(module), root, dbfile, options,
+              results).run(count)
+
+    report = {
+        "commit": commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "config": {"movies": options.movies, "episodes": options.episodes,
+                   "file_size": options.file_size, "sidecars": options.sidecars,
+                   "backend": options.backend, "jobs": options.jobs,
+                   "readers": options.readers, "probe_jobs": options.probe_jobs,
+                   "incremental": options.incremental, "repeat": options.repeat},
+        "results": results}
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as fh:
+            fh.write(text + "\n")
+    else:
+        sys.stdout.write(text + "\n")
+    return
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser("Usage: %prog [options]")
+    parser.add_option("--movies", dest="movies", type="int", help="Movies in the synthetic library [%default]", default=3000)
+    parser.add_option("--episodes", dest="episodes", type="int", help="TV episodes in the synthetic library [%default]", default=10000)
+    parser.add_option("--file-size", dest="file_size", type="int", help="Average (sparse) video size in bytes [%default]", default=1024 * 1024)
+    parser.add_option("--sidecars", dest="sidecars", action="store_true", help="Give every video an md5 sidecar up front, so scans don't hash [%default]", default=False)
+    parser.add_option("--backend", dest="backend", type="choice", choices=["json", "sqlite"], help="Database backend, json or sqlite [%default]", default="json")
+    parser.add_option("--workdir", dest="workdir", type="string", help="Where the library and databases are kept between runs [%default]", default=os.path.join("/tmp", "moviechecker-bench"))
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", help="Hash files with X worker processes [%default]", default=1)
+    parser.add_option("--readers", dest="readers", type="int", help="Worker processes allowed to read from one disk at a time [%default]", default=1)
+    parser.add_option("--probe-jobs", dest="probe_jobs", type="int", help="Read MediaInfo with X worker processes [%default]", default=1)
+    parser.add_option("--incremental", dest="incremental", type="int", help="Percent of the library added for the incremental scan, and changed for the journal save [%default]", default=1)
+    parser.add_option("--repeat", dest="repeat", type="int", help="Run each search X times and keep the fastest [%default]", default=5)
+    parser.add_option("-o", "--output", dest="output", type="string", help="Write the json results here instead of stdout [%default]", default=None)
+    parser.add_option("-l", "--log-level", dest="log_level", type="string", help="change log level [%default]", default="warning")
+    (options, args) = parser.parse_args()
+    main(options)
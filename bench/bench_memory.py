@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+""" Memory held by an open JsonDB with entries as dicts and as compact
+    records (--compact-records), for the entries alone and together with
+    the search index, every table of it built.  Each database is opened
+    in a child process so one model's garbage can't count against the
+    other.  Entries are the synthetic TV episodes of bench_snapshot.py.
+
+    Usage: bench_memory.py [--sizes 10000,60000]
+"""
+import os
+import sys
+import gc
+import optparse
+import time
+import shutil
+import tempfile
+import subprocess
+import tracemalloc
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(HERE, "stub"), os.path.join(HERE, "..", "bin")]
+from jsondb import JsonDB  # noqa: E402
+from bench_snapshot import synthetic  # noqa: E402
+
+
+def measure(filename, compact_records):
+    """ (seconds to open, MiB with the indexes, MiB of entries alone) """
+    tracemalloc.start()
+    start = time.perf_counter()
+    db = JsonDB(filename, compact_records=compact_records)
+    elapsed = time.perf_counter() - start
+    db.search_index.build()
+    gc.collect()
+    total = tracemalloc.get_traced_memory()[0]
+    db.search_index.clear()
+    db.path_index = {}
+    gc.collect()
+    entries = tracemalloc.get_traced_memory()[0]
+    return elapsed, total / 1048576.0, entries / 1048576.0
+
+
+def main(sizes):
+    workdir = tempfile.mkdtemp(prefix="bench-memory-")
+    print("%8s  %-8s  %10s  %10s  %10s" % ("entries", "model", "open s", "total MiB", "entries MiB"))
+    try:
+        for size in sizes:
+            filename = os.path.join(workdir, "%d.json" % size)
+            db = JsonDB(filename)
+            db.db = synthetic(size)
+            db.save()
+            db.clear()
+            for model, flag in (("dict", []), ("records", ["--compact-records"])):
+                output = subprocess.check_output([sys.executable, __file__, "--measure",
+                                                  filename] + flag)
+                print("%8d  %-8s  %10.2f  %10.1f  %10.1f" % (
+                    (size, model) + tuple(float(v) for v in output.split())))
+    finally:
+        shutil.rmtree(workdir)
+    return
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser("Usage: %prog [options]")
+    parser.add_option("--sizes", dest="sizes", type="string", help="Comma separated numbers of entries to measure [%default]", default="10000,60000,100000")
+    # Used by main() to measure one database in a child process
+    parser.add_option("--measure", dest="measure", type="string", help=optparse.SUPPRESS_HELP, default=None)
+    parser.add_option("--compact-records", dest="compact_records", action="store_true", help=optparse.SUPPRESS_HELP, default=False)
+    (options, args) = parser.parse_args()
+    if options.measure:
+        print("%f %f %f" % measure(options.measure, options.compact_records))
+    else:
+        try:
+            sizes = [int(size) for size in options.sizes.split(",")]
+        except ValueError:
+            parser.error("--sizes takes a comma separated list of entry counts")
+        main(sizes)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+""" Search latency of SearchIndex against a linear pass over the entries,
+    as the database grows.  "first ms" is a query on a fresh index, which
+    builds the tables the query needs, the cost a one-off lookup.py or
+    lookup-tv.py run pays after opening the database.  "repeat ms" is the
+    same query once they're built.  Entries are synthetic TV episodes.
+
+    Usage: bench_search.py [--sizes 3000,10000]
+"""
+import os
+import sys
+import time
+import optparse
+import random
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+from searchindex import SearchIndex  # noqa: E402
+
+WORDS = ("the of and night day house blue red man woman last first city "
+         "river dead live time game king queen lost found home road war "
+         "star light dark fire water stone wind ghost love").split()
+
+
+def synthetic(count, seed=1):
+    rnd = random.Random(seed)
+    shows = ["%s %s %d" % (rnd.choice(WORDS), rnd.choice(WORDS), n)
+             for n in range(max(1, count // 60))]
+    shows[0] = "Firefly"
+    entries = {}
+    for n in range(count):
+        show = shows[n % len(shows)]
+        title = " ".join(rnd.choice(WORDS) for w in range(rnd.randint(2, 5)))
+        entries["%032x" % n] = {
+            "show": show, "title": title, "season": n % 7 + 1,
+            "episode": n % 22 + 1, "year": str(1970 + n % 50),
+            "filename": "/tv/%s/%d.mkv" % (show, n),
+            "mkvinfo": {"video": [{"resname": rnd.choice(["720p", "1080p", "2160p"])}]}}
+    return entries
+
+
+def linear(entries, text="", show=None, season=None):
+    text = text.lower()
+    found = []
+    for details in entries.values():
+        if season and int(season) != int(details['season']):
+            continue
+        if show and details['show'].lower() != show.lower():
+            continue
+        if text and text not in details['show'].lower() and text not in details['title'].lower():
+            continue
+        found.append(details)
+    return found
+
+
+def timed(func, repeat=20):
+    best = None
+    for r in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000
+
+
+def main(sizes):
+    queries = [("text=firefly", dict(text="firefly"), dict(text="firefly")),
+               ("show+season", dict(show="firefly", season=1),
+                dict(show="Firefly", season=1)),
+               ("text=queen", dict(text="queen"), dict(text="queen"))]
+    print("%8s  %-12s  %10s  %10s  %10s  %8s" % (
+        "entries", "query", "first ms", "repeat ms", "linear ms", "results"))
+    for size in sizes:
+        entries = synthetic(size)
+        for name, iq, lq in queries:
+            index = SearchIndex(lambda: entries)
+            found = index.search(**iq)
+            assert len(found) == len(linear(entries, **lq)), name
+            print("%8d  %-12s  %10.3f  %10.3f  %10.3f  %8d" % (
+                size, name,
+                timed(lambda: [entries[m] for m in SearchIndex(lambda: entries).search(**iq)],
+                      repeat=3),
+                timed(lambda: [entries[m] for m in index.search(**iq)]),
+                timed(lambda: linear(entries, **lq), repeat=3),
+                len(found)))
+        print("%8d  %-12s  %10.3f" % (size, "build all",
+                                      timed(lambda: SearchIndex(lambda: entries).build(),
+                                            repeat=3)))
+    return
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser("Usage: %prog [options]")
+    parser.add_option("--sizes", dest="sizes", type="string", help="Comma separated numbers of entries to search [%default]", default="3000,10000,30000,100000")
+    (options, args) = parser.parse_args()
+    try:
+        sizes = [int(size) for size in options.sizes.split(",")]
+    except ValueError:
+        parser.error("--sizes takes a comma separated list of entry counts")
+    main(sizes)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+""" Startup time of JsonDB for each snapshot format: decoding the file,
+    and opening the database (decode, journal replay and the path index),
+    as every lookup.py query does.  Building the whole search index is
+    timed on its own.  Queries only build the tables they use, and only
+    once they're used more than once, see SearchIndex.  Entries are
+    synthetic TV episodes shaped like the ones a scan stores.
+
+    Usage: bench_snapshot.py [--sizes 3000,60000] [--repeat 3]
+"""
+import os
+import sys
+import time
+import optparse
+import random
+import shutil
+import tempfile
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(HERE, "stub"), os.path.join(HERE, "..", "bin")]
+import jsondb  # noqa: E402
+from jsondb import JsonDB, read_snapshot  # noqa: E402
+from bench_search import WORDS  # noqa: E402
+
+
+def synthetic(count, seed=1):
+    rnd = random.Random(seed)
+    shows = ["%s %s %d" % (rnd.choice(WORDS), rnd.choice(WORDS), n)
+             for n in range(max(1, count // 60))]
+    entries = {}
+    for n in range(count):
+        show = shows[n % len(shows)]
+        title = " ".join(rnd.choice(WORDS) for w in range(rnd.randint(2, 5)))
+        size = rnd.randint(200, 4000) * 1024 * 1024
+        path = "/tv/%s/%s.S%02dE%02d.mkv" % (show, show, n % 7 + 1, n % 22 + 1)
+        entries["%032x" % n] = {
+            "show": show, "title": title, "season": n % 7 + 1,
+            "episode": n % 22 + 1, "filename": path, "filetype": "mkv",
+            "filesize": "%d MiB" % (size // 1048576), "md5sum": "%032x" % n,
+            "digests": {"md5": "%032x" % n}, "valid": True,
+            "fingerprint": "%d:%032x" % (size, rnd.getrandbits(128)),
+            "stat": {"dev": 2049, "inode": 1000 + n, "size": size,
+                     "mtime_ns": 1700000000000000000 + n},
+            "size_bytes": size, "duration_ms": rnd.randint(20, 60) * 60000,
+            "bit_rate_bps": 5000000,
+            "probe": {"status": "ok", "tier": "fast", "attempts": 1, "schema": 2},
+            "mkvinfo": {
+                "title": None, "chapters": None, "duration": "45 min",
+                "duration_ms": 2700000,
+                "video": [{"height": 1080, "width": 1920, "resolution": "1920x1080",
+                           "resname": rnd.choice(["720p", "1080p"]), "codec": "AVC",
+                           "duration": None, "bit_rate": "5.00Mb/s",
+                           "bit_rate_bps": 5000000, "bit_depth": 8,
+                           "aspect_ratio": "16:9", "color_primaries": "BT.709",
+                           "frame_rate": "23.976"}],
+                "audio": [{"freq": 48000, "channels": 6, "language": "en",
+                           "bit_depth": None, "codec": "AC-3", "format": "AC-3"}]}}
+    return entries
+
+
+def decode(filename):
+    with jsondb.gc_paused():
+        return read_snapshot(filename)
+
+
+def build_index(filename):
+    """ Milliseconds to build every table of an opened database's index """
+    index = JsonDB(filename).search_index
+    start = time.perf_counter()
+    index.build()
+    return (time.perf_counter() - start) * 1000
+
+
+def best(func, repeat):
+    times = []
+    for r in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times) * 1000
+
+
+def main(sizes, repeat=3):
+    workdir = tempfile.mkdtemp(prefix="bench-snapshot-")
+    formats = ["json"] + list(jsondb.SNAPSHOT_FORMATS)
+    orjson = jsondb.orjson
+    print("orjson: %s, msgpack: %s" % (orjson is not None, jsondb.msgpack is not None))
+    print("%8s  %-8s  %10s  %10s  %10s  %10s" % (
+        "entries", "format", "MiB", "decode ms", "open ms", "index ms"))
+    try:
+        for size in sizes:
+            entries = synthetic(size)
+            for format in formats:
+                filename = os.path.join(workdir, "%d.%s" % (size, format))
+                db = JsonDB(filename)
+                db.db = entries
+                db.index()
+                db.snapshot_format = format
+                db.save()
+                db.clear()
+                assert read_snapshot(filename)[0] == format
+                parsers = [(format, orjson)]
+                if format == "json" and orjson is not None:
+                    parsers.append(("json/std", None))  # Without orjson
+                index = build_index(filename)
+                for name, jsondb.orjson in parsers:
+                    print("%8d  %-8s  %10.1f  %10.1f  %10.1f  %10.1f" % (
+                        size, name, os.path.getsize(filename) / 1048576.0,
+                        best(lambda: decode(filename), repeat),
+                        best(lambda: JsonDB(filename), repeat), index))
+                jsondb.orjson = orjson
+    finally:
+        shutil.rmtree(workdir)
+    return
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser("Usage: %prog [options]")
+    parser.add_option("--sizes", dest="sizes", type="string", help="Comma separated numbers of entries to time [%default]", default="3000,10000,60000")
+    parser.add_option("--repeat", dest="repeat", type="int", help="Time each step X times and keep the fastest [%default]", default=3)
+    (options, args) = parser.parse_args()
+    try:
+        sizes = [int(size) for size in options.sizes.split(",")]
+    except ValueError:
+        parser.error("--sizes takes a comma separated list of entry counts")
+    main(sizes, options.repeat)
@@ -0,0 +1,42 @@
+""" Stand-in for pymediainfo so benchmarks measure this code rather than
+    libmediainfo, and run where it isn't installed.  Track details are
+    made up from a hash of the path, so they're the same on every run.
+"""
+import zlib
+
+HEIGHTS = (480, 720, 1080, 1080, 2160)
+
+
+class Track(object):
+
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+    def __getattr__(self, name):
+        return None
+
+    def to_data(self):
+        return dict(self.__dict__)
+
+
+class MediaInfo(object):
+
+    def __init__(self, tracks):
+        self.tracks = tracks
+
+    @classmethod
+    def parse(cls, path, parse_speed=0.5, **kwargs):
+        seed = zlib.crc32(path.encode("utf8", "surrogateescape"))
+        height = HEIGHTS[seed % len(HEIGHTS)]
+        deep = parse_speed >= 0.5
+        return cls([
+            Track(track_type="General", duration=1200000 + seed % 6000000),
+            Track(track_type="Video", width=height * 16 // 9, height=height,
+                  scan_type="Progressive", other_display_aspect_ratio=["16:9"],
+                  frame_rate="23.976", codec="AVC", bit_depth=8,
+                  bit_rate=1000000 + seed % 30000000 if deep else None,
+                  nominal_bit_rate=None,
+                  color_primaries="BT.709" if deep else None),
+            Track(track_type="Audio", codec_family="AC-3", format="AC-3",
+                  bit_depth=None, language="en", channel_s=6,
+                  sampling_rate=48000)])
@@ -1,11 +1,24 @@
 #!/usr/bin/env python
 import os
+import json
 import logging
 import sqlite3
 import datetime
+import helpers
+import media
+from media import MediaFile
+from searchindex import inode_key
+from jsondb import JsonDB
+from stats import STATS
 
 
 class FileDB(object):
+    """ sqlite backed drop-in for JsonDB.  Entries are stored whole as json
+        in details, with the fields searches filter on copied out into
+        indexed columns so a query doesn't have to decode every row.
+    """
+
+    extensions = ('.sqlite', '.sqlite3')
 
     def __init__(self, filename):
         self.log = logging.getLogger()
@@ -14,11 +27,44 @@ class FileDB(object):
         self.cursor = None
         self.open = False
         self.write_immediate = False
-        self.save_interval = 20  # Every 100 new entries, lets save the database.
-        self.create_syntax = """CREATE TABLE IF NOT EXISTS files (hash TEXT PRIMARY KEY, filepath TEXT, details BLOB);
-                                CREATE UNIQUE INDEX IF NOT EXISTS files.path ON files (filepath);"""
+        self.save_interval = 200  # Commit every 200 new entries
+        self.dirty = False   # Uncommitted changes
+        self.create_syntax = """
+            CREATE TABLE IF NOT EXISTS files (
+                hash TEXT PRIMARY KEY, filepath TEXT NOT NULL,
+                title_lc TEXT, show_lc TEXT, show_key TEXT,
+                season INTEGER, episode INTEGER, year TEXT,
+                resolution TEXT, valid INTEGER DEFAULT 1, details TEXT,
+                fingerprint TEXT, inode TEXT, size_bytes INTEGER,
+                duration_ms INTEGER, bit_rate_bps INTEGER);
+            CREATE UNIQUE INDEX IF NOT EXISTS files_path ON files (filepath);
+            CREATE INDEX IF NOT EXISTS files_title ON files (title_lc);
+            CREATE INDEX IF NOT EXISTS files_show ON files (show_key, season, episode);
+            CREATE INDEX IF NOT EXISTS files_year ON files (year);
+            CREATE INDEX IF NOT EXISTS files_resolution ON files (resolution);"""
+        # Columns added since the first version, for databases made before
+        # them, with the expression that fills them in from details, None
+        # if every entry has to be rewritten by backfill()
+        self.upgrade_columns = (
+            ("fingerprint", "TEXT", "json_extract(details, '$.fingerprint')"),
+            ("inode", "TEXT", "json_extract(details, '$.stat.dev') || ':' || "
+                              "json_extract(details, '$.stat.inode')"),
+            ("size_bytes", "INTEGER", None),
+            ("duration_ms", "INTEGER", None),
+            ("bit_rate_bps", "INTEGER", None))
+        self.upgrade_syntax = """
+            CREATE INDEX IF NOT EXISTS files_fingerprint ON files (fingerprint);
+            CREATE INDEX IF NOT EXISTS files_inode ON files (inode);
+            CREATE INDEX IF NOT EXISTS files_size ON files (size_bytes);
+            CREATE INDEX IF NOT EXISTS files_duration ON files (duration_ms);
+            CREATE INDEX IF NOT EXISTS files_bit_rate ON files (bit_rate_bps);"""
         self.load(filename)
 
+    @classmethod
+    def handles(cls, filename):
+        """ True if filename should be opened with FileDB rather than JsonDB """
+        return filename.lower().endswith(cls.extensions)
+
     def _datetimehandler(self, o):
         if isinstance(o, datetime.datetime):
             return o.__str__()
@@ -26,77 +72,261 @@ class FileDB(object):
     def create(self):
         if not self.open:
             return False
-        with self.connection.cursor() as c:
-            c.execute(self.create_syntax)
+        self.connection.executescript(self.create_syntax)
+        columns = [r[1] for r in self.connection.execute("PRAGMA table_info(files);")]
+        backfill = False
+        for column, kind, fill in self.upgrade_columns:
+            if column not in columns:
+                self.connection.execute("ALTER TABLE files ADD COLUMN %s %s;" % (column, kind))
+                if fill:
+                    self.connection.execute("UPDATE files SET %s = %s;" % (column, fill))
+                else:
+                    backfill = True
+        if backfill:
+            self.backfill()
+        self.connection.executescript(self.upgrade_syntax)
+        self.connection.commit()
         return True
 
+    def backfill(self):
+        """ Add media.raw_fields() to every entry, for databases from
+            before they were kept
+        """
+        rows = self.connection.execute("""SELECT hash, details FROM files;""").fetchall()
+        for md5sum, details in rows:
+            struct = json.loads(details)
+            struct.update(media.raw_fields(struct))
+            self._store(struct, struct['filename'], md5sum)
+        self.log.info("db: backfilled raw sizes, durations and bit rates "
+                      "for (%d) entries", len(rows))
+        return
+
     def load(self, filename=None):
         filename = filename or self.filename
         try:
             self.connection = sqlite3.connect(filename)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
             self.cursor = self.connection.cursor()
             self.open = True
-        except IOError:
-            self.log.error("db=%s is missing", filename)
+            self.create()
         except Exception as e:
             self.log.error("unable to read db=%s: %s", filename, e)
+            self.open = False
         return self.open
 
+    def index(self):
+        # Indexes live in sqlite
+        return self.open
+
+    def _row(self, struct, filename, md5sum):
+        """ Column values for an entry """
+        resolution = None
+        video = (struct.get("mkvinfo") or {}).get("video") or []
+        if len(video) > 0:
+            resolution = video[0].get("resname")
+        show = struct.get("show")
+        stat = struct.get("stat")
+        return (md5sum, filename, (struct.get("title") or "").lower(),
+                show.lower() if show else None,
+                helpers.normalize_name(show) if show else None,
+                struct.get("season"), struct.get("episode"),
+                struct.get("year"), resolution,
+                int(bool(struct.get("valid", True))),
+                json.dumps(struct, default=self._datetimehandler),
+                struct.get("fingerprint"),
+                inode_key(stat['dev'], stat['inode']) if stat else None,
+                struct.get("size_bytes"), struct.get("duration_ms"),
+                struct.get("bit_rate_bps"))
+
+    def _store(self, struct, filename, md5sum):
+        # REPLACE also drops a stale entry that held this path before
+        sql = """INSERT OR REPLACE INTO files (hash, filepath, title_lc, show_lc,
+                 show_key, season, episode, year, resolution, valid, details,
+                 fingerprint, inode, size_bytes, duration_ms, bit_rate_bps)
+                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);"""
+        self.cursor.execute(sql, self._row(struct, filename, md5sum))
+        self.dirty = True
+        if self.write_immediate:
+            self.save()
+        return
+
     def add(self, struct, filename, md5sum=""):
         if not md5sum:
-            md5sum = self.md5File(filename)
+            mfile = MediaFile(filename)
+            md5sum = mfile.md5file()
+        if not md5sum:
+            self.log.error("db: unable to add entry without a key!")
+            return False
         self.log.debug("db: add entry=%s", struct)
-        sql = """INSERT INTO files (hash, filename, details) VALUES (?, ?, ?);"""
         try:
-            self.cursor.execute(sql, (md5sum, filename, struct))
-            self.log.info("db: added filename=%s md5sum=%s to db",
+            self._store(struct, filename, md5sum)
+            self.log.info("db: adding filename=%s md5sum=%s to db",
                           os.path.basename(filename), md5sum)
             return True
         except Exception as e:
             self.log.error("db: failed insert filename=%s: %s", filename, e)
-
-        if self.write_immediate:
-            self.connection.commit()
         return False
 
-    def remove(self, md5sum):
-        details = self.get_hash(md5sum)
+    def update(self, md5sum, struct):
+        """ Store changes made to an existing entry """
+        try:
+            self._store(struct, struct['filename'], md5sum)
+        except Exception as e:
+            self.log.error("db: failed update md5sum=%s: %s", md5sum, e)
+        return
+
+    def remove(self, md5sum=None):
+        details = self.get(md5sum) if md5sum else None
         if details:
-            self.log.info("db: removing hash=%s filename=%s")
-            sql = """DELETE FROM files WHERE hash=?"""
+            self.log.info("db: removing md5=%s filename=%s", md5sum,
+                          os.path.basename(details['filename']))
+            sql = """DELETE FROM files WHERE hash=?;"""
             try:
-                self.cursor.execute(sql, md5sum.lower())
-                return True
+                self.cursor.execute(sql, (md5sum,))
+                self.dirty = True
             except Exception as e:
                 self.log.error("db: failed to delete md5sum=%s: %s", md5sum, e)
-        else:
+        elif md5sum:
             self.log.error("db: remove hash=%s failed, no such hash!", md5sum)
-        return False
 
         if self.write_immediate:
-            self.connection.commit()
+            self.save()
         return
 
-    def get_path(self, path):
-        sql = """SELECT * FROM files WHERE filename=?;"""
+    def _fetch(self, sql, args):
         try:
-            self.cursor.execute(sql, (path,))
-            return self.cursor.fetchone()
+            self.cursor.execute(sql, args)
+            row = self.cursor.fetchone()
         except Exception as e:
-            self.log.error("Unable to fetch path=%s: %s", path, e)
+            self.log.error("Unable to fetch %s: %s", args, e)
+            return None
+        if row:
+            return json.loads(row[0])
         return None
 
+    def get(self, md5sum):
+        return self._fetch("""SELECT details FROM files WHERE hash=?;""", (md5sum,))
+
     def get_hash(self, md5sum):
-        sql = """SELECT * FROM files WHERE hash=?;"""
+        return self.get(md5sum)
+
+    def get_path(self, path):
+        return self._fetch("""SELECT details FROM files WHERE filepath=?;""", (path,))
+
+    def get_inode(self, dev, inode):
+        """ Entries last seen at this device and inode """
+        return [json.loads(r[0]) for r in self.connection.execute(
+            """SELECT details FROM files WHERE inode=?;""", (inode_key(dev, inode),))]
+
+    def get_fingerprint(self, fingerprint):
+        """ Entries whose content probably matches fingerprint """
+        return [json.loads(r[0]) for r in self.connection.execute(
+            """SELECT details FROM files WHERE fingerprint=?;""", (fingerprint,))]
+
+    def move(self, md5sum, struct, oldpath):
+        """ Store an entry whose filename changed from oldpath """
+        self.update(md5sum, struct)
+        return
+
+    def entries(self):
+        """ Iterate over (md5sum, entry) for the whole database """
+        for md5sum, details in self.connection.execute(
+                """SELECT hash, details FROM files;"""):
+            yield md5sum, json.loads(details)
+
+    def candidates(self, text=None, show=None, season=None, episode=None,
+                   year=None, resolution=None, ranges=None, order=None,
+                   top=None):
+        """ Entries that may match a search, narrowed down by sqlite using
+            the indexed columns.  Callers still filter the results, which
+            are decoded a row at a time as they're iterated, largest order
+            column first if order is given.  top isn't needed, sqlite walks
+            the column's index in order.
+        """
+        where = []
+        args = []
+        if text:
+            where.append("(instr(title_lc, ?) > 0 OR instr(show_lc, ?) > 0)")
+            args.extend([text.lower(), text.lower()])
+        for column, value in (("show_key", show), ("year", year)):
+            if value:
+                where.append("%s = ?" % column)
+                args.append(value)
+        if resolution:
+            # Entries without a video track aren't filtered on resolution
+            where.append("(resolution = ? OR resolution IS NULL)")
+            args.append(resolution)
+        for column, value in (("season", season), ("episode", episode)):
+            if value:
+                where.append("%s = ?" % column)
+                args.append(int(value))
+        for column, (low, high) in (ranges or {}).items():
+            if column not in media.RAW_FIELDS:
+                raise ValueError("no range index on %s" % column)
+            if low is not None:
+                where.append("%s >= ?" % column)
+                args.append(low)
+            if high is not None:
+                where.append("%s <= ?" % column)
+                args.append(high)
+        sql = "SELECT details FROM files"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        if order:
+            if order not in media.RAW_FIELDS:
+                raise ValueError("no sorted index on %s" % order)
+            # NULLs sort lowest, so entries without a value come last
+            sql += " ORDER BY %s DESC" % order
+        return (json.loads(r[0]) for r in self.connection.execute(sql, args))
+
+    def count(self):
+        return self.connection.execute("""SELECT COUNT(*) FROM files;""").fetchone()[0]
+
+    def migrate(self, jsonfile):
+        """ One-shot import of every entry of a JsonDB database, journal
+            included, in any of its snapshot formats
+        """
+        source = JsonDB(jsonfile)
+        if not source.open:
+            return 0
+        write_immediate, self.write_immediate = self.write_immediate, False
         try:
-            self.cursor.execute(sql, (md5sum,))
-            return self.cursor.fetchone()
+            count = 0
+            for md5sum, struct in source.entries():
+                if 'size_bytes' not in struct:
+                    struct.update(media.raw_fields(struct))
+                self._store(struct, struct['filename'], md5sum)
+                count += 1
+            self.save()
+        finally:
+            self.write_immediate = write_immediate
+        self.log.info("db: migrated (%d) entries from %s into %s",
+                      count, jsonfile, self.filename)
+        return count
+
+    def save(self, filename=None):
+        if not self.open:
+            return
+        try:
+            with STATS.phase("save"):
+                self.connection.commit()
+            self.dirty = False
         except Exception as e:
-            self.log.error("Unable to fetch hash=%s: %s", md5sum, e)
-        return None
+            self.log.error("unable to commit db=%s: %s", self.filename, e)
+        return
 
-    def close(self):
-        self.connection.commit()
+    def clean_invalid(self):
+        try:
+            self.cursor.execute("""DELETE FROM files WHERE valid = 0;""")
+        except Exception as e:
+            self.log.error("db: failed to clean invalid entries: %s", e)
+        return
+
+    def close(self, save=False):
+        if not self.open:
+            return
+        self.save()
         self.cursor.close()
         self.connection.close()
         self.open = False
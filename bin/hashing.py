@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+import os
+import time
+import mmap
+import zlib
+import queue
+import hashlib
+import collections
+import multiprocessing
+import helpers
+from scheduler import DeviceScheduler
+from stats import STATS
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+class CRC32(object):
+    """ zlib.crc32 behind the hashlib update()/hexdigest() interface """
+
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def hexdigest(self):
+        return "%08x" % self.value
+
+
+DIGESTS = {'md5': hashlib.md5, 'sha1': hashlib.sha1,
+           'sha256': hashlib.sha256, 'crc32': CRC32}
+if xxhash is not None:
+    DIGESTS['xxh64'] = xxhash.xxh64
+
+# Cheapest to compute first, verification uses the first one available
+COST = ('xxh64', 'crc32', 'md5', 'sha1', 'sha256')
+
+SIDECAR_HEADER = "# digests v1"
+
+FINGERPRINT_SAMPLES = 3  # head, middle and tail
+FINGERPRINT_SAMPLE_SIZE = 64 * 1024
+
+
+def parse_digests(names):
+    """ Turn "sha256,crc32" into a tuple of digest names, md5 always first
+        since it's what the database is keyed on.  Raises ValueError for
+        digests we can't compute.
+    """
+    if isinstance(names, str):
+        names = names.split(",")
+    wanted = ['md5']
+    for name in names:
+        name = name.strip().lower()
+        if not name or name in wanted:
+            continue
+        if name not in DIGESTS:
+            raise ValueError("unknown digest %s, choose from %s" % (
+                name, ",".join(sorted(DIGESTS))))
+        wanted.append(name)
+    return tuple(wanted)
+
+
+def cheapest(names):
+    """ The cheapest digest of names we can compute, None if there's none """
+    for name in COST:
+        if name in names and name in DIGESTS:
+            return name
+    return None
+
+
+def read_sidecar(fh):
+    """ Digests from a sidecar file: the first line is "<md5>\t<name>" as
+        it always was, extra digests follow as "# <name> <hex>" lines after
+        SIDECAR_HEADER, which older readers never look at.
+    """
+    digests = {}
+    lines = fh.read().splitlines()
+    if not lines or not lines[0].split():
+        return digests
+    digests['md5'] = lines[0].split()[0].lower()
+    for line in lines[1:]:
+        fields = line.split()
+        if line == SIDECAR_HEADER:
+            continue
+        if len(fields) == 3 and fields[0] == "#":
+            digests[fields[1].lower()] = fields[2].lower()
+    return digests
+
+
+def format_sidecar(filename, digests):
+    """ Sidecar contents for digests, byte for byte the old format when
+        there's nothing but the md5
+    """
+    text = digests['md5'] + "\t" + filename
+    extra = sorted(n for n in digests if n != 'md5')
+    if extra:
+        text += "\n" + SIDECAR_HEADER + "\n"
+        text += "".join("# %s %s\n" % (n, digests[n]) for n in extra)
+    return text
+
+
+def digest(path, names=('md5',), block_size=DEFAULT_BLOCK_SIZE, use_mmap=False):
+    """ Return {name: hexdigest} for every digest in names, and the number
+        of bytes read, reading the file only once.  Reads block_size chunks
+        into one reused buffer, or with use_mmap hashes straight out of the
+        page cache without copying at all.
+    """
+    hashers = [(n, DIGESTS[n]()) for n in names]
+    updates = [h.update for n, h in hashers]
+    size = 0
+    with open(path, 'rb', buffering=0) as fh:
+        fd = fh.fileno()
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        if use_mmap:
+            size = os.fstat(fd).st_size
+            if size > 0:  # Can't mmap an empty file
+                with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mm:
+                    if hasattr(mm, 'madvise'):
+                        mm.madvise(mmap.MADV_SEQUENTIAL)
+                    view = memoryview(mm)
+                    try:
+                        for offset in range(0, size, block_size):
+                            # Released each time round, mm can't close
+                            # while a slice of it is still exported
+                            with view[offset:offset + block_size] as chunk:
+                                for update in updates:
+                                    update(chunk)
+                    finally:
+                        view.release()
+        else:
+            buf = bytearray(block_size)
+            view = memoryview(buf)
+            while True:
+                count = fh.readinto(buf)
+                if not count:
+                    break
+                size += count
+                chunk = view[:count]
+                for update in updates:
+                    update(chunk)
+    return dict((n, h.hexdigest()) for n, h in hashers), size
+
+
+def md5sum(path, block_size=DEFAULT_BLOCK_SIZE, use_mmap=False):
+    """ Return the md5 hexdigest of path, and the number of bytes read """
+    digests, size = digest(path, ('md5',), block_size, use_mmap)
+    return digests['md5'], size
+
+
+def fingerprint(path, size=None, samples=FINGERPRINT_SAMPLES,
+                sample_size=FINGERPRINT_SAMPLE_SIZE):
+    """ Cheap identity for a file: its size and an md5 of sample_size
+        blocks at evenly spread offsets, first and last included.  The same
+        content always gives the same fingerprint, but not the other way
+        round, so a match has to be confirmed with a full hash.
+    """
+    m = hashlib.md5()
+    with open(path, 'rb', buffering=0) as fh:
+        fd = fh.fileno()
+        if size is None:
+            size = os.fstat(fd).st_size
+        if size <= samples * sample_size:
+            m.update(os.pread(fd, size, 0))
+        else:
+            step = (size - sample_size) // (samples - 1)
+            for i in range(samples):
+                m.update(os.pread(fd, sample_size, i * step))
+    return "%d:%s" % (size, m.hexdigest())
+
+
+def hash_file(path, block_size=DEFAULT_BLOCK_SIZE, use_mmap=False,
+              names=('md5',), sample=False):
+    """ Worker entry point: hash one file, never raising.  Runs in the
+        pool processes, so it only reads and reports back to the parent.
+        cpu vs seconds tells whether hashing was cpu or disk bound.
+        md5 is None when it wasn't one of the digests asked for.  With
+        sample the file's fingerprint() is taken too, None if it can't be,
+        and with no names that's all that's read.
+    """
+    result = {'path': path, 'md5': None, 'digests': {}, 'bytes': 0,
+              'fingerprint': None, 'seconds': 0.0, 'cpu': 0.0, 'error': None}
+    start = time.time()
+    cpu = time.process_time()
+    if sample:
+        try:
+            result['fingerprint'] = fingerprint(path)
+        except OSError:
+            pass
+    try:
+        if names:
+            result['digests'], result['bytes'] = digest(path, names, block_size, use_mmap)
+            result['md5'] = result['digests'].get('md5')
+    except Exception as e:
+        result['error'] = str(e)
+    result['seconds'] = time.time() - start
+    result['cpu'] = time.process_time() - cpu
+    return result
+
+
+def account(result):
+    """ Add a hash_file result to the run's STATS """
+    if result['error']:
+        STATS.count("hash_errors")
+        return
+    if not result['digests']:
+        return  # Only fingerprinted
+    STATS.add("hash", result['seconds'], result['cpu'], nbytes=result['bytes'])
+    STATS.file("hash", result['path'], result['seconds'], result['bytes'])
+    return
+
+
+def rate(result):
+    """ Human bytes/sec for a hash_file result """
+    return "%s/s" % helpers.bytes_to_human(
+        result['bytes'] / max(result['seconds'], 0.001))
+
+
+class HashPool(object):
+    """ Fan file hashing out to a pool of worker processes.  Work is grouped
+        by device so each disk gets at most `readers` sequential readers.
+        Database updates, saves and logging all stay with the caller, which
+        consumes results from run() in the parent process.
+    """
+
+    def __init__(self, jobs=1, readers=1, block_size=DEFAULT_BLOCK_SIZE,
+                 use_mmap=False, lookahead=4096, digests=('md5',)):
+        self.jobs = max(1, jobs or 1)
+        self.block_size = block_size or DEFAULT_BLOCK_SIZE
+        self.use_mmap = use_mmap
+        self.digests = digests  # Computed for tasks that don't name their own
+        self.lookahead = lookahead  # Files queued ahead looking for idle disks
+        self.scheduler = DeviceScheduler(readers)
+        self.pool = None
+        self.done = queue.Queue()
+        self.files = 0
+        self.bytes = 0
+        self.seconds = 0.0  # Time spent inside hash_file, summed over workers
+        self.cpu = 0.0
+        self.devices = collections.Counter()  # device -> bytes hashed
+        self.started = time.time()
+        if self.jobs > 1:
+            self.pool = multiprocessing.Pool(self.jobs)
+
+    def run(self, tasks):
+        """ Hash the path of every (context, path, device) in tasks, yielding
+            (context, result) as each one finishes.  A path of None needs no
+            hashing and is passed straight through with a None result.  A
+            task may add a fourth item, the digest names to compute for it,
+            and a fifth, True to have the worker fingerprint it as well.
+        """
+        for task in tasks:
+            context, path, device = task[:3]
+            names = task[3] if len(task) > 3 else self.digests
+            sample = task[4] if len(task) > 4 else False
+            if path is None:
+                yield context, None
+            elif self.pool is None:
+                result = hash_file(path, self.block_size, self.use_mmap, names, sample)
+                yield context, self._account(device, result)
+            else:
+                self.scheduler.put(device, (context, path, names, sample))
+                self._dispatch()
+                while self.scheduler.queued >= self.lookahead:
+                    yield self._collect(block=True)
+                while not self.done.empty():
+                    yield self._collect()
+        while self.scheduler.busy() > 0:
+            yield self._collect(block=True)
+
+    def _dispatch(self):
+        """ Start queued hashes while there are idle workers and disks """
+        while self.scheduler.busy() < self.jobs:
+            work = self.scheduler.get()
+            if work is None:
+                break
+            device, (context, path, names, sample) = work
+
+            def finished(result, context=context, device=device):
+                self.done.put((device, context, result))
+            self.pool.apply_async(hash_file, (path, self.block_size, self.use_mmap,
+                                              names, sample), callback=finished)
+        return
+
+    def _collect(self, block=False):
+        device, context, result = self.done.get(block)
+        self.scheduler.release(device)
+        self._dispatch()
+        return context, self._account(device, result)
+
+    def _account(self, device, result):
+        account(result)
+        if not result['error'] and result['digests']:
+            self.files += 1
+            self.bytes += result['bytes']
+            self.seconds += result['seconds']
+            self.cpu += result['cpu']
+            self.devices[device] += result['bytes']
+        return result
+
+    def summary(self):
+        """ Aggregate throughput since the pool was started.  cpu is the
+            share of hashing time spent computing rather than waiting on
+            reads, near 100% means adding disks won't help.
+        """
+        elapsed = max(time.time() - self.started, 0.001)
+        return "hashed files=%d size=%s elapsed=%.1fs throughput=%s/s cpu=%d%% jobs=%d devices=%d block=%s%s digests=%s" % (
+            self.files, helpers.bytes_to_human(self.bytes), elapsed,
+            helpers.bytes_to_human(self.bytes / elapsed),
+            100 * self.cpu / max(self.seconds, 0.001), self.jobs,
+            len(self.devices), helpers.bytes_to_human(self.block_size, 0),
+            " mmap" if self.use_mmap else "", ",".join(self.digests))
+
+    def close(self):
+        if self.pool is not None:
+            if self.scheduler.busy() > 0:
+                self.pool.terminate()
+            else:
+                self.pool.close()
+            self.pool.join()
+            self.pool = None
+        return
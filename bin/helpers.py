@@ -1,4 +1,37 @@
 #!/usr/bin/env python
+import re
+import heapq
+
+# Integer fields kept on each entry next to the display strings, for
+# range searches and sorting
+RAW_FIELDS = ('size_bytes', 'duration_ms', 'bit_rate_bps')
+
+
+def largest(field):
+    """ Sort key for entries by one of RAW_FIELDS, used reversed so the
+        largest come first and entries without a value last
+    """
+    def key(details):
+        value = details.get(field)
+        return (value is not None, value or 0)
+    return key
+
+
+def largest_entries(entries, field, top):
+    """ The top entries with the largest field, largest first, and how
+        many different entries (by md5sum) there were.  Only the top are
+        held, the rest are just counted.
+    """
+    seen = set()
+
+    def unique():
+        for details in entries:
+            if details['md5sum'] not in seen:
+                seen.add(details['md5sum'])
+                yield details
+    found = heapq.nlargest(top, unique(), key=largest(field))
+    return found, len(seen)
+
 
 def speed_to_human(bps, precision=2):
     mbps = bps / 1000000.0
@@ -19,3 +52,36 @@ def ms_to_human(ms):
     days, hours = divmod(hours, 24)
     return "%d:%02d:%02d" % (hours, minutes, seconds)
 
+def human_to_bytes(text):
+    """ Inverse of bytes_to_human, "2.86MB" -> 2998927.  A bare number is
+        bytes.  None if text isn't a size.
+    """
+    m = re.match(r"^\s*(\d+(?:\.\d*)?)\s*([KMGT]?)B?\s*$", str(text), re.I)
+    if not m:
+        return None
+    return int(float(m.group(1)) * 1024 ** " KMGT".index(m.group(2).upper() or " "))
+
+def human_to_ms(text):
+    """ Inverse of ms_to_human, "1:30:00" -> 5400000, None if text isn't a
+        duration
+    """
+    m = re.match(r"^\s*(\d+):(\d\d):(\d\d)\s*$", str(text))
+    if not m:
+        return None
+    hours, minutes, seconds = [int(x) for x in m.groups()]
+    return ((hours * 60 + minutes) * 60 + seconds) * 1000
+
+def human_to_speed(text):
+    """ Inverse of speed_to_human, "16.22Mb/s" -> 16220000, None if text
+        isn't a speed
+    """
+    m = re.match(r"^\s*(\d+(?:\.\d*)?)\s*Mb/s\s*$", str(text))
+    if not m:
+        return None
+    return int(round(float(m.group(1)) * 1000000))
+
+def normalize_name(name):
+    """ Lowercase alphanumerics only, so 'Marvel's Agents of S.H.I.E.L.D.'
+        and 'marvels.agents.of.shield' compare equal """
+    return re.sub(r'[^A-Za-z0-9]+', '', name.lower())
+
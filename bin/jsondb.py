@@ -1,53 +1,380 @@
 #!/usr/bin/env python
 import os
-import sys
-import time
 import logging
 import json
+import gc
+import pickle
+import marshal
 import datetime
+import itertools
+import contextlib
+import collections
+import media
+import records
 from media import MediaFile
+from searchindex import SearchIndex
+from locking import FileLock, LockTimeout
+from stats import STATS
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# Binary snapshots start with this, the format's name and a newline.  A json
+# snapshot starts with "{", so the two can't be mistaken for each other.
+SNAPSHOT_MAGIC = b"MCDB "
+SNAPSHOT_VERSION = 1
+SNAPSHOT_FORMATS = collections.OrderedDict([
+    ("pickle", (lambda o: pickle.dumps(o, protocol=pickle.HIGHEST_PROTOCOL), pickle.loads)),
+    ("marshal", (marshal.dumps, marshal.loads)),
+])
+if msgpack is not None:
+    SNAPSHOT_FORMATS["msgpack"] = (
+        lambda o: msgpack.packb(o, use_bin_type=True, default=records.plain),
+        lambda b: msgpack.unpackb(b, raw=False, strict_map_key=False))
+
+
+def loads(text):
+    """ json.loads, through orjson when it's installed """
+    if orjson is not None:
+        try:
+            return orjson.loads(text)
+        except ValueError:
+            pass  # NaN and the like, which only json accepts
+    return json.loads(text)
+
+
+@contextlib.contextmanager
+def gc_paused():
+    """ Hold off the cyclic garbage collector.  Loading a database makes
+        millions of containers and no cycles, so every collection it would
+        trigger is wasted time.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def read_snapshot(filename):
+    """ Returns (format, db, path_index) from a snapshot file of any
+        format, path_index None if it wasn't saved with one
+    """
+    with open(filename, 'rb') as fh:
+        data = fh.read()
+    if not data.startswith(SNAPSHOT_MAGIC):
+        return "json", loads(data), None
+    header, data = data.split(b"\n", 1)
+    format = header[len(SNAPSHOT_MAGIC):].decode("ascii")
+    if format not in SNAPSHOT_FORMATS:
+        raise ValueError("unsupported snapshot format %s" % format)
+    payload = SNAPSHOT_FORMATS[format][1](data)
+    if payload.get("version") != SNAPSHOT_VERSION:
+        raise ValueError("unsupported %s snapshot version %s" % (format, payload.get("version")))
+    return format, payload["db"], payload["path_index"]
 
 
 class JsonDB(object):
+    """ A dict of md5sum -> entry, kept in a json snapshot file.  Changes
+        are appended to <filename>.journal as they're saved, and only
+        folded into a fresh snapshot once the journal grows large.
+
+        The snapshot can instead be written in one of SNAPSHOT_FORMATS,
+        which load faster and keep the path index too.  Whichever format a
+        snapshot is in is detected when it's read, and kept unless
+        snapshot_format is changed.  The journal is always json lines.
 
-    def __init__(self, filename):
+        With compact_records set, entries are held as records.Entry rather
+        than dicts, which takes a fraction of the memory.  They're written
+        out as plain dicts either way.
+
+        Loading holds a shared lock on <filename>.lock and saving an
+        exclusive one, so a reader never sees half a save.  Before writing,
+        save() merges in whatever other processes saved since we loaded,
+        with our own changes winning for entries both touched.
+    """
+
+    lock_timeout = 300  # Seconds to wait for the lock before giving up
+
+    def __init__(self, filename, compact_records=False):
         self.log = logging.getLogger()
         self.filename = filename
+        self.journalfile = filename + ".journal"
+        self.oldjournalfile = filename + ".journal.old"  # While compacting
+        self.disk = None          # Snapshot we loaded, see _snapshot_id()
+        self.journal_id = None    # Inode of the journal we read
+        self.journal_offset = 0   # How far we've read it
         self.db = {}
         self.path_index = {}
+        self.search_index = SearchIndex(lambda: self.db)
         self.write_immediate = False
         self.open = False
         self.save_interval = 20  # Every 100 new entries, lets save the database.
         self.dirty = False   # Track changes.
+        self.journal = True  # Append changes instead of rewriting everything
+        self.journal_min = 4 * 1024 * 1024     # Never compact below this
+        self.journal_max = 256 * 1024 * 1024   # Always compact above this
+        self.journal_ratio = 0.5  # Compact when journal > ratio * snapshot
+        self.journal_torn = False  # A crash left a partial record behind
+        self.pending = collections.OrderedDict()  # md5sum -> entry, None if removed
+        self.backfilled = {}  # md5sum -> entry given raw fields in memory only
+        self.snapshot_format = "json"  # Format the next snapshot is written in
+        self.loaded_format = "json"    # Format the snapshot on disk is in
+        self.path_index_loaded = False  # path_index came with the snapshot
+        self.compact_records = compact_records  # Hold entries as records.Entry
         self.load(filename)
 
     def _datetimehandler(self, o):
         if isinstance(o, datetime.datetime):
             return o.__str__()
+        if isinstance(o, records.Record):
+            return records.plain(o)
 
     def clear(self):
         self.db = {}
         self.path_index = {}
+        self.path_index_loaded = False
+        self.search_index.clear()
+        self.pending.clear()
+        self.backfilled = {}
         return
 
     def load(self, filename=None):
         filename = filename or self.filename
-        if os.path.isfile(filename):
-            try:
-                with open(filename, 'r') as fh:
-                    self.db = json.load(fh)
-                self.open = True
-                self.index()
-            except Exception as e:
-                self.log.error("unable to read db=%s: %s", filename, e)
+        try:
+            with gc_paused(), self._filelock(filename).shared():
+                self._load(filename)
+        except Exception as e:
+            self.log.error("unable to read db=%s: %s", filename, e)
         return self.open
 
+    def _load(self, filename):
+        with STATS.phase("load"):
+            if filename == self.filename:
+                self.disk = self._snapshot_id()
+            if os.path.isfile(filename):
+                format, self.db, path_index = read_snapshot(filename)
+                if self.compact_records:
+                    for md5, details in self.db.items():
+                        self.db[md5] = records.compact(details)
+                self.path_index = path_index or {}
+                self.path_index_loaded = path_index is not None
+                if filename == self.filename:
+                    self.loaded_format = self.snapshot_format = format
+        if filename == self.filename:
+            with STATS.phase("replay"):
+                self.replay()
+        self.open = True  # A missing database is a new, empty one
+        with STATS.phase("index"):
+            self.index()
+        return
+
+    def replay(self):
+        """ Apply journal records over the snapshot.  A torn record from
+            a crash ends the replay.  A crash while compacting can leave the
+            journal moved aside, see _write_snapshot(), and it's replayed
+            too while the new snapshot isn't in place yet.
+        """
+        records = self._journal_records(0)
+        if self._compaction_interrupted():
+            moved = self._read_journal(self.oldjournalfile)
+            records = itertools.chain((record for record, length in moved), records)
+        count = 0
+        for record in records:
+            if "del" in record:
+                self._unpath(record["del"])
+                self.db.pop(record["del"], None)
+            else:
+                md5sum, entry = record["put"], self._record(record["entry"])
+                self._unpath(md5sum)
+                self.db[md5sum] = entry
+                if self.path_index_loaded:
+                    self.path_index[entry['filename']] = md5sum
+            count += 1
+        if count:
+            self.log.debug("db: replayed (%d) journal records from %s",
+                           count, self.journalfile)
+        return count
+
+    def _journal_records(self, offset):
+        """ Yield journal records from byte offset on, keeping track of how
+            far we've read in journal_offset
+        """
+        self.journal_id = self._journal_id()
+        self.journal_offset = offset
+        if self.journal_id is None:
+            return
+        for record, length in self._read_journal(self.journalfile, offset):
+            self.journal_offset += length
+            yield record
+        return
+
+    def _read_journal(self, journalfile, offset=0):
+        """ Yield (record, length in bytes) from journalfile, from byte
+            offset on
+        """
+        with open(journalfile, 'rb') as fh:
+            fh.seek(offset)
+            for line in fh:
+                try:
+                    record = loads(line)
+                except ValueError:
+                    record = None
+                if not line.endswith(b"\n") or not isinstance(record, dict):
+                    self.log.warning("db: ignoring torn journal record in %s",
+                                     journalfile)
+                    self.journal_torn = True
+                    return
+                yield record, len(line)
+        return
+
+    def _snapshot_id(self):
+        """ Identifies the snapshot file, which is replaced, never rewritten
+            in place, whenever it's saved.  None if there's none.
+        """
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _compaction_interrupted(self):
+        """ True if a crash stopped _write_snapshot() after it moved the
+            journal aside but before the new snapshot replaced the old one
+        """
+        return (os.path.isfile(self.oldjournalfile) and
+                os.path.isfile("%s.tmp" % self.filename))
+
+    def _finish_compaction(self):
+        """ Complete or clean up after a _write_snapshot() a crash cut
+            short.  Called with the exclusive lock.
+        """
+        if not os.path.isfile(self.oldjournalfile):
+            return
+        if self._compaction_interrupted():
+            self.log.warning("db: completing the interrupted save of %s", self.filename)
+            os.rename("%s.tmp" % self.filename, self.filename)
+        os.unlink(self.oldjournalfile)
+        return
+
+    def _journal_id(self):
+        try:
+            return os.stat(self.journalfile).st_ino
+        except OSError:
+            return None
+
+    def _filelock(self, filename):
+        return FileLock(filename + ".lock", self.lock_timeout)
+
+    def _merge(self):
+        """ Bring in changes other processes saved since we loaded, before
+            our own save goes over them.  Called with the exclusive lock.
+            Our pending changes win over theirs.
+        """
+        if self._snapshot_id() != self.disk:
+            self._reload()
+            return
+        journal_id = self._journal_id()
+        if journal_id is None or journal_id == self.journal_id:
+            offset = self.journal_offset
+        elif self.journal_id is None:
+            offset = 0  # Started since we loaded
+        else:
+            self._reload()
+            return
+        if journal_id is None or os.path.getsize(self.journalfile) <= offset:
+            return
+        merged = 0
+        for record in self._journal_records(offset):
+            md5sum = record.get("del") or record["put"]
+            if md5sum in self.pending:
+                continue
+            old = self.db.pop(md5sum, None)
+            if old is not None:
+                if self.path_index.get(old['filename']) == md5sum:
+                    del self.path_index[old['filename']]
+                self.search_index.remove(md5sum)
+            if "put" in record:
+                entry = self._record(record["entry"])
+                self.db[md5sum] = entry
+                self.path_index[entry['filename']] = md5sum
+                self.search_index.add(md5sum, entry)
+            merged += 1
+        self.log.info("db: merged (%d) changes saved to %s by another process",
+                      merged, self.journalfile)
+        return
+
+    def _reload(self):
+        """ Load the database again, another process rewrote the snapshot,
+            and apply our pending changes over it
+        """
+        pending = collections.OrderedDict(self.pending)
+        snapshot_format = self.snapshot_format
+        self.clear()
+        with gc_paused():
+            self._load(self.filename)
+            self.snapshot_format = snapshot_format
+            for md5sum, struct in pending.items():
+                old = self.db.pop(md5sum, None)
+                if old is not None and self.path_index.get(old['filename']) == md5sum:
+                    del self.path_index[old['filename']]
+                if struct is None:
+                    self.search_index.remove(md5sum)
+                else:
+                    self.db[md5sum] = struct
+                    self.path_index[struct['filename']] = md5sum
+                    self.search_index.add(md5sum, struct)
+            self.pending.update(pending)
+        self.dirty = True
+        self.log.info("db: reloaded %s saved by another process, (%d) changes of "
+                      "ours on top", self.filename, len(pending))
+        return
+
+    def _record(self, struct):
+        return records.compact(struct) if self.compact_records else struct
+
+    def _unpath(self, md5sum):
+        """ Drop md5sum's current filename from a loaded path index """
+        old = self.db.get(md5sum)
+        if self.path_index_loaded and old and self.path_index.get(old['filename']) == md5sum:
+            del self.path_index[old['filename']]
+        return
+
+    def _changed(self, md5sum, struct):
+        """ Remember a change for the next save, None meaning removed """
+        self.pending.pop(md5sum, None)
+        self.pending[md5sum] = struct
+        self.dirty = True
+        return
+
     def index(self):
-        # Build path index
+        # Build the path index, the search index builds itself as queries
+        # need it
         if not self.open:
             return False
-        for md5, details in self.db.iteritems():
-            self.path_index[details['filename']] = md5
+        self.search_index.clear()
+        self.backfilled = {}
+        for md5, details in self.db.items():
+            if 'size_bytes' not in details:
+                # From before the raw fields were kept.  Only saved along
+                # with a real change, so a search doesn't write anything.
+                details.update(media.raw_fields(details))
+                self.backfilled[md5] = details
+            if not self.path_index_loaded:
+                self.path_index[details['filename']] = md5
+        if self.backfilled:
+            self.log.info("db: backfilled raw sizes, durations and bit rates "
+                          "for (%d) entries", len(self.backfilled))
         return True
 
     def add(self, struct, filename, md5sum=""):
@@ -58,9 +385,11 @@ class JsonDB(object):
             self.log.error("db: unable to add entry without a key!")
             return False
         self.log.debug("db: add entry=%s", struct)
+        struct = self._record(struct)
         self.db[md5sum] = struct
-        self.dirty = True
+        self._changed(md5sum, struct)
         self.path_index[filename] = md5sum
+        self.search_index.add(md5sum, struct)
         self.log.info("db: adding filename=%s md5sum=%s to db",
                       os.path.basename(filename), md5sum)
         if self.write_immediate:
@@ -68,70 +397,204 @@ class JsonDB(object):
         return True
 
     def remove(self, md5sum=None):
-        remove = []
-        remove_paths = []
-        if md5sum:
-            if md5sum in self.db:
-                d = self.db[md5sum]
-                what = self.name(d['show'], d['season'], d['episode'])
-                self.log.info("db: removing md5=%s show=%s", md5sum, what)
-                remove.append(md5sum)
-                remove_paths.append(self.db[md5sum]['filename'])
-        for e in remove:
-            self.db.pop(e)
-            self.dirty = True
-        for e in remove_paths:
-            self.path_index.pop(e)
+        if md5sum and md5sum in self.db:
+            d = self.db.pop(md5sum)
+            self.log.info("db: removing md5=%s filename=%s", md5sum,
+                          os.path.basename(d['filename']))
+            if self.path_index.get(d['filename']) == md5sum:
+                self.path_index.pop(d['filename'])
+            self.search_index.remove(md5sum)
+            self._changed(md5sum, None)
 
         if self.write_immediate:
             self.save()
         return
 
+    def get(self, md5sum):
+        return self.db.get(md5sum)
+
     def get_path(self, path):
         if path in self.path_index:
             md5 = self.path_index[path]
             return self.db[md5]
         return None
 
+    def update(self, md5sum, struct):
+        """ Store changes made to an existing entry """
+        struct = self._record(struct)
+        self.db[md5sum] = struct
+        self.search_index.add(md5sum, struct)
+        self._changed(md5sum, struct)
+        if self.write_immediate:
+            self.save()
+        return
+
+    def get_inode(self, dev, inode):
+        """ Entries last seen at this device and inode """
+        return [self.db[md5] for md5 in self.search_index.inode(dev, inode)]
+
+    def get_fingerprint(self, fingerprint):
+        """ Entries whose content probably matches fingerprint """
+        return [self.db[md5] for md5 in self.search_index.fingerprint(fingerprint)]
+
+    def move(self, md5sum, struct, oldpath):
+        """ Store an entry whose filename changed from oldpath """
+        if self.path_index.get(oldpath) == md5sum:
+            del self.path_index[oldpath]
+        self.path_index[struct['filename']] = md5sum
+        self.update(md5sum, struct)
+        return
+
+    def entries(self):
+        """ Iterate over (md5sum, entry) for the whole database """
+        return iter(list(self.db.items()))
+
+    def candidates(self, text=None, show=None, season=None, episode=None,
+                   year=None, resolution=None, ranges=None, order=None,
+                   top=None):
+        """ Entries that may match a search, callers still filter them.
+            text is a lowercase substring of the title (or show), show a
+            helpers.normalize_name() key, ranges maps media.RAW_FIELDS to
+            (low, high) bounds.  Returns an iterator, largest order field
+            first if order is one of media.RAW_FIELDS.  With top only the
+            first top are sure to be in order, see SearchIndex.ordered().
+        """
+        md5s = self.search_index.search(text, show, season, episode, year,
+                                        resolution, ranges)
+        if order:
+            return (self.db[md5] for md5 in self.search_index.ordered(order, md5s, top))
+        if md5s is None:
+            return iter(list(self.db.values()))
+        return (self.db[md5] for md5 in md5s)
+
+    def count(self):
+        return len(self.db)
+
+    def _compact_due(self):
+        """ True once the journal is big enough to fold into the snapshot,
+            or the snapshot is to be written in another format
+        """
+        if not os.path.isfile(self.filename) or self.journal_torn:
+            return True
+        if self.snapshot_format != self.loaded_format:
+            return True
+        try:
+            journal = os.path.getsize(self.journalfile)
+        except OSError:
+            return False
+        if journal > self.journal_max:
+            return True
+        return (journal > self.journal_min and
+                journal > self.journal_ratio * os.path.getsize(self.filename))
+
     def save(self, filename=None):
-        if len(self.db) < 1:
-            self.log.warning("db: save called on empty database, skipping")
-            return
         if not self.open:
             return
         filename = filename or self.filename
-        lockfile = filename + ".lock"
-        if os.path.isfile(lockfile):
-            if (time.time() - os.path.getmtime(lockfile)) > 200:
-                self.log.warning("db: lockfile=%s is stale, removing!", lockfile)
-                os.unlink(lockfile)
-            else:
-                sys.stdout.write("db: locked, waiting..")
-                while True:
-                    sys.stdout.write(".")
-                    for t in range(1, 100):
-                        time.sleep(.1)
-                    if not os.path.isfile(lockfile):
-                        break
-
-        self.log.info("db: saving filename=%s with (%d) entries",
-                      filename, len(self.db))
-        tmpfile = "%s.tmp" % filename
         try:
-            open(lockfile, 'w').write("locked")
-            with open(tmpfile, 'w') as fh:
-                json.dump(self.db, fh, default=self._datetimehandler)
-            os.rename(tmpfile, filename)
+            with self._filelock(filename).exclusive(), STATS.phase("save"):
+                if filename == self.filename:
+                    self._finish_compaction()
+                    self._merge()
+                if self.journal and filename == self.filename and not self._compact_due():
+                    self._append_journal()
+                else:
+                    self._write_snapshot(filename)
+        except (LockTimeout, OSError) as e:
+            self.log.error("db: not saved, will retry on the next save: %s", e)
+        return
+
+    def _append_journal(self):
+        """ Append pending changes as json lines, fsync'd before returning """
+        if not self.pending:
+            return
+        for md5sum, details in self.backfilled.items():
+            # Unless another process changed it since
+            if md5sum not in self.pending and self.db.get(md5sum) is details:
+                self.pending[md5sum] = details
+        self.backfilled = {}
+        self.log.info("db: journaling (%d) changes to filename=%s",
+                      len(self.pending), self.journalfile)
+        try:
+            with open(self.journalfile, 'a') as fh:
+                for md5sum, struct in self.pending.items():
+                    if struct is None:
+                        record = {"del": md5sum}
+                    else:
+                        record = {"put": md5sum, "entry": struct}
+                    fh.write(json.dumps(record, default=self._datetimehandler) + "\n")
+                fh.flush()
+                os.fsync(fh.fileno())
+                self.journal_offset = os.fstat(fh.fileno()).st_size
+            self.journal_id = self._journal_id()
+            self.pending.clear()
             self.dirty = False
+        except Exception as e:
+            self.log.error("unable to write journal=%s: %s", self.journalfile, e)
+        return
+
+    def _dump(self, fh):
+        """ Write the database to fh in snapshot_format, a text file for
+            json and a binary one otherwise
+        """
+        if self.snapshot_format == "json":
+            json.dump(self.db, fh, default=self._datetimehandler)
+            return
+        db = self.db
+        if self.compact_records and self.snapshot_format == "marshal":
+            db = dict((md5, records.plain(details)) for md5, details in db.items())
+        payload = {"version": SNAPSHOT_VERSION, "db": db,
+                   "path_index": self.path_index}
+        fh.write(SNAPSHOT_MAGIC + self.snapshot_format.encode("ascii") + b"\n")
+        fh.write(SNAPSHOT_FORMATS[self.snapshot_format][0](payload))
+        return
+
+    def _write_snapshot(self, filename):
+        """ Rewrite the whole database to filename with tmp+rename, then
+            drop the journal it now contains.  The journal is moved aside
+            before the rename, so a crash never leaves it next to a snapshot
+            that already holds it.  Until the rename, the complete tmp file
+            and the moved journal tell load() and _finish_compaction() the
+            old snapshot is still in place.
+        """
+        if len(self.db) < 1:
+            self.log.warning("db: save called on empty database, skipping")
+            return
+        self.log.info("db: saving filename=%s with (%d) entries as %s",
+                      filename, len(self.db), self.snapshot_format)
+        tmpfile = "%s.tmp" % filename
+        try:
+            with open(tmpfile, 'w' if self.snapshot_format == "json" else 'wb') as fh:
+                self._dump(fh)
+                fh.flush()
+                os.fsync(fh.fileno())
+            compacting = filename == self.filename and os.path.isfile(self.journalfile)
+            if compacting:
+                os.rename(self.journalfile, self.oldjournalfile)
+            try:
+                os.rename(tmpfile, filename)
+            except Exception:
+                if compacting:
+                    os.rename(self.oldjournalfile, self.journalfile)
+                raise
+            if filename == self.filename:
+                if compacting:
+                    os.unlink(self.oldjournalfile)
+                self.disk = self._snapshot_id()
+                self.journal_id, self.journal_offset = None, 0
+                self.journal_torn = False
+                self.backfilled = {}
+                self.loaded_format = self.snapshot_format
+                self.pending.clear()
+                self.dirty = False
         except Exception as e:
             self.log.error("unable to write db=%s: %s", filename, e)
             if os.path.isfile(tmpfile):
                 os.unlink(tmpfile)
-        os.unlink(lockfile)
         return
 
     def clean_invalid(self):
-        for e, d in self.db.iteritems():
+        for e, d in list(self.db.items()):
             if not d.get('valid', True):
                 self.remove(md5sum=e)
         return
@@ -139,7 +602,7 @@ class JsonDB(object):
     def close(self, save=False):
         if save:
             self.save()
-        if self.dirty:
+        if self.dirty or (self.db and self.snapshot_format != self.loaded_format):
             self.save()
         self.clear()
         self.open = False
@@ -0,0 +1,473 @@
+#!/usr/bin/env python
+import os
+import collections
+import concurrent.futures
+import helpers
+import walker
+import watcher
+import media
+from media import MediaFile
+from probe import ProbePool
+import hashing
+from hashing import HashPool
+from stats import STATS
+
+
+class MediaLibrary(object):
+    """ Directory scanning shared by MovieDB and TVDB.  Mixed in ahead of
+        the database class, subclasses only provide parse() to turn a path
+        into the descriptive fields of a database entry.
+    """
+
+    metacache = None  # MetaCache of probe results shared between paths
+
+    extensions = ['mkv', 'avi', 'mp4', 'mpeg', 'mpg', 'ts', 'flv', 'iso', 'm4v', 'divx', 'wmv']
+    ext_skip = ['md5', 'idx', 'sub', 'srt', 'smi', 'nfo', 'nfo-orig', 'sfv', 'txt', 'json', 'jpeg', 'jpg', 'bak']
+
+    # --sort choices, each the media.RAW_FIELDS field it sorts on
+    sort_fields = {'size': 'size_bytes', 'bitrate': 'bit_rate_bps',
+                   'duration': 'duration_ms'}
+
+    def parse(self, video_subdir, filename, fullpath):
+        """ Return a dict of entry fields for this path, or None to skip """
+        raise NotImplementedError
+
+    def ranges(self, min_size=None, max_size=None, min_bitrate=None,
+               min_duration=None):
+        """ The ranges argument of candidates() for the --min-size,
+            --max-size (bytes), --min-bitrate (bits/s) and --min-duration
+            (ms) search options, None if there are none
+        """
+        ranges = {}
+        if min_size is not None or max_size is not None:
+            ranges['size_bytes'] = (min_size, max_size)
+        if min_bitrate is not None:
+            ranges['bit_rate_bps'] = (min_bitrate, None)
+        if min_duration is not None:
+            ranges['duration_ms'] = (min_duration, None)
+        return ranges or None
+
+    def scan(self, startdir, extensions=None, ext_skip=None, check=False,
+             limit=0, jobs=1, readers=1, block_size=None, use_mmap=False,
+             walk_threads=1, digests=('md5',), probe_jobs=1, probe_timeout=300,
+             probe_retries=2, probe_tier='fast'):
+        """ Scan startdir for files that end in extensions,
+            if check is set, check the md5 file against the actual md5
+            checksum, and report.  Hashing is spread over jobs processes,
+            with at most readers of them reading from any one device, and
+            directories are listed by walk_threads threads.  New files get
+            every one of digests computed from a single read, and are probed
+            at probe_tier by probe_jobs MediaInfo processes.
+        """
+        extensions = extensions or self.extensions
+        ext_skip = ext_skip or self.ext_skip
+        abspath = os.path.abspath(startdir)
+        files = STATS.iterate("walk", walker.walk(abspath, extensions, ext_skip, walk_threads,
+                                                  on_skip=self._skipped(extensions)))
+        self.process(files, check, limit, jobs, readers, block_size, use_mmap,
+                     digests, probe_jobs, probe_timeout, probe_retries, probe_tier)
+
+        # remove files that have been deleted
+        self.clean_invalid()
+        return
+
+    def process(self, files, check=False, limit=0, jobs=1, readers=1,
+                block_size=None, use_mmap=False, digests=('md5',),
+                probe_jobs=1, probe_timeout=300, probe_retries=2,
+                probe_tier='fast'):
+        """ Hash, probe and add walker FileEntries that aren't in the
+            database yet, returns the number added.  MediaInfo probes, at
+            probe_tier, run in a ProbePool alongside the hashing; entries
+            are added as their probe finishes, and ones whose probe failed
+            are probed again on the next scan.
+        """
+        counts = collections.Counter()
+        tasks = self._hash_tasks(files, check, counts, digests)
+        pool = HashPool(jobs, readers, block_size, use_mmap, digests=digests)
+        probes = ProbePool(probe_jobs, probe_timeout, probe_retries, log=self.log)
+        probing = set()  # md5sums waiting on a probe before they're added
+        found = 0
+        try:
+            for (mfile, fields, fe, fingerprint, known), result in pool.run(tasks):
+                for probed in probes.results():
+                    self._probed(probing, counts, *probed)
+                if not self._hashed(mfile, result, check):
+                    continue
+                if fingerprint is None and result:
+                    fingerprint = result['fingerprint']
+
+                stat = fe.stat_info()
+                entry = self.get(mfile.md5)
+                if known and not entry and mfile.md5 not in probing:
+                    self.log.warning("scan: fingerprint collision, filename=%s md5sum=%s "
+                                     "is new content after all", mfile.filename, mfile.md5)
+                if entry:
+                    entry['valid'] = True
+                    if entry['filename'] != mfile.path:
+                        if not os.path.lexists(entry['filename']):
+                            # Moved, maybe across devices, and found by md5
+                            entry['digests'] = mfile.digests
+                            entry['fingerprint'] = fingerprint
+                            self._move(mfile.md5, entry, fe, fields)
+                            counts['moved'] += 1
+                        else:
+                            self._copied(mfile.md5, entry, fe)
+                        continue
+                    if (entry.get('stat') != stat or entry.get('digests') != mfile.digests or
+                            entry.get('fingerprint') != fingerprint):
+                        entry['stat'] = stat  # Skip it on the next scan
+                        entry['digests'] = mfile.digests
+                        entry['fingerprint'] = fingerprint
+                        self.update(mfile.md5, entry)
+                    if self._probe_failed(entry) and mfile.md5 not in probing:
+                        self._probe(probes, probing, counts, mfile.md5, mfile.path, probe_tier)
+                    continue
+                if mfile.md5 in probing:
+                    continue  # A copy of a file we're still probing
+
+                data = dict(fields)
+                data.update({"filename": mfile.path, "filetype": fe.extension,
+                             "filesize": helpers.bytes_to_human(fe.size),
+                             "size_bytes": fe.size,
+                             "md5sum": mfile.md5, "digests": mfile.digests,
+                             "fingerprint": fingerprint, "valid": True,
+                             "stat": stat})
+                self._probe(probes, probing, counts, data, mfile.path, probe_tier)
+                found += 1
+
+                if limit > 0 and found >= limit:
+                    self.log.info("SCAN LIMIT=%d SET, Stopping..", limit)
+                    break
+            hashed = pool.summary()
+            for probed in probes.results(block=True):
+                self._probed(probing, counts, *probed)
+        finally:
+            pool.close()
+            probes.close()
+        STATS.counts.update(counts)
+        self.log.info("scan: %s", hashed)
+        self.log.info("scan: %s, cached=%d", probes.summary(), counts['cached'])
+        self.log.info("scan: skipped=%d unchanged files, moved=%d renamed files, "
+                      "reprocessed=%d new or modified files, "
+                      "fingerprinted=%d matching known content, added=%d",
+                      counts['skipped'], counts['moved'], counts['reprocessed'],
+                      counts['fingerprinted'], counts['added'])
+        return counts['added']
+
+    def reprobe_outdated(self, probe_jobs=1, probe_timeout=300, probe_retries=2):
+        """ Probe every entry whose metadata came from an older
+            media.MEDIAINFO_SCHEMA again, at the tier it was probed with.
+            Returns the number of entries brought up to date.
+        """
+        return self._reprobe("reprobe", self._outdated, None,
+                             probe_jobs, probe_timeout, probe_retries)
+
+    def deep_probe(self, probe_jobs=1, probe_timeout=300, probe_retries=2):
+        """ Probe every entry that only has fast tier metadata again with
+            the deep tier.  Returns the number of entries brought up to date.
+        """
+        return self._reprobe("deep-probe", lambda e: self._tier(e) != 'deep', 'deep',
+                             probe_jobs, probe_timeout, probe_retries)
+
+    def _reprobe(self, label, wanted, tier, probe_jobs, probe_timeout, probe_retries):
+        """ Probe entries for which wanted(entry) is true again, probe_jobs
+            at a time.  Results are cached as they arrive and the database
+            is saved every save_interval, so an interrupted run carries on
+            where it left off.
+        """
+        todo = [(md5sum, entry['filename'], tier or self._tier(entry))
+                for md5sum, entry in self.entries() if wanted(entry)]
+        self.log.info("%s: (%d) entries to probe, schema=%d", label, len(todo),
+                      media.MEDIAINFO_SCHEMA)
+        counts = collections.Counter()
+        probes = ProbePool(probe_jobs, probe_timeout, probe_retries, log=self.log)
+        probing = set()
+        try:
+            for md5sum, path, entry_tier in todo:
+                if os.path.isfile(path):
+                    self._probe(probes, probing, counts, md5sum, path, entry_tier)
+                else:
+                    self.log.warning("%s: filename=%s is missing, skipping", label, path)
+                for probed in probes.results():
+                    self._probed(probing, counts, *probed)
+            for probed in probes.results(block=True):
+                self._probed(probing, counts, *probed)
+        finally:
+            probes.close()
+        self.save()
+        self.log.info("%s: %s, cached=%d", label, probes.summary(), counts['cached'])
+        return counts['updated']
+
+    def _outdated(self, entry):
+        return entry.get('probe', {}).get('schema', 0) < media.MEDIAINFO_SCHEMA
+
+    def _tier(self, entry):
+        """ Probe tier entry's metadata came from, entries from before
+            tiers were probed the deep way
+        """
+        return entry.get('probe', {}).get('tier', 'deep')
+
+    def _probe(self, probes, probing, counts, context, path, tier):
+        """ Queue a probe of path for context (see _probed), unless the
+            MetaCache already has the answer
+        """
+        md5sum = context['md5sum'] if isinstance(context, dict) else context
+        probing.add(md5sum)
+        cached = None
+        if self.metacache is not None:
+            cached = self.metacache.get(md5sum, media.MEDIAINFO_SCHEMA, tier)
+        if cached is None:
+            probes.submit(context, path, tier)
+            return
+        counts['cached'] += 1
+        self._probed(probing, counts, context, cached['mkvinfo'], cached['probe'])
+        return
+
+    def _probed(self, probing, counts, context, info, status):
+        """ Store a ProbePool result.  context is the new entry to add, or
+            the md5sum of an existing entry that was probed again.
+        """
+        if isinstance(context, dict):
+            data, md5sum = context, context['md5sum']
+        else:
+            data, md5sum = self.get(context), context
+        probing.discard(md5sum)
+        if data is None:
+            return
+        if info is None and data is not context and not self._probe_failed(data):
+            return  # Keep the metadata it has over a failed deeper probe
+        data['mkvinfo'] = info if info is not None else media.blank_info()
+        data['probe'] = dict(status, schema=media.MEDIAINFO_SCHEMA)
+        data.update(media.raw_fields(data))
+        if (self.metacache is not None and status['status'] == 'ok' and
+                not self.metacache.get(md5sum, media.MEDIAINFO_SCHEMA, status['tier'])):
+            self.metacache.put(md5sum, media.MEDIAINFO_SCHEMA, data['mkvinfo'], data['probe'])
+        if data is context:
+            self.add(data, data['filename'], md5sum)
+            counts['added'] += 1
+        else:
+            self.update(md5sum, data)
+            counts['updated'] += 1
+        if (counts['added'] + counts['updated']) % self.save_interval == 0:
+            self.log.debug("Intermediate DB Save, found=%d interval=%d",
+                           counts['added'] + counts['updated'], self.save_interval)
+            self.save()
+        return
+
+    def _probe_failed(self, entry):
+        """ True if the last probe of entry failed or timed out """
+        return entry.get('probe', {}).get('status', 'ok') != 'ok'
+
+    def watch(self, startdir, extensions=None, ext_skip=None, settle=5,
+              poll=0, deep=False, **options):
+        """ Keep running, handing files that appear under startdir to
+            process() once they've finished copying, and saving after each
+            batch.  With deep, new entries are then given a deep probe.
+            options are passed on to process().  Stops on KeyboardInterrupt.
+        """
+        extensions = extensions or self.extensions
+        ext_skip = ext_skip or self.ext_skip
+        probe_options = dict((k, v) for k, v in options.items()
+                             if k in ('probe_jobs', 'probe_timeout', 'probe_retries'))
+
+        def settled(files):
+            if self.process(files, **options):
+                self.save()
+                if deep:
+                    self.deep_probe(**probe_options)
+
+        self.save()  # Whatever came before, in case we're killed
+        watch = watcher.Watcher(startdir, settled, extensions, ext_skip,
+                                settle, poll, self.log)
+        watch.run()
+        return
+
+    def verify(self, results, threads=16):
+        """ Drop results whose file has gone away, removing them from the
+            database with a single save, and warn about results whose
+            sidecar md5 no longer matches.  The stats and sidecar reads are
+            done from a thread pool so slow network mounts overlap.
+        """
+        def check(r):
+            if not os.path.isfile(r['filename']):
+                return r, False, None
+            return r, True, MediaFile(r['filename']).md5
+
+        with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+            checked = list(pool.map(check, results))
+
+        final_results = []
+        removed = 0
+        write_immediate, self.write_immediate = self.write_immediate, False
+        try:
+            for r, exists, md5 in checked:
+                if not exists:
+                    # Deleted video file
+                    self.remove(md5sum=r['md5sum'])
+                    removed += 1
+                    continue
+                if md5 != r["md5sum"]:
+                    self.log.warning("%s has a bad checksum!", r['filename'])
+                final_results.append(r)
+        finally:
+            self.write_immediate = write_immediate
+        if removed:
+            self.save()
+        return final_results
+
+    def _skipped(self, extensions):
+        def skipped(path):
+            self.log.warning("filename=%s is not in extensions list=%s, skipping",
+                             path, extensions)
+        return skipped
+
+    def _hash_tasks(self, files, check, counts, digests=('md5',)):
+        """ Turn walker FileEntries into (context, path, device, digests)
+            for the pool, path being None when the file needs no hashing.
+            Files whose stat matches their entry are known already and
+            skipped without reading the sidecar, unless we were asked to
+            check them.  Checks only compute the cheapest digest the sidecar
+            has, plus any of digests it's missing.  Files renamed within a
+            filesystem keep their device, inode, size and mtime, so they're
+            moved to their new path straight away.
+
+            Files with no sidecar whose fingerprint matches an entry are
+            probably known content (a copy, or a rename that lost its
+            sidecar); their full hash is put off until everything else has
+            been queued, and only that hash decides what they are.  Other
+            files are fingerprinted by the hash workers.  Copies already
+            confirmed are skipped on their stat, like the entry's own file.
+        """
+        deferred = []
+        for fe in files:
+            entry = self.get_path(fe.path)
+            if (entry and not check and entry.get('stat') == fe.stat_info() and
+                    not self._probe_failed(entry)):
+                entry['valid'] = True
+                counts['skipped'] += 1
+                continue
+
+            fields = self.parse(fe.dirpath, fe.name, fe.path)
+            if fields is None:
+                continue
+
+            moved = None if check else self._renamed(fe)
+            if moved:
+                self._move(moved['md5sum'], moved, fe, fields)
+                counts['moved'] += 1
+                if not self._probe_failed(moved):
+                    continue
+
+            mfile = MediaFile(fe.path)
+            if mfile.md5:
+                if not check and self._copy_of([self.get(mfile.md5)], fe):
+                    counts['skipped'] += 1
+                    continue
+                # The worker fingerprints it, on its own or with the check
+                counts['reprocessed'] += 1
+                context = (mfile, fields, fe, None, None)
+                names = mfile.check_digests(digests) if check else ()
+                yield context, fe.path, fe.dev, names, True
+                continue
+
+            fingerprint = self._fingerprint(fe)
+            known = self.get_fingerprint(fingerprint) if fingerprint else []
+            if not check and self._copy_of(known, fe):
+                counts['skipped'] += 1
+                continue
+            counts['reprocessed'] += 1
+            context = (mfile, fields, fe, fingerprint, known)
+            if not known:
+                yield context, fe.path, fe.dev, digests
+                continue
+            self.log.info("scan: filename=%s looks like known filename=%s, "
+                          "confirming with a full hash", fe.name, known[0]['filename'])
+            counts['fingerprinted'] += 1
+            deferred.append((context, fe.path, fe.dev, digests))
+        for task in deferred:
+            yield task
+
+    def _renamed(self, fe):
+        """ The entry fe was renamed from, if any: same device, inode,
+            size and mtime, and nothing left at its old path
+        """
+        stat = fe.stat_info()
+        for entry in self.get_inode(fe.dev, fe.inode):
+            if (entry['filename'] != fe.path and entry.get('stat') == stat and
+                    not os.path.lexists(entry['filename'])):
+                return entry
+        return None
+
+    def _copy_of(self, entries, fe):
+        """ The entry of entries fe was recorded as a copy of, if its stat
+            still matches and the entry's own file is still there
+        """
+        stat = fe.stat_info()
+        for entry in entries:
+            if (entry and (entry.get('copies') or {}).get(fe.path) == stat and
+                    os.path.lexists(entry['filename']) and not self._probe_failed(entry)):
+                entry['valid'] = True
+                return entry
+        return None
+
+    def _copied(self, md5sum, entry, fe):
+        """ Record fe as a copy of entry's content, dropping copies that
+            have gone, so the next scan can skip it on its stat
+        """
+        copies = dict((path, stat) for path, stat in (entry.get('copies') or {}).items()
+                      if path != fe.path and os.path.lexists(path))
+        copies[fe.path] = fe.stat_info()
+        if copies != entry.get('copies'):
+            self.log.info("scan: filename=%s is a copy of filename=%s",
+                          fe.path, entry['filename'])
+            entry['copies'] = copies
+            self.update(md5sum, entry)
+        return
+
+    def _move(self, md5sum, entry, fe, fields):
+        """ Point entry at fe's path, without rehashing or probing """
+        oldpath = entry['filename']
+        replaced = self.get_path(fe.path)
+        if replaced and replaced.get('md5sum') != md5sum:
+            # Whatever used to be at the new path was overwritten
+            self.remove(md5sum=replaced['md5sum'])
+        entry.update(fields)
+        entry.update({"filename": fe.path, "filetype": fe.extension,
+                      "stat": fe.stat_info(), "valid": True})
+        self.move(md5sum, entry, oldpath)
+        self.log.info("scan: moved md5sum=%s from %s to %s", md5sum, oldpath, fe.path)
+        return
+
+    def _fingerprint(self, fe):
+        try:
+            with STATS.phase("fingerprint"):
+                return hashing.fingerprint(fe.path, fe.size)
+        except OSError as e:
+            self.log.error("Unable to fingerprint (%s): %s", fe.path, e)
+        return None
+
+    def _hashed(self, mfile, result, check):
+        """ Apply a pool result to mfile, returns False if it has no hash """
+        if result and result['error']:
+            self.log.error("Unable to compute checksum of (%s): %s",
+                           mfile.path, result['error'])
+            return False
+        if result and result['digests']:
+            self.log.debug("Hashed (%s) size=%s in %.1fs rate=%s", mfile.filename,
+                           helpers.bytes_to_human(result['bytes']),
+                           result['seconds'], hashing.rate(result))
+        if mfile.md5:
+            self.log.debug('Found Hashfile: filename=%s MD5Hash=%s',
+                           mfile.filename, mfile.md5)
+            if check:
+                if mfile.check_checksum(result['digests']):
+                    self.log.info('GOOD: %s [ %s %s / %s ]', mfile.filename, mfile.checked,
+                                  mfile.digests[mfile.checked], mfile.computed[mfile.checked])
+                elif mfile.checked:
+                    self.log.error("BAD: Hash mismatch for file=%s digest=%s "
+                                   "stored_hash=%s computed_hash=%s!",
+                                   mfile.filename, mfile.checked,
+                                   mfile.digests[mfile.checked], mfile.computed[mfile.checked])
+        else:
+            mfile.generate_checksum(digests=result['digests'])
+        return bool(mfile.md5)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+import os
+import fcntl
+import logging
+import threading
+import contextlib
+
+
+class LockTimeout(Exception):
+    pass
+
+
+class FileLock(object):
+    """ fcntl.flock() on filename, shared for readers and exclusive for
+        writers.  The kernel drops the lock when its holder exits, however
+        that happens, so a lock is never stale and the file is never
+        removed.  Waits block in flock() rather than polling; a timeout is
+        enforced by waiting in a helper thread, which gives up the lock
+        itself if it gets it after we stopped waiting.
+    """
+
+    def __init__(self, filename, timeout=None):
+        self.log = logging.getLogger()
+        self.filename = filename
+        self.timeout = timeout  # Seconds, None to wait for as long as it takes
+
+    def shared(self):
+        return self._locked(fcntl.LOCK_SH)
+
+    def exclusive(self):
+        return self._locked(fcntl.LOCK_EX)
+
+    @contextlib.contextmanager
+    def _locked(self, operation):
+        fd = self._acquire(operation)
+        try:
+            yield
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+    def _open(self, operation):
+        try:
+            return os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError:
+            pass
+        try:
+            return os.open(self.filename, os.O_RDONLY)
+        except OSError as e:
+            if operation == fcntl.LOCK_EX:
+                raise
+            # Read-only, and the lock file was never made, so no one
+            # can be writing here
+            self.log.debug("lock: reading without lock=%s: %s", self.filename, e)
+            return None
+
+    def _acquire(self, operation):
+        """ An fd of filename locked with operation, closing it unlocks """
+        fd = self._open(operation)
+        if fd is None:
+            return None
+        try:
+            fcntl.flock(fd, operation | fcntl.LOCK_NB)
+            return fd
+        except BlockingIOError:
+            pass
+        except Exception:
+            os.close(fd)
+            raise
+        kind = "shared" if operation == fcntl.LOCK_SH else "exclusive"
+        self.log.info("lock: waiting %s for %s lock=%s",
+                      "%ds" % self.timeout if self.timeout is not None else "indefinitely",
+                      kind, self.filename)
+        if self.timeout is None:
+            try:
+                fcntl.flock(fd, operation)
+            except Exception:
+                os.close(fd)
+                raise
+            return fd
+
+        done = threading.Event()
+        guard = threading.Lock()
+        state = {"abandoned": False, "error": None}
+
+        def wait():
+            try:
+                fcntl.flock(fd, operation)
+            except Exception as e:
+                state["error"] = e
+            with guard:
+                if state["abandoned"] or state["error"]:
+                    os.close(fd)
+                if not state["abandoned"]:
+                    done.set()
+
+        threading.Thread(target=wait, name="lock-wait", daemon=True).start()
+        done.wait(self.timeout)
+        with guard:
+            if done.is_set():
+                if state["error"]:
+                    raise state["error"]
+                return fd
+            state["abandoned"] = True  # wait() closes fd when flock() returns
+        raise LockTimeout("no %s lock on %s after %ds" % (kind, self.filename, self.timeout))
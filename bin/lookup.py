@@ -1,163 +1,173 @@
 #!/usr/bin/env python
 
-import os
 import sys
 import optparse
+import itertools
 import logging
 import helpers
-from jsondb import JsonDB
-from media import MediaFile
-from tables import Printer as TP
+import hashing
+from jsondb import JsonDB, SNAPSHOT_FORMATS
+from filedb import FileDB
+from library import MediaLibrary
+from metacache import MetaCache
+from tables import Printer as TP, RecordWriter
+from stats import STATS
 
 
-class MovieDB(JsonDB):
+class MovieLibrary(MediaLibrary):
+    """ Movie handling, independent of the database backend """
 
     def remove(self, title=None, year=None, md5sum=None):
         remove = []
-        remove_paths = []
         if md5sum:
-            if md5sum in self.db:
+            m = self.get(md5sum)
+            if m:
                 self.log.warning("moviedb: removing md5=%s title=%s year=%s",
-                                 md5sum, self.db[md5sum]['title'],
-                                 self.db[md5sum]['year'])
+                                 md5sum, m['title'], m['year'])
                 remove.append(md5sum)
-                remove_paths.append(self.db[md5sum]['filename'])
         if title and year:
-            for md5sum, m in self.db.iteritems():
+            for md5sum, m in self.entries():
                 if m['title'].lower() == title.lower() and m['year'] == year:
                     self.log.info("moviedb: removing md5=%s title=%s year=%s",
                                   md5sum, title, year)
                     remove.append(md5sum)
-                    remove_paths.append(self.db[md5sum]['filename'])
         for e in remove:
-            self.db.pop(e)
-            self.dirty = True
-        for e in remove_paths:
-            self.path_index.pop(e)
-
-        if self.write_immediate:
-            self.save()
+            super(MovieLibrary, self).remove(md5sum=e)
         return
 
-    def search(self, string="", resolution=None, year=None):
-        results = []
-        for md5sum, details in self.db.iteritems():
-            append = True
+    def search(self, string="", resolution=None, year=None, verify=False,
+               ranges=None, order=None, top=None):
+        results = list(self.matches(string, resolution, year, ranges, order, top))
+        if verify:
+            return self.verify(results)
+        return results
+
+    def matches(self, string="", resolution=None, year=None, ranges=None,
+                order=None, top=None):
+        """ Yield entries matching a search as they're found, largest
+            order (one of media.RAW_FIELDS) first if it's given.  With top
+            the database only puts its top largest first, in order.
+        """
+        for details in self.candidates(text=string, year=year,
+                                       resolution=resolution, ranges=ranges,
+                                       order=order, top=top):
             if string != "" and string.lower() not in details['title'].lower():
-                append = False
+                continue
             if resolution:
                 mkvinfo = details.get("mkvinfo", {})
                 videos = mkvinfo.get("video")
                 if len(videos) > 0:
                     res = videos[0].get("resname", "")
                     if res != resolution:
-                        append = False
+                        continue
             if year and details.get("year", 0) != year:
-                append = False
-            if append:
-                results.append(details)
-        final_results = []
-        for r in results:
-            if not os.path.isfile(r['filename']):
-                # Deleted movie file
-                self.remove(md5sum=r['md5sum'])
                 continue
-            mfile = MediaFile(r["filename"])
-            if mfile.md5 != r["md5sum"]:
-                self.log.warning("%s has a bad checksum!", r['filename'])
-            final_results.append(r)
-        return final_results
-
-    def scan(self, startdir,
-             extensions=['mkv', 'avi', 'mp4', 'mpeg', 'mpg', 'ts', 'flv', 'iso', 'm4v', 'divx', 'wmv'],
-             ext_skip=['md5', 'idx', 'sub', 'srt', 'smi', 'nfo', 'nfo-orig', 'sfv', 'txt', 'json', 'jpeg', 'jpg', 'bak'],
-             check=False, limit=0):
-        """ Scan startdir for files that end in extensions,
-            if check is set, check the md5 file against the actual md5
-            checksum, and report
-        """
-        abspath = os.path.abspath(startdir)
-        found = 0
-        for video_subdir, dirs, files in os.walk(abspath):
-            if limit > 0 and found >= limit:
-                break
-
-            for filename in files:
-                if limit > 0 and found >= limit:
-                    self.log.info("SCAN LIMIT=%d SET, Stopping..", limit)
-                    break
-
-                fullpath = "%s/%s" % (video_subdir, filename)
-                extension = filename.split('.')[-1].lower()
-                filesize = os.path.getsize(fullpath)
-
-                if extension in ext_skip:
-                    continue
-
-                if extension not in extensions:
-                    self.log.warning("filename=%s is not in extensions list=%s, skipping",
-                                     fullpath, extensions)
-                    continue
-
-                video_year = 'n/a'
-                video_name = filename
-                video_genre = 'n/a'
-                try:
-                    video_dir = video_subdir.split('/')[-1]
-                    video_genre = video_subdir.split('/')[-2]
-                    video_dir_parts = video_dir.split(".")
-                    video_year = video_dir_parts[-1]
-                    video_name = ".".join(video_dir_parts[0:-1])
-                except Exception as e:
-                    self.log.error("Error parsing video path=%s: %s", fullpath, e)
-
-                mfile = MediaFile(fullpath)
-                if mfile.md5:
-                    self.log.debug('Found Hashfile: filename=%s MD5Hash=%s',
-                                   filename, mfile.md5)
-                    if check:
-                        if mfile.check_checksum():
-                            self.log.info('GOOD: %s [ %s / %s ]', filename,
-                                          mfile.md5file, mfile.md5computed)
-                        else:
-                            self.log.error("BAD: Hash mismatch for file=%s "
-                                           "stored_hash=%s computed_hash=%s!",
-                                           filename, mfile.md5file, mfile.md5computed)
-                else:
-                    mfile.generate_checksum()
-
-                if mfile.md5 in self.db:
-                    self.db[mfile.md5]['valid'] = True
-                    continue
-
-                data = {"title": video_name, "year": video_year,
-                        "genre": video_genre,
-                        "filename": fullpath, "filetype": extension,
-                        "filesize": helpers.bytes_to_human(filesize),
-                        "mkvinfo": mfile.mediainfo(),
-                        "md5sum": mfile.md5, "valid": True}
-
-                found += 1
-                self.add(data, fullpath, mfile.md5)
-
-                if found % self.save_interval == 0:
-                    self.log.debug("Intermediate DB Save, found=%d interval=%d",
-                                   found, self.save_interval)
-                    self.save()
-
-        # remove files that have been deleted
-        self.clean_invalid()
+            yield details
         return
 
+    def parse(self, video_subdir, filename, fullpath):
+        """ Movies live in <genre>/<title>.<year>/ directories """
+        video_year = 'n/a'
+        video_name = filename
+        video_genre = 'n/a'
+        try:
+            video_dir = video_subdir.split('/')[-1]
+            video_genre = video_subdir.split('/')[-2]
+            video_dir_parts = video_dir.split(".")
+            video_year = video_dir_parts[-1]
+            video_name = ".".join(video_dir_parts[0:-1])
+        except Exception as e:
+            self.log.error("Error parsing video path=%s: %s", fullpath, e)
+        return {"title": video_name, "year": video_year, "genre": video_genre}
+
+
+class MovieDB(MovieLibrary, JsonDB):
+    """ Movies stored in a json file """
+
+
+class MovieFileDB(MovieLibrary, FileDB):
+    """ Movies stored in sqlite """
+
+
+def open_db(filename, compact_records=False):
+    """ Pick the database backend from the --db filename """
+    if FileDB.handles(filename):
+        return MovieFileDB(filename=filename)
+    return MovieDB(filename=filename, compact_records=compact_records)
+
+
+# Fields of each result for --format jsonl|csv|tsv, in order
+FIELDS = ["md5sum", "genre", "title", "year", "duration", "ext", "resolution",
+          "resname", "width", "height", "codec", "bitrate", "bits", "audioc",
+          "formats", "filesize", "size_bytes", "duration_ms", "bit_rate_bps",
+          "path"]
+
+
+def result_fields(m):
+    """ What we print for a search result, as a dict.  Missing values are
+        "--" like the table shows them, or None for the raw numbers.
+    """
+    f = dict.fromkeys(["resolution", "resname", "codec", "bitrate", "bits",
+                       "audioc", "formats", "duration"], "--")
+    f.update(dict.fromkeys(["width", "height"]))
+    f["md5sum"] = m["md5sum"]
+    f["genre"] = m["genre"]
+    f["title"] = m["title"].replace(".", " ").replace("_", " ")
+    f["year"] = m["year"]
+    f["ext"] = m.get("filetype", "--").upper()
+    f["filesize"] = m.get("filesize", -1)
+    f["size_bytes"] = m.get("size_bytes")
+    f["duration_ms"] = m.get("duration_ms")
+    f["bit_rate_bps"] = m.get("bit_rate_bps")
+    f["path"] = m["filename"]
+    if m["mkvinfo"]:
+        mkvinfo = m["mkvinfo"]
+        video = mkvinfo.get("video", [])
+        audio = mkvinfo.get("audio", [])
+        if len(video) > 0:
+            f["resolution"] = video[0].get("resolution", "--")
+            f["resname"] = video[0].get("resname", "--")
+            f["width"] = video[0].get("width")
+            f["height"] = video[0].get("height")
+            f["codec"] = video[0].get("codec") or "--"
+            f["bitrate"] = video[0].get("bit_rate", "--")
+            f["bits"] = str(video[0].get("bit_depth", "--"))
+        audio_tracks = len(audio)
+        if audio_tracks > 0:
+            channels = audio[0].get("channels", "--") or "--"
+            f["audioc"] = str(channels).replace("Object Based / ", "")
+        formats = [x.get("format") for x in audio if x.get("format")]
+        f["formats"] = "/".join(formats)
+        f["duration"] = str(mkvinfo.get("duration", "--")).split(".")[0]
+    return f
+
+
+def printresults(results=[], showkey=False, showpath=False, limit=0, page=1,
+                 format="table", order=None):
+    offset = limit * max(page - 1, 0)
+    total = None
+    if order and limit:
+        # Only the rows shown get their fields built, the rest are counted.
+        # Filtering can drop some of the largest the database found, so
+        # they're picked out again here rather than trusting its order.
+        results, total = helpers.largest_entries(results, order, offset + limit)
+        results = results[offset:]
+        offset = 0
+    if format != "table":
+        # Streamed in the order the database finds them, only sorted by --sort
+        w = RecordWriter(sys.stdout, format, FIELDS)
+        stop = offset + limit if limit else None
+        for m in itertools.islice(results, offset, stop):
+            w.write(result_fields(m))
+        return
 
-def printresults(results=[], showkey=False, showpath=False):
     columns = ["Genre", "Title", "Year", "Duration", "EXT", "Resolution",
                "Bitrate", "Bits", "AudioC", "Formats", "Size"]
     if showkey:
         columns.insert(0, "md5sum")
     if showpath:
         columns.append("Path")
-    t = TP()
+    t = TP(limit=limit, offset=offset, sort=not order)
     t.set_header(columns, justification="<")
     t.justification["Duration"] = ">"
     t.justification["Bitrate"] = ">"
@@ -167,88 +177,181 @@ def printresults(results=[], showkey=False, showpath=False):
     t.justification["Bits"] = "^"
 
     for m in results:
-        title = m["title"].replace(".", " ").replace("_", " ")
-        extension = m.get("filetype", "--").upper()
-        filesize = m.get("filesize", -1)
-        resolution, resname, bitrate = "--", "--", "--"
-        channels, aformat, duration = "--", "--", "--"
-        if m["mkvinfo"]:
-            mkvinfo = m["mkvinfo"]
-            video = mkvinfo.get("video", [])
-            audio = mkvinfo.get("audio", [])
-            if len(video) > 0:
-                resolution = video[0].get("resolution", "--")
-                resname = video[0].get("resname", "--")
-                bitrate = video[0].get("bit_rate", "--")
-                bitdepth = str(video[0].get("bit_depth", "--"))
-            audio_tracks = len(audio)
-            if audio_tracks > 0:
-                channels = audio[0].get("channels", "--") or "--"
-                channels = str(channels).replace("Object Based / ", "")
-            formats = [x.get("format") for x in audio if x.get("format")]
-            aformat = "/".join(formats)
-            duration = str(mkvinfo.get("duration", "--")).split(".")[0]
-
+        f = result_fields(m)
         row = []
         if showkey:
-            row.append(m["md5sum"])
-        row.append(m["genre"])
-        row.append(title)
-        row.append(m["year"])
-        row.append(duration)
-        row.append(extension)
-        row.append("%s (%s)" % (resolution, resname))
-        row.append(bitrate)
-        row.append(bitdepth)
-        row.append(channels)
-        row.append(aformat)
-        row.append(filesize)
+            row.append(f["md5sum"])
+        row.append(f["genre"])
+        row.append(f["title"])
+        row.append(f["year"])
+        row.append(f["duration"])
+        row.append(f["ext"])
+        row.append("%s (%s)" % (f["resolution"], f["resname"]))
+        row.append(f["bitrate"])
+        row.append(f["bits"])
+        row.append(f["audioc"])
+        row.append(f["formats"])
+        row.append(f["filesize"])
         if showpath:
-            row.append(m["filename"])
-        sortkey = "%s;%s;%s" % (m['title'], resname, m['md5sum'])
+            row.append(f["path"])
+        sortkey = "%s;%s;%s" % (m['title'], f["resname"], m['md5sum'])
         t.add_data(row, key=sortkey)
 
-    sys.stdout.write(t.dump(header_underline=True, padding="  |  "))
+    if total is not None:
+        t.count = total  # Every match, not just the rows shown
+    if t.count:
+        t.write(sys.stdout, header_underline=True, padding="  |  ")
     return
 
 
 def main(options):
-    db = MovieDB(filename=options.dbfile)
+    JsonDB.lock_timeout = options.lock_timeout or None
+    db = open_db(options.dbfile, options.compact_records)
     db.log = options.log
+    db.journal = not options.nojournal
+    if options.snapshot_format:
+        db.snapshot_format = options.snapshot_format
+    if options.migrate:
+        if isinstance(db, FileDB):
+            db.migrate(options.migrate)
+        else:
+            options.log.error("--migrate needs a sqlite --db, not %s", options.dbfile)
     options.log.info("Loaded %d movies from database=%s",
-                     len(db.db), options.dbfile)
+                     db.count(), options.dbfile)
 
     if options.delete:
         db.remove(md5sum=options.delete)
 
-    if options.scan:
-        db.scan(options.startdir, check=options.checkvideos, limit=options.limit)
+    if options.scan or options.reprobe or options.deep or options.watch:
+        # Only probing uses it, a search shouldn't have to read it
+        db.metacache = MetaCache(options.metacache or options.dbfile + ".meta")
 
-    if options.search or options.s_res:
-        results = db.search(options.search.lower(), resolution=options.s_res, year=options.s_year)
-        if len(results) > 0:
-            printresults(results, options.showkey, options.showpath)
+    if options.scan:
+        with STATS.phase("scan"), STATS.profiling(options.profile):
+            db.scan(options.startdir, check=options.checkvideos, limit=options.limit,
+                    jobs=options.jobs, readers=options.readers,
+                    block_size=options.block_size * 1024 * 1024, use_mmap=options.mmap,
+                    walk_threads=options.walk_threads, digests=options.digests,
+                    probe_jobs=options.probe_jobs, probe_timeout=options.probe_timeout,
+                    probe_retries=options.probe_retries, probe_tier=options.probe_tier)
+
+    if options.reprobe:
+        try:
+            db.reprobe_outdated(probe_jobs=options.probe_jobs, probe_timeout=options.probe_timeout,
+                                probe_retries=options.probe_retries)
+        except KeyboardInterrupt:
+            options.log.info("reprobe: interrupted, saving database")
+
+    if options.deep:
+        try:
+            db.deep_probe(probe_jobs=options.probe_jobs, probe_timeout=options.probe_timeout,
+                          probe_retries=options.probe_retries)
+        except KeyboardInterrupt:
+            options.log.info("deep-probe: interrupted, saving database")
+
+    ranges = db.ranges(options.min_size, options.max_size, options.min_bitrate,
+                       options.min_duration)
+    order = db.sort_fields.get(options.sort)
+    top = options.results * max(options.page, 1) if options.results else None
+    if options.search is not None or options.s_res or ranges or order:
+        text = (options.search or "").lower()
+        with STATS.phase("search"), STATS.profiling(options.profile):
+            if options.verify:
+                results = db.search(text, resolution=options.s_res,
+                                    year=options.s_year, verify=True, ranges=ranges,
+                                    order=order, top=top)
+            else:
+                results = db.matches(text, resolution=options.s_res,
+                                     year=options.s_year, ranges=ranges, order=order,
+                                     top=top)
+            printresults(results, options.showkey, options.showpath,
+                         options.results, options.page, options.format, order)
+
+    if options.watch:
+        try:
+            db.watch(options.startdir, settle=options.settle, poll=options.poll,
+                     jobs=options.jobs, readers=options.readers,
+                     block_size=options.block_size * 1024 * 1024,
+                     use_mmap=options.mmap, digests=options.digests,
+                     probe_jobs=options.probe_jobs, probe_timeout=options.probe_timeout,
+                     probe_retries=options.probe_retries, probe_tier=options.probe_tier,
+                     deep=options.deep)
+        except KeyboardInterrupt:
+            options.log.info("watch: interrupted, saving database")
 
     db.close()
+    if db.metacache is not None:
+        db.metacache.close()
+    if options.stats:
+        sys.stderr.write(STATS.summary())
+    if options.stats_file:
+        STATS.write(options.stats_file)
     exit(0)
 
 
 if __name__ == '__main__':
     usage = "Usage: %prog [options] arg"
     parser = optparse.OptionParser(usage, version="%prog 1.0")
-    parser.add_option("-s", "--search", dest="search", type="string", help="Search string [%default]", default="")
+    parser.add_option("-s", "--search", dest="search", type="string", help="Search string, '' matches everything [%default]", default=None)
     parser.add_option("--resolution", dest="s_res", type="string", help="Search for files with [%default] resolution", default=None)
     parser.add_option("--year", dest="s_year", type="string", help="Search for files with [%default] year", default=None)
     parser.add_option("-d", "--delete", dest="delete", type="string", help="Delete hash key from database [%default]", default=None)
     parser.add_option("--db", dest="dbfile", type="string", help="Database file [%default]", default="/d1/movies/db.json")
-    parser.add_option("--limit", dest="limit", type="int", help="Limit scan to only X entries", default=0)
+    parser.add_option("--migrate", dest="migrate", type="string", help="Import entries from this json database into a .sqlite --db [%default]", default=None)
+    parser.add_option("--no-journal", dest="nojournal", action="store_true", help="Rewrite the whole json database on every save [%default]", default=False)
+    parser.add_option("--snapshot-format", dest="snapshot_format", type="choice", choices=["json"] + list(SNAPSHOT_FORMATS), help="Rewrite the json database's snapshot as json, or a faster loading %s [%%default]" % "/".join(SNAPSHOT_FORMATS), default=None)
+    parser.add_option("--compact-records", dest="compact_records", action="store_true", help="Hold json database entries in compact records, for large libraries [%default]", default=False)
+    parser.add_option("--lock-timeout", dest="lock_timeout", type="float", help="Seconds to wait for another process holding the database lock, 0 waits indefinitely [%default]", default=300)
+    parser.add_option("--limit", dest="limit", type="int", help="Limit scan to only X entries [%default]", default=0)
+    parser.add_option("--results", dest="results", type="int", help="Print only X search results, 0 prints them all [%default]", default=0)
+    parser.add_option("--page", dest="page", type="int", help="Print page X of the search results, --results to a page [%default]", default=1)
     parser.add_option("--start-dir", dest="startdir", type="string", help="Start Directory to start processing movies [%default]", default="/d1/movies/")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", help="Hash files with X worker processes [%default]", default=1)
+    parser.add_option("--readers", dest="readers", type="int", help="Worker processes allowed to read from one disk at a time [%default]", default=1)
+    parser.add_option("--block-size", dest="block_size", type="int", help="Read X MiB at a time when hashing [%default]", default=4)
+    parser.add_option("--mmap", dest="mmap", action="store_true", help="Hash files through mmap instead of read [%default]", default=False)
+    parser.add_option("--walk-threads", dest="walk_threads", type="int", help="List directories with X threads, helps on NFS/SMB [%default]", default=1)
+    parser.add_option("--digests", dest="digests", type="string", help="Digests to compute in the same read as the md5, eg. sha256,crc32 [%default]", default="md5")
+    parser.add_option("--probe-jobs", dest="probe_jobs", type="int", help="Read MediaInfo with X worker processes [%default]", default=1)
+    parser.add_option("--probe-timeout", dest="probe_timeout", type="int", help="Give up on a MediaInfo read after X seconds [%default]", default=300)
+    parser.add_option("--probe-retries", dest="probe_retries", type="int", help="Retry failed MediaInfo reads X times [%default]", default=2)
+    parser.add_option("--probe-tier", dest="probe_tier", type="choice", choices=["fast", "deep"], help="Read only the headers (fast) or more of each file (deep) when adding files [%default]", default="fast")
+    parser.add_option("--deep-probe", dest="deep", action="store_true", help="Read deep MediaInfo for entries that only have fast, after scanning or each --watch batch [%default]", default=False)
+    parser.add_option("--reprobe-outdated", dest="reprobe", action="store_true", help="Read MediaInfo again for entries from an older extractor [%default]", default=False)
+    parser.add_option("--meta-cache", dest="metacache", type="string", help="MediaInfo cache file, shared by identical files [<db>.meta]", default=None)
+    parser.add_option("--watch", dest="watch", action="store_true", help="Keep running, adding new files as they appear under --start-dir [%default]", default=False)
+    parser.add_option("--settle", dest="settle", type="float", help="Seconds a new file must stop changing before it is added [%default]", default=5.0)
+    parser.add_option("--poll", dest="poll", type="int", help="Poll directories every X seconds instead of using inotify, 0 for inotify [%default]", default=0)
     parser.add_option("-c", "--check-videos", dest="checkvideos", action="store_true", help="Check video MD5s to find bad ones [%default]", default=False)
     parser.add_option("--scan", dest="scan", action="store_true", help="Scan files in addition to search db [%default]", default=False)
+    parser.add_option("--verify-results", dest="verify", action="store_true", help="Check search results still exist and match their md5 file, removing deleted ones [%default]", default=False)
     parser.add_option("--key", dest="showkey", action="store_true", help="Show Key value [%default]", default=False)
+    parser.add_option("--min-size", dest="min_size", type="string", help="Search for files of at least this size, eg. 700MB or 4GB [%default]", default=None)
+    parser.add_option("--max-size", dest="max_size", type="string", help="Search for files of at most this size [%default]", default=None)
+    parser.add_option("--min-bitrate", dest="min_bitrate", type="float", help="Search for files with a video bit rate of at least X Mb/s [%default]", default=None)
+    parser.add_option("--min-duration", dest="min_duration", type="int", help="Search for files at least X minutes long [%default]", default=None)
+    parser.add_option("--sort", dest="sort", type="choice", choices=["size", "bitrate", "duration"], help="List search results largest size, bitrate or duration first [%default]", default=None)
+    parser.add_option("--format", dest="format", type="choice", choices=["table", "jsonl", "csv", "tsv"], help="Print search results as a table, or stream them as jsonl, csv or tsv with raw numbers [%default]", default="table")
     parser.add_option("--path", dest="showpath", action="store_true", help="Show Filename Path [%default]", default=False)
+    parser.add_option("--stats", dest="stats", action="store_true", help="Print where the time went, per phase, to stderr when done [%default]", default=False)
+    parser.add_option("--stats-file", dest="stats_file", type="string", help="Write the --stats report to this file as json [%default]", default=None)
+    parser.add_option("--profile", dest="profile", type="string", help="Profile scanning and searching with cProfile, writing pstats to this file [%default]", default=None)
     parser.add_option("-l", "--log-level", dest="log_level", type="string", help="change log level [%default]", default="info")
     (options, args) = parser.parse_args()
+    try:
+        options.digests = hashing.parse_digests(options.digests)
+    except ValueError as e:
+        parser.error(str(e))
+    for name in ("min_size", "max_size"):
+        size = getattr(options, name)
+        if size is not None:
+            setattr(options, name, helpers.human_to_bytes(size))
+            if getattr(options, name) is None:
+                parser.error("--%s %s isn't a size, eg. 700MB or 4GB" % (name.replace("_", "-"), size))
+    if options.min_bitrate is not None:
+        options.min_bitrate = int(options.min_bitrate * 1000000)
+    if options.min_duration is not None:
+        options.min_duration = options.min_duration * 60 * 1000
 
     logger = logging.getLogger("lookup")
     level = options.log_level.upper()
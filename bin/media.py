@@ -1,9 +1,125 @@
 #!/usr/bin/env python
 import os
 import logging
-import hashlib
+import collections
 from pymediainfo import MediaInfo
 import helpers
+import hashing
+from stats import STATS
+
+# Version of what probe() extracts, bump it whenever that changes so
+# --reprobe-outdated knows which entries to refresh.
+# 2: raw duration_ms and bit_rate_bps
+MEDIAINFO_SCHEMA = 2
+
+RAW_FIELDS = helpers.RAW_FIELDS
+
+# MediaInfo parse_speed for each probe tier, cheapest first.  fast only
+# reads the headers, enough for resolution, codec, duration and the audio
+# tracks; deep is MediaInfo's default and reads on for measured bit rates
+# and colour details.
+PROBE_TIERS = collections.OrderedDict([('fast', 0.0), ('deep', 0.5)])
+
+
+def tier_covers(have, want):
+    """ True if metadata from tier have is at least as good as tier want """
+    tiers = list(PROBE_TIERS)
+    return tiers.index(have) >= tiers.index(want)
+
+
+def blank_info():
+    """ mediainfo() for a file MediaInfo couldn't read """
+    return {'title': None, 'duration': None, 'duration_ms': None, 'chapters': None, 'video': [], 'audio': []}
+
+
+def raw_fields(entry):
+    """ The RAW_FIELDS of a database entry, from the file's size and what
+        probe() measured, or parsed back out of the display strings for
+        entries probed before it kept them.  None where they're unknown.
+    """
+    mkvinfo = entry.get('mkvinfo') or {}
+    video = (mkvinfo.get('video') or [{}])[0]
+    size = (entry.get('stat') or {}).get('size')
+    if size is None:
+        size = helpers.human_to_bytes(entry.get('filesize'))
+    duration = mkvinfo.get('duration_ms')
+    if duration is None:
+        duration = helpers.human_to_ms(mkvinfo.get('duration'))
+    bit_rate = video.get('bit_rate_bps')
+    if bit_rate is None:
+        bit_rate = helpers.human_to_speed(video.get('bit_rate'))
+    return {'size_bytes': size, 'duration_ms': duration, 'bit_rate_bps': bit_rate}
+
+
+def probe(path, tier='deep'):
+    """ The video and audio track details of path, raising if MediaInfo
+        can't read it.  Fields the tier doesn't read far enough for are
+        left None.  Runs in ProbePool workers, see MediaFile.mediainfo().
+    """
+    info = blank_info()
+    video = {'height': None, 'width': None, 'resolution': None, 'resname': None, 'codec': None, 'duration': None, 'bit_rate': None, 'bit_rate_bps': None, 'bit_depth': None, 'aspect_ratio': None, 'color_primaries': None}
+    audio = {'freq': None, 'channels': None, 'language': None, 'bit_depth': None, 'codec': None}
+    mi = MediaInfo.parse(path, parse_speed=PROBE_TIERS[tier])
+
+    for t in mi.tracks:
+        if t.track_type == 'General':
+            info['duration'] = helpers.ms_to_human(t.duration or 0)
+            info['duration_ms'] = int(float(t.duration)) if t.duration else None
+            continue
+        if t.track_type == "Video":
+            vt = dict(video)
+            vd = t.to_data()
+            try:
+                # note, display_aspect_ratio = 1.791 , eg 16:9
+                vt['aspect_ratio'] = t.other_display_aspect_ratio[0]
+            except IndexError:
+                vt['aspect_ratio'] = 'n/a'
+            vt['height'] = t.height
+            vt['width'] = t.width
+            vt['resolution'] = "%dx%d" % (t.width, t.height)
+            if 'lace' in (t.scan_type or ""):
+                scantype = 'i'
+            else:
+                scantype = 'p'
+            if 1601 > t.height > 1080:
+                resname = "2160"
+            elif 1081 > t.height > 720:
+                resname = "1080"
+            elif 721 > t.height > 480:
+                resname = "720"
+            elif 481 > t.height > 320:
+                resname = "320"
+            else:
+                resname = "%s" % t.height
+            vt['resname'] = "%s%s" % (resname, scantype)
+            vt['frame_rate'] = t.frame_rate
+            vt['codec'] = t.codec
+            vt['bit_depth'] = t.bit_depth
+            vt['color_primaries'] = vd.get("color_primaries", "--")
+            if t.bit_rate:
+                br = t.bit_rate
+            elif t.nominal_bit_rate:
+                br = t.nominal_bit_rate
+            else:
+                br = None
+            vt['bit_rate_bps'] = int(float(br)) if br else None
+            try:
+                vt['bit_rate'] = helpers.speed_to_human(br)
+            except Exception:
+                vt['bit_rate'] = "n/a"
+
+            info['video'].append(vt)
+        if t.track_type == "Audio":
+            at = dict(audio)
+            at['codec'] = t.codec_family
+            at['format'] = t.format
+            at['bit_depth'] = t.bit_depth
+            at['language'] = t.language
+            at['channels'] = t.channel_s
+            at['freq'] = t.sampling_rate
+            info['audio'].append(at)
+
+    return info
 
 
 class MediaFile():
@@ -12,9 +128,12 @@ class MediaFile():
         self.log = logging.getLogger()
         self.path = path
         self.filename = os.path.basename(path)
-        self.md5 = self.md5file(generate_missing=False)
-        self.md5file = None      # Only the md5 value retrieved from the file
+        self.md5stored = None    # Only the md5 value retrieved from the file
         self.md5computed = None  # If we computed a hash, this is the value.
+        self.digests = {}        # Every digest the sidecar file holds
+        self.computed = {}       # Every digest we computed
+        self.checked = None      # Digest check_checksum() compared
+        self.md5 = self.md5file(generate_missing=False)
 
     def md5filename(self):
         splits = self.path.split('.')
@@ -27,10 +146,11 @@ class MediaFile():
         md5file = self.md5filename()
         if os.path.isfile(md5file):
             try:
-                with open(md5file, 'r') as fh:
-                    md5value = fh.readline().split()[0].lower()
+                with STATS.phase("sidecar"), open(md5file, 'r') as fh:
+                    self.digests = hashing.read_sidecar(fh)
+                md5value = self.digests['md5']
                 self.md5 = md5value
-                self.md5file = md5value
+                self.md5stored = md5value
                 return md5value
             except Exception as e:
                 self.log.error("Unable to get md5file=%s: %s", md5file, e)
@@ -39,111 +159,91 @@ class MediaFile():
             return self.generate_checksum()
         return None
 
-    def md5Checksum(self):
-        try:
-            m = hashlib.md5()
-            with open(self.path, 'rb') as fh:
-                while True:
-                    data = fh.read(8192)
-                    if not data:
-                        break
-                    m.update(data)
-            self.md5computed = m.hexdigest()
-            return self.md5computed
-        except Exception as e:
-            self.log.error("Unable to compute checksum of (%s): %s", self.path, e)
-        return None
-
-    def generate_checksum(self):
-        self.log.info('Generating hash for (%s)', self.filename)
-        md5value = self.md5Checksum()
-        if not md5value:
+    def md5Checksum(self, block_size=hashing.DEFAULT_BLOCK_SIZE, use_mmap=False,
+                    names=('md5',)):
+        result = hashing.hash_file(self.path, block_size, use_mmap, names)
+        hashing.account(result)
+        if result['error']:
+            self.log.error("Unable to compute checksum of (%s): %s",
+                           self.path, result['error'])
             return None
-        self.md5 = md5value
+        self.log.debug("Hashed (%s) size=%s in %.1fs rate=%s", self.filename,
+                       helpers.bytes_to_human(result['bytes']),
+                       result['seconds'], hashing.rate(result))
+        self.computed = result['digests']
+        self.md5computed = result['md5']
+        return self.md5computed
+
+    def check_digests(self, wanted=('md5',)):
+        """ Digests to compute to check this file: the cheapest one the
+            sidecar holds, plus any of wanted it lacks so they can be added
+            from the same read
+        """
+        names = [hashing.cheapest(self.digests) or 'md5']
+        names.extend(n for n in wanted if n not in self.digests and n not in names)
+        return tuple(names)
+
+    def write_sidecar(self, digests):
         md5file = self.md5filename()
         try:
             with open(md5file, 'w') as fh:
-                fh.write(md5value + "\t" + self.filename)
+                fh.write(hashing.format_sidecar(self.filename, digests))
+            self.digests = dict(digests)
             self.log.info('Wrote computed value (%s) for filename (%s)',
-                          md5value, os.path.basename(md5file))
+                          digests['md5'], os.path.basename(md5file))
         except Exception as e:
             self.log.error("Unable to write checksum file (%s): %s",
                            md5file, e)
+        return
+
+    def generate_checksum(self, md5value=None, digests=None):
+        """ Write the sidecar md5 file, hashing the file unless md5value
+            (or all of digests) was already computed elsewhere (eg. by a
+            HashPool worker)
+        """
+        self.log.info('Generating hash for (%s)', self.filename)
+        if digests:
+            self.computed = dict(digests)
+            md5value = digests.get('md5')
+        elif md5value:
+            self.computed = {'md5': md5value}
+        else:
+            md5value = self.md5Checksum()
+        if not md5value:
+            return None
+        self.md5computed = md5value
+        self.md5 = md5value
+        self.write_sidecar(self.computed)
         return md5value
 
-    def check_checksum(self):
+    def check_checksum(self, current=None):
+        """ Compare the sidecar against current (an md5 or a dict of
+            digests), or a fresh hash, on the cheapest digest both have.
+            Digests the sidecar was missing are added to it if it matches.
+        """
         filesum = self.md5file(generate_missing=False)
         if not filesum:
             return None
-        current = self.md5Checksum()
-        if not current:
+        if isinstance(current, dict):
+            self.computed = dict(current)
+        elif current:
+            self.computed = {'md5': current}
+        elif not self.md5Checksum(names=self.check_digests()):
+            return None
+        self.md5computed = self.computed.get('md5')
+        self.checked = hashing.cheapest(set(self.digests) & set(self.computed))
+        if not self.checked:
             return None
-        return filesum.lower() == current.lower()
+        good = self.digests[self.checked] == self.computed[self.checked].lower()
+        if good and not set(self.computed) <= set(self.digests):
+            merged = dict(self.computed)
+            merged.update(self.digests)
+            self.write_sidecar(merged)
+        return good
 
     def mediainfo(self):
-        info = {'title': None, 'duration': None, 'chapters': None, 'video': [], 'audio': []}
-        video = {'height': None, 'width': None, 'resolution': None, 'resname': None, 'codec': None, 'duration': None, 'bit_rate': None, 'bit_depth': None, 'aspect_ratio': None, 'color_primaries': None}
-        audio = {'freq': None, 'channels': None, 'language': None, 'bit_depth': None, 'codec': None}
         try:
-            mi = MediaInfo.parse(self.path)
+            return probe(self.path)
         except Exception as e:
             self.log.error("MediaInfo threw error reading path=%s: %s", self.path, e)
-            return info
-
-        for t in mi.tracks:
-            if t.track_type == 'General':
-                info['duration'] = helpers.ms_to_human(t.duration or 0)
-                continue
-            if t.track_type == "Video":
-                vt = dict(video)
-                vd = t.to_data()
-                try:
-                    # note, display_aspect_ratio = 1.791 , eg 16:9
-                    vt['aspect_ratio'] = t.other_display_aspect_ratio[0]
-                except IndexError:
-                    vt['aspect_ratio'] = 'n/a'
-                vt['height'] = t.height
-                vt['width'] = t.width
-                vt['resolution'] = "%dx%d" % (t.width, t.height)
-                if 'lace' in (t.scan_type or ""):
-                    scantype = 'i'
-                else:
-                    scantype = 'p'
-                if 1601 > t.height > 1080:
-                    resname = "2160"
-                elif 1081 > t.height > 720:
-                    resname = "1080"
-                elif 721 > t.height > 480:
-                    resname = "720"
-                elif 481 > t.height > 320:
-                    resname = "320"
-                else:
-                    resname = "%s" % t.height
-                vt['resname'] = "%s%s" % (resname, scantype)
-                vt['frame_rate'] = t.frame_rate
-                vt['codec'] = t.codec
-                vt['bit_depth'] = t.bit_depth
-                vt['color_primaries'] = vd.get("color_primaries", "--")
-                if t.bit_rate:
-                    br = t.bit_rate
-                elif t.nominal_bit_rate:
-                    br = t.nominal_bit_rate
-                else:
-                    br = None
-                try:
-                    vt['bit_rate'] = helpers.speed_to_human(br)
-                except Exception:
-                    vt['bit_rate'] = "n/a"
-
-                info['video'].append(vt)
-            if t.track_type == "Audio":
-                at = dict(audio)
-                at['codec'] = t.codec_family
-                at['format'] = t.format
-                at['bit_depth'] = t.bit_depth
-                at['language'] = t.language
-                at['channels'] = t.channel_s
-                at['freq'] = t.sampling_rate
-                info['audio'].append(at)
-
-        return info
+        return blank_info()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+import os
+import json
+import logging
+import media
+import records
+from jsondb import JsonDB
+from locking import FileLock, LockTimeout
+
+
+class MetaCache(object):
+    """ MediaInfo results by md5sum, so content is only ever probed once
+        no matter how many paths or databases it turns up in.  Each result
+        is tagged with the media.MEDIAINFO_SCHEMA it was extracted with,
+        and results from older extractors are treated as missing, as are
+        results from a cheaper probe tier than the one asked for.
+
+        Kept as json lines appended to filename as results come in, the
+        last line for an md5sum winning, so an interrupted run loses
+        nothing it already probed.  Rewritten without the superseded
+        lines when they outnumber the live ones.
+
+        Reading and appending hold a shared lock on <filename>.lock, and
+        rewriting an exclusive one, which also re-reads the file so
+        results other processes appended since aren't lost.  Appends go
+        to the file as it is then, not one a rewrite has since replaced.
+    """
+
+    def __init__(self, filename):
+        self.log = logging.getLogger()
+        self.filename = filename
+        self.cache = {}  # md5sum -> {"schema", "mkvinfo", "probe"}
+        self.fh = None
+        self.load()
+
+    def _lock(self):
+        return FileLock("%s.lock" % self.filename, JsonDB.lock_timeout)
+
+    def load(self):
+        try:
+            with self._lock().shared():
+                lines = self._read()
+        except LockTimeout as e:
+            self.log.error("metacache: not loaded, everything will be probed: %s", e)
+            return
+        if lines > 2 * len(self.cache) + 1000:
+            self.compact()
+        self.log.debug("metacache: loaded (%d) results from %s",
+                       len(self.cache), self.filename)
+        return
+
+    def _read(self):
+        """ Load filename into cache, returning the number of records """
+        lines = 0
+        if os.path.isfile(self.filename):
+            with open(self.filename, 'r') as fh:
+                for line in fh:
+                    try:
+                        record = json.loads(line)
+                        md5sum = record.pop("md5")
+                    except (ValueError, KeyError, AttributeError):
+                        self.log.warning("metacache: ignoring bad record in %s",
+                                         self.filename)
+                        continue
+                    self.cache[md5sum] = record
+                    lines += 1
+        return lines
+
+    def get(self, md5sum, schema, tier='fast'):
+        """ The cached record for md5sum, None unless it is from schema
+            and at least tier
+        """
+        record = self.cache.get(md5sum)
+        if record is None or record.get("schema") != schema:
+            return None
+        if not media.tier_covers(record["probe"].get("tier", "deep"), tier):
+            return None
+        return record
+
+    def put(self, md5sum, schema, mkvinfo, probe):
+        record = {"schema": schema, "mkvinfo": mkvinfo, "probe": probe}
+        self.cache[md5sum] = record
+        try:
+            with self._lock().shared():
+                if self.fh is not None and self._replaced():
+                    self.close()
+                if self.fh is None:
+                    self.fh = open(self.filename, 'a')
+                self.fh.write(json.dumps(dict(record, md5=md5sum), default=records.plain) + "\n")
+                self.fh.flush()
+        except LockTimeout as e:
+            self.log.error("metacache: result for %s not saved: %s", md5sum, e)
+        return
+
+    def _replaced(self):
+        """ True if fh is no longer filename, another process rewrote it """
+        try:
+            return os.fstat(self.fh.fileno()).st_ino != os.stat(self.filename).st_ino
+        except OSError:
+            return True
+
+    def compact(self):
+        self.close()
+        tmpfile = "%s.tmp" % self.filename
+        try:
+            with self._lock().exclusive():
+                self._read()  # Everything we have is in it, and what others appended
+                with open(tmpfile, 'w') as fh:
+                    for md5sum, record in self.cache.items():
+                        fh.write(json.dumps(dict(record, md5=md5sum), default=records.plain) + "\n")
+                    fh.flush()
+                    os.fsync(fh.fileno())
+                os.rename(tmpfile, self.filename)
+            self.log.info("metacache: compacted %s to (%d) results",
+                          self.filename, len(self.cache))
+        except LockTimeout as e:
+            self.log.error("metacache: not compacted: %s", e)
+        except Exception as e:
+            self.log.error("unable to compact metacache=%s: %s", self.filename, e)
+        return
+
+    def sync(self):
+        if self.fh is not None:
+            os.fsync(self.fh.fileno())
+        return
+
+    def close(self):
+        if self.fh is not None:
+            self.sync()
+            self.fh.close()
+            self.fh = None
+        return
@@ -1,56 +1,82 @@
 #!/usr/bin/env python
 
-import os,fnmatch,time
+import os,sys,fnmatch,time
 import optparse,logging
-import hashlib
+import walker
+import watcher
+import hashing
+from hashing import HashPool
+from stats import STATS
 
-def md5Checksum(filePath):
-    with open(filePath, 'rb') as fh:
-        m = hashlib.md5()
-        while True:
-            data = fh.read(8192)
-            if not data:
-                break
-            m.update(data)
-        return m.hexdigest()
+EXTENSIONS = ('mkv','avi','mp4','mpeg')
+
+def hash_tasks(options,entries,counts):
+    """ Yield (context, video, device, digests) for every video in entries that needs hashing """
+    for entry in entries:
+        basepath = entry.dirpath
+        filename = entry.name
+        video = entry.path
+        counts['total'] += 1
+        basename = '.'.join(filename.split('.')[0:-1])
+        extension = filename.split('.')[-1]
+        logging.debug('Found (%s)',video)
+        logging.debug('BasePath (%s), Filename (%s), Basename (%s), Extension (%s)',basepath,filename,basename,extension)
 
-def main(options):
-    totalfiles = 0
-    hashesadded = 0
-    for basepath, dirs, files in os.walk( os.path.abspath(options.startdir) ):
-        for filename in files:
-            if filename.lower().endswith(('.mkv','.avi','.mp4','.mpeg')):
-                video = basepath + "/" + filename
-                totalfiles += 1
-                basename = '.'.join(filename.split('.')[0:-1])
-                extension = filename.split('.')[-1]
-                logging.debug('Found (%s)',video)
-                logging.debug('BasePath (%s), Filename (%s), Basename (%s), Extension (%s)',basepath,filename,basename,extension)
+        hashfile = basepath + "/" + basename + ".md5"
 
-                hashfile = basepath + "/" + basename + ".md5"
+        if os.path.isfile(hashfile):
+            logging.debug('Found MD5 hash existing for (%s)!', filename)
+            if options.checkvideos:
+                with STATS.phase('sidecar'):
+                    chkfh = open(hashfile,'r')
+                    stored = hashing.read_sidecar(chkfh)
+                    chkfh.close()
+                logging.debug('Existing hashes for video (%s) are (%s)',video,stored)
+                # Only the cheapest stored digest is needed to check, plus any new ones asked for
+                names = [hashing.cheapest(stored) or 'md5']
+                names.extend(n for n in options.digests if n not in stored and n not in names)
+                yield (video,filename,hashfile,stored), video, entry.dev, tuple(names)
+        else:
+            logging.info('Generating hash for (%s)',filename)
+            yield (video,filename,hashfile,None), video, entry.dev, options.digests
 
-                if os.path.isfile(hashfile):
-                    logging.debug('Found MD5 hash existing for (%s)!', filename)
-                    if options.checkvideos:
-                        chkfh = open(hashfile,'r')
-                        filevalue = chkfh.readline().split()[0].lower()
-                        chkfh.close()
-                        logging.debug('Existing hash for video (%s) is (%s)',video,filevalue)
-                        md5value = md5Checksum(video).lower()
-                        if md5value != filevalue:
-                            logging.error('BAD: Hash does not match for file (%s), stored hash (%s), computed hash (%s)!',video,filevalue,md5value)
-                        else:
-                            logging.info('GOOD: %s [ %s / %s ]',video,filevalue,md5value)
-                    
-                else:
-                    logging.info('Generating hash for (%s)',filename)
-                    md5value = md5Checksum(video)
-                    hashfh = open(hashfile,'w')
-                    hashfh.write(md5value + "\t" + filename)
-                    hashfh.close()
-                    logging.info('Wrote computed value (%s) for filename (%s)',md5value,filename)
-                    hashesadded += 1
-    logging.info('Completed (%d) files, added (%d) hashes!',totalfiles,hashesadded)
+def main(options,entries=None):
+    """ Hash entries, or everything under startdir """
+    if entries is None:
+        entries = STATS.iterate('walk',walker.walk(options.startdir,extensions=EXTENSIONS,threads=options.walk_threads))
+    counts = {'total': 0, 'added': 0}
+    pool = HashPool(options.jobs,options.readers,options.block_size*1024*1024,options.mmap,digests=options.digests)
+    try:
+        with STATS.profiling(options.profile):
+            for (video,filename,hashfile,stored), result in pool.run(hash_tasks(options,entries,counts)):
+                if result['error']:
+                    logging.error('Unable to compute checksum of (%s): %s',video,result['error'])
+                    continue
+                computed = result['digests']
+                if stored:
+                    name = hashing.cheapest(set(stored) & set(computed))
+                    if computed[name] != stored[name]:
+                        logging.error('BAD: Hash does not match for file (%s), stored %s (%s), computed %s (%s)!',video,name,stored[name],name,computed[name])
+                        continue
+                    logging.info('GOOD: %s [ %s %s / %s ]',video,name,stored[name],computed[name])
+                    if set(computed) <= set(stored):
+                        continue
+                    computed.update(stored)
+                hashfh = open(hashfile,'w')
+                hashfh.write(hashing.format_sidecar(filename,computed))
+                hashfh.close()
+                logging.info('Wrote computed value (%s) for filename (%s)',computed['md5'],filename)
+                if not stored:
+                    counts['added'] += 1
+    finally:
+        pool.close()
+    logging.info(pool.summary())
+    logging.info('Completed (%d) files, added (%d) hashes!',counts['total'],counts['added'])
+    STATS.counts.update(counts)
+    if options.stats:
+        sys.stderr.write(STATS.summary())
+    if options.stats_file:
+        STATS.write(options.stats_file)
     return
 
 if __name__ == '__main__':
@@ -66,12 +92,28 @@ if __name__ == '__main__':
     parser.add_option('-s','--start-dir',dest='startdir',type='string',metavar='STARTDIR',help='Start Directory to start processing movies [%default]',default='/d1/movies/')
     parser.add_option("-l", "--log-level", dest="log_level", type='string',metavar='LEVEL',help="change log level [%default]",default='info')
     parser.add_option("-c", "--check-videos", dest="checkvideos", action="store_true",help="Check video MD5's to find bad ones [%default]",default=False)
+    parser.add_option("-j", "--jobs", dest="jobs", type='int', help="Hash files with X worker processes [%default]",default=1)
+    parser.add_option("--readers", dest="readers", type='int', help="Worker processes allowed to read from one disk at a time [%default]",default=1)
+    parser.add_option("--block-size", dest="block_size", type='int', help="Read X MiB at a time when hashing [%default]",default=4)
+    parser.add_option("--mmap", dest="mmap", action="store_true", help="Hash files through mmap instead of read [%default]",default=False)
+    parser.add_option("--walk-threads", dest="walk_threads", type='int', help="List directories with X threads, helps on NFS/SMB [%default]",default=1)
+    parser.add_option("--digests", dest="digests", type='string', help="Digests to compute in the same read as the md5, eg. sha256,crc32 [%default]",default="md5")
     parser.add_option("--continuous", dest="loop", type='int', help="Run continuously, and loop every [%default] seconds",default=0)
+    parser.add_option("--watch", dest="watch", action="store_true", help="Hash everything once, then hash new videos as they appear [%default]",default=False)
+    parser.add_option("--settle", dest="settle", type='float', help="Seconds a new video must stop changing before it is hashed [%default]",default=5.0)
+    parser.add_option("--poll", dest="poll", type='int', help="Poll directories every X seconds instead of using inotify, 0 for inotify [%default]",default=0)
+    parser.add_option("--stats", dest="stats", action="store_true", help="Print where the time went, per phase, to stderr after each pass [%default]",default=False)
+    parser.add_option("--stats-file", dest="stats_file", type='string', help="Write the --stats report to this file as json [%default]",default=None)
+    parser.add_option("--profile", dest="profile", type='string', help="Profile hashing with cProfile, writing pstats to this file [%default]",default=None)
     group = optparse.OptionGroup(parser, "Debug Options")
     group.add_option("-d", "--debug", action="store_true",help="Print debug information")
     parser.add_option_group(group)
 
     (options, args) = parser.parse_args()
+    try:
+        options.digests = hashing.parse_digests(options.digests)
+    except ValueError as e:
+        parser.error(str(e))
 
     logger = logging.getLogger('')
     level = options.log_level.upper()
@@ -81,7 +123,15 @@ if __name__ == '__main__':
     stderr_handler.setFormatter(formatter)
     logger.addHandler(stderr_handler)
 
-    if options.loop > 0:
+    if options.watch:
+        main(options)
+        watch = watcher.Watcher(options.startdir,lambda entries: main(options,entries),
+                                EXTENSIONS,(),options.settle,options.poll)
+        try:
+            watch.run()
+        except KeyboardInterrupt:
+            pass
+    elif options.loop > 0:
         while True:
             logging.info('Running in continuous mode every (%d) seconds',options.loop)
             main(options)
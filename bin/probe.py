@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+import time
+import logging
+import collections
+import multiprocessing
+import multiprocessing.connection
+import media
+from stats import STATS
+
+
+def serve(conn):
+    """ Worker process: probe each (path, tier) sent down conn until None """
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+        try:
+            conn.send((media.probe(*task), None))
+        except Exception as e:
+            conn.send((None, "%s: %s" % (type(e).__name__, e)))
+    return
+
+
+class ProbeWorker(object):
+    """ One probe process and the task it's working on """
+
+    def __init__(self):
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=serve, args=(child,),
+                                               daemon=True)
+        self.process.start()
+        child.close()
+        self.task = None
+        self.started = 0
+
+    def send(self, task):
+        self.task = task
+        self.started = time.time()
+        self.conn.send((task.path, task.tier))
+        return
+
+    def kill(self):
+        self.process.terminate()
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+        return
+
+    def close(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(1)
+        if self.process.is_alive():
+            self.kill()
+        else:
+            self.conn.close()
+        return
+
+
+class ProbeTask(object):
+    __slots__ = ('context', 'path', 'tier', 'attempts', 'ready')
+
+    def __init__(self, context, path, tier):
+        self.context = context
+        self.path = path
+        self.tier = tier
+        self.attempts = 0
+        self.ready = 0  # Not to be retried before this time
+
+
+class ProbePool(object):
+    """ MediaInfo probes in their own worker processes, so a damaged file or
+        a stuck network mount can't stall a scan.  A probe that runs longer
+        than timeout seconds has its worker killed and replaced, failures
+        are retried up to retries times, waiting backoff seconds, doubling
+        each time, before they're given up on.
+
+        submit() never blocks, results() hands back (context, info, status)
+        for finished probes, status being a dict with status "ok", "failed"
+        or "timeout", the tier, the last error and the number of attempts.
+    """
+
+    def __init__(self, jobs=1, timeout=300, retries=2, backoff=5, log=None):
+        self.jobs = max(1, jobs or 1)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.log = log or logging.getLogger()
+        self.workers = []
+        self.queue = collections.deque()
+        self.done = collections.deque()
+        self.counts = collections.Counter()
+
+    def submit(self, context, path, tier='deep'):
+        self.queue.append(ProbeTask(context, path, tier))
+        self._dispatch()
+        return
+
+    def pending(self):
+        return len(self.queue) + sum(1 for w in self.workers if w.task)
+
+    def results(self, block=False):
+        """ Finished probes, waiting for every outstanding one if block """
+        while True:
+            self._poll(block and not self.done)
+            while self.done:
+                yield self.done.popleft()
+            if not block or not self.pending():
+                break
+        return
+
+    def _dispatch(self):
+        """ Hand queued probes that are due to idle workers, starting new
+            workers up to jobs
+        """
+        now = time.time()
+        while self.queue:
+            worker = next((w for w in self.workers if w.task is None), None)
+            if worker is None and len(self.workers) >= self.jobs:
+                break
+            task = next((t for t in self.queue if t.ready <= now), None)
+            if task is None:
+                break
+            if worker is None:
+                worker = ProbeWorker()
+                self.workers.append(worker)
+            self.queue.remove(task)
+            task.attempts += 1
+            worker.send(task)
+        return
+
+    def _wait(self, block):
+        """ Seconds to wait for a worker, 0 to just look """
+        if not block:
+            return 0
+        now = time.time()
+        due = [w.started + self.timeout for w in self.workers if w.task]
+        due.extend(t.ready for t in self.queue if t.ready > now)  # Backing off
+        if not due:
+            return 0
+        return max(0, min(due) - now)
+
+    def _poll(self, block=False):
+        self._dispatch()
+        busy = dict((w.conn, w) for w in self.workers if w.task)
+        if busy or block:
+            ready = multiprocessing.connection.wait(list(busy), self._wait(block))
+        else:
+            ready = []
+        for conn in ready:
+            worker = busy[conn]
+            task, worker.task = worker.task, None
+            elapsed = time.time() - worker.started
+            STATS.add("probe", elapsed)
+            STATS.file("probe", task.path, elapsed)
+            try:
+                info, error = conn.recv()
+            except (EOFError, OSError):
+                self._replace(worker)
+                info, error = None, "probe worker died, exit code %s" % worker.process.exitcode
+            if error:
+                self._failed(task, "failed", error)
+            else:
+                self._finished(task, info, {"status": "ok", "tier": task.tier,
+                                            "attempts": task.attempts})
+        now = time.time()
+        for worker in list(self.workers):
+            if worker.task and now - worker.started > self.timeout:
+                task, worker.task = worker.task, None
+                STATS.add("probe", now - worker.started)
+                STATS.file("probe", task.path, now - worker.started)
+                self._replace(worker)
+                self._failed(task, "timeout", "no result after %ds" % self.timeout)
+        self._dispatch()
+        return
+
+    def _replace(self, worker):
+        worker.kill()
+        self.workers.remove(worker)
+        return
+
+    def _failed(self, task, status, error):
+        if task.attempts <= self.retries:
+            delay = self.backoff * 2 ** (task.attempts - 1)
+            self.log.warning("probe: %s %s (%s), retrying in %ds", status,
+                             task.path, error, delay)
+            task.ready = time.time() + delay
+            self.queue.append(task)
+            return
+        self.log.error("probe: giving up on %s after (%d) attempts: %s",
+                       task.path, task.attempts, error)
+        self._finished(task, None, {"status": status, "tier": task.tier,
+                                    "error": error, "attempts": task.attempts})
+        return
+
+    def _finished(self, task, info, status):
+        self.counts[status["status"]] += 1
+        STATS.count("probe_%s" % status["status"])
+        self.done.append((task.context, info, status))
+        return
+
+    def summary(self):
+        return "probed ok=%d failed=%d timeout=%d jobs=%d" % (
+            self.counts['ok'], self.counts['failed'], self.counts['timeout'],
+            self.jobs)
+
+    def close(self):
+        for worker in self.workers:
+            if worker.task:
+                worker.kill()
+            else:
+                worker.close()
+        self.workers = []
+        return
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+import sys
+import collections.abc
+
+
+class Record(collections.abc.MutableMapping):
+    """ A dict look-alike that keeps the keys every entry has in __slots__
+        rather than a per-record hash table.  Other keys go in a dict of
+        their own, only made if a record has any.  String values of the
+        categorical keys are interned, so a codec name, resolution or show
+        is held once for the whole database instead of once per entry,
+        and dict values of the nested keys become records too.
+
+        Reads, writes, iteration and == against a dict all behave like the
+        dict the record was made from, so code written for JsonDB's dict
+        entries keeps working on them.  Records pickle as that dict, and
+        json takes plain() as its default.
+    """
+
+    __slots__ = ("_extra",)
+    fields = ()         # Keys stored in slots
+    _slots = frozenset()
+    interned = ()       # Keys whose string values are interned
+    nested = {}         # Key -> function converting its value
+
+    def __init__(self, *args, **kwargs):
+        self._extra = None
+        self.update(*args, **kwargs)
+
+    @classmethod
+    def of(cls, value):
+        """ value as a cls, unless it's already one or isn't a mapping """
+        if type(value) is not dict and (
+                isinstance(value, cls) or not isinstance(value, collections.abc.Mapping)):
+            return value
+        # __setitem__ inlined, this runs for every entry of a database
+        record = cls.__new__(cls)
+        record._extra = None
+        slots, nested, interned = cls._slots, cls.nested, cls.interned
+        for key, v in value.items():
+            if key not in slots:
+                record[key] = v
+                continue
+            if key in nested:
+                v = nested[key](v)
+            elif key in interned and type(v) is str:
+                v = sys.intern(v)
+            setattr(record, key, v)
+        return record
+
+    def __getitem__(self, key):
+        if key in self._slots:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def get(self, key, default=None):
+        if key in self._slots:
+            return getattr(self, key, default)
+        if self._extra is None:
+            return default
+        return self._extra.get(key, default)
+
+    def __setitem__(self, key, value):
+        if key in self._slots:
+            if key in self.nested:
+                value = self.nested[key](value)
+            elif key in self.interned and type(value) is str:
+                value = sys.intern(value)
+            setattr(self, key, value)
+            return
+        if self._extra is None:
+            self._extra = {}
+        self._extra[key] = value
+        return
+
+    def __delitem__(self, key):
+        if key in self._slots:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+            return
+        if self._extra is None:
+            raise KeyError(key)
+        del self._extra[key]
+        return
+
+    def __contains__(self, key):
+        if key in self._slots:
+            return hasattr(self, key)
+        return self._extra is not None and key in self._extra
+
+    def __iter__(self):
+        for key in self.fields:
+            if hasattr(self, key):
+                yield key
+        if self._extra is not None:
+            for key in self._extra:
+                yield key
+        return
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+    def __bool__(self):
+        for key in self.fields:
+            if hasattr(self, key):
+                return True
+        return bool(self._extra)
+
+    def __reduce__(self):
+        return (dict, (list(self.items()),))
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, dict(self))
+
+
+def record_class(name, fields, interned=(), nested=None):
+    """ A Record subclass with a slot for each of fields """
+    return type(name, (Record,), {
+        "__slots__": tuple(fields), "fields": tuple(fields),
+        "_slots": frozenset(fields), "interned": frozenset(interned),
+        "nested": nested or {}})
+
+
+def record_list(cls):
+    """ Converts a list of dicts to a list of cls """
+    def convert(value):
+        if not isinstance(value, list):
+            return value
+        return [cls.of(v) for v in value]
+    return convert
+
+
+VideoTrack = record_class("VideoTrack", (
+    "height", "width", "resolution", "resname", "codec", "duration", "bit_rate",
+    "bit_rate_bps", "bit_depth", "aspect_ratio", "color_primaries", "frame_rate"),
+    interned=("resolution", "resname", "codec", "bit_rate", "aspect_ratio",
+              "color_primaries", "frame_rate"))
+
+AudioTrack = record_class("AudioTrack", (
+    "freq", "channels", "language", "bit_depth", "codec", "format"),
+    interned=("language", "codec", "format"))
+
+MediaInfo = record_class("MediaInfo", (
+    "title", "duration", "duration_ms", "chapters", "video", "audio"),
+    interned=("duration",),
+    nested={"video": record_list(VideoTrack), "audio": record_list(AudioTrack)})
+
+Stat = record_class("Stat", ("size", "mtime_ns", "inode", "dev"))
+
+Probe = record_class("Probe", ("status", "tier", "attempts", "schema", "error"),
+                     interned=("status", "tier"))
+
+Entry = record_class("Entry", (
+    "title", "year", "genre", "show", "season", "episode", "filename",
+    "filetype", "filesize", "size_bytes", "md5sum", "digests", "fingerprint",
+    "valid", "stat", "mkvinfo", "probe", "duration_ms", "bit_rate_bps"),
+    interned=("year", "genre", "show", "filetype"),
+    nested={"stat": Stat.of, "mkvinfo": MediaInfo.of, "probe": Probe.of})
+
+
+def compact(entry):
+    """ A database entry as an Entry record """
+    return Entry.of(entry)
+
+
+def plain(value):
+    """ value with every Record in it turned back into a dict """
+    if isinstance(value, Record):
+        return dict((k, plain(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return [plain(v) for v in value]
+    return value
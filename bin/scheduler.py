@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+import collections
+
+
+class DeviceScheduler(object):
+    """ Queue work per device (st_dev) and hand it out so that no device
+        has more than `readers` jobs in flight.  Spinning disks read
+        sequentially far faster than they seek, so a couple of readers per
+        disk across every disk beats many readers fighting over one.
+    """
+
+    def __init__(self, readers=1):
+        self.readers = max(1, readers or 1)
+        self.queues = collections.OrderedDict()  # device -> deque of items
+        self.active = collections.Counter()      # device -> jobs in flight
+        self.queued = 0
+
+    def put(self, device, item):
+        """ Queue item to be read from device """
+        self.queues.setdefault(device, collections.deque()).append(item)
+        self.queued += 1
+        return
+
+    def get(self):
+        """ Return (device, item) for the next device with a free reader,
+            or None when every device with queued work is busy.  Devices
+            are served round robin so a large one can't starve the rest.
+        """
+        for device in list(self.queues):
+            if self.active[device] >= self.readers:
+                continue
+            work = self.queues.pop(device)
+            item = work.popleft()
+            if work:
+                self.queues[device] = work  # Back of the line
+            self.active[device] += 1
+            self.queued -= 1
+            return device, item
+        return None
+
+    def release(self, device):
+        """ A job on device finished, free its reader """
+        self.active[device] -= 1
+        if self.active[device] <= 0:
+            del self.active[device]
+        return
+
+    def busy(self):
+        """ Jobs currently in flight across all devices """
+        return sum(self.active.values())
@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+import array
+import bisect
+import collections
+import heapq
+import helpers
+from helpers import RAW_FIELDS
+
+
+def trigrams(text):
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+def inode_key(dev, inode):
+    return "%d:%d" % (dev, inode)
+
+
+class SortedIndex(object):
+    """ md5sums in order of one integer field, for range searches and
+        largest-first listings that don't sort the database.  Loading is
+        just a dict insert; the (value, md5sum) list is sorted once, when
+        it's first queried, and kept in order with bisect from then on.
+    """
+
+    def __init__(self):
+        self.values = {}    # md5sum -> value
+        self.items = []     # sorted (value, md5sum), once not stale
+        self.stale = True
+
+    def add(self, md5sum, value):
+        self.remove(md5sum)
+        if value is None:
+            return
+        self.values[md5sum] = value
+        if not self.stale:
+            bisect.insort(self.items, (value, md5sum))
+        return
+
+    def remove(self, md5sum):
+        value = self.values.pop(md5sum, None)
+        if value is not None and not self.stale:
+            del self.items[bisect.bisect_left(self.items, (value, md5sum))]
+        return
+
+    def _sorted(self):
+        if self.stale:
+            self.items = sorted((v, m) for m, v in self.values.items())
+            self.stale = False
+        return self.items
+
+    def range(self, low=None, high=None):
+        """ Set of md5sums with low <= value <= high, either end open if None """
+        items = self._sorted()
+        start = 0 if low is None else bisect.bisect_left(items, (low,))
+        end = len(items) if high is None else bisect.bisect_left(items, (high + 1,))
+        return set(m for v, m in items[start:end])
+
+    def descending(self, md5s=None):
+        """ Yield md5s, or every md5sum, largest value first.  Ones without
+            a value aren't included.
+        """
+        if md5s is not None and len(md5s) * 8 < len(self.values):
+            # Cheaper to sort a handful than walk the whole index
+            md5s = [m for m in md5s if m in self.values]
+            md5s.sort(key=lambda m: (self.values[m], m), reverse=True)
+            for m in md5s:
+                yield m
+            return
+        for v, m in reversed(self._sorted()):
+            if md5s is None or m in md5s:
+                yield m
+        return
+
+
+class SearchIndex(object):
+    """ In-memory lookup tables over JsonDB entries, so a search only
+        touches entries that can match instead of every record.
+
+        Names (lowercased title and show) are stored once each, with a
+        trigram -> name id posting list for substring search.  Postings
+        are append-only arrays; names left without entries are skipped at
+        query time.  Exact fields (year, season, episode, resolution, the
+        normalized show, the content fingerprint and the file's device and
+        inode) map straight to sets of md5sums.  The integer RAW_FIELDS each
+        have a SortedIndex.
+
+        Tables are built from entries() when a query needs them, and only
+        from the build_after'th such query on; before that the query looks
+        at every entry instead.  Building a table costs many times a single
+        pass, so opening a database costs nothing and a one-off search
+        costs one pass, while a scan, which looks up every file it finds,
+        or a long running watch soon has the tables it uses.  add() and
+        remove() keep the tables built so far up to date.
+    """
+
+    facets = ('year', 'season', 'episode', 'resolution', 'show', 'fingerprint',
+              'inode')
+    build_after = 2  # Queries needing a table before it's built
+
+    def __init__(self, entries=dict):
+        self.entries = entries  # Returns the md5sum -> entry dict being indexed
+        self.clear()
+
+    def clear(self):
+        self.built = set()     # Tables built: 'names', facets and RAW_FIELDS
+        self.uses = collections.Counter()  # table -> queries that needed it
+        self.name_ids = {}     # lowercased name -> name id
+        self.names = []        # name id -> lowercased name
+        self.name_md5s = []    # name id -> set of md5sums using that name
+        self.postings = collections.defaultdict(lambda: array.array('i'))
+        self.facet = dict((f, collections.defaultdict(set)) for f in self.facets)
+        self.keys = {}         # md5sum -> {table: what it was indexed under}
+        self.sorted = dict((f, SortedIndex()) for f in RAW_FIELDS)
+        self.shows = {}        # show -> helpers.normalize_name(show)
+        return
+
+    def __len__(self):
+        return len(self.entries())
+
+    def build(self, tables=None):
+        """ Build tables, or every table, if they aren't yet """
+        for table in tables or (('names',) + self.facets + RAW_FIELDS):
+            if table in self.built:
+                continue
+            self.built.add(table)
+            for md5sum, entry in self.entries().items():
+                self._index(table, md5sum, entry)
+        return
+
+    def _ready(self, table):
+        """ True if table is built, building it if it's needed often enough """
+        if table not in self.built:
+            self.uses[table] += 1
+            if self.uses[table] < self.build_after:
+                return False
+            self.build((table,))
+        return True
+
+    def _facet_value(self, facet, entry):
+        if facet == 'resolution':
+            video = (entry.get("mkvinfo") or {}).get("video") or []
+            return video[0].get("resname") if len(video) > 0 else None
+        if facet == 'show':
+            show = entry.get("show")
+            if not show:
+                return None
+            key = self.shows.get(show)
+            if key is None:
+                key = self.shows[show] = helpers.normalize_name(show)
+            return key
+        if facet == 'inode':
+            stat = entry.get("stat")
+            return inode_key(stat['dev'], stat['inode']) if stat else None
+        return entry.get(facet)
+
+    def _name_id(self, name):
+        nid = self.name_ids.get(name)
+        if nid is None:
+            nid = len(self.names)
+            self.name_ids[name] = nid
+            self.names.append(name)
+            self.name_md5s.append(set())
+            for t in trigrams(name):
+                self.postings[t].append(nid)
+        return nid
+
+    def _index(self, table, md5sum, entry):
+        if table in self.sorted:
+            self.sorted[table].add(md5sum, entry.get(table))
+            return
+        if table == 'names':
+            key = []
+            for field in ('title', 'show'):
+                value = entry.get(field)
+                if value:
+                    nid = self._name_id(value.lower())
+                    self.name_md5s[nid].add(md5sum)
+                    key.append(nid)
+        else:
+            key = self._facet_value(table, entry)
+            self.facet[table][key].add(md5sum)
+        self.keys.setdefault(md5sum, {})[table] = key
+        return
+
+    def add(self, md5sum, entry):
+        self.remove(md5sum)
+        for table in self.built:
+            self._index(table, md5sum, entry)
+        return
+
+    def remove(self, md5sum):
+        keys = self.keys.pop(md5sum, {})
+        for table, key in keys.items():
+            if table == 'names':
+                for nid in key:
+                    self.name_md5s[nid].discard(md5sum)
+                continue
+            md5s = self.facet[table].get(key)
+            if md5s is not None:
+                md5s.discard(md5sum)
+                if not md5s:
+                    del self.facet[table][key]
+        for index in self.sorted.values():
+            index.remove(md5sum)
+        return
+
+    def text(self, text):
+        """ md5sums with text as a substring of their title or show """
+        self.build(('names',))
+        grams = trigrams(text)
+        if grams:
+            # Every match contains every trigram, so the rarest one is
+            # enough to find them all, the rest are weeded out below
+            postings = [self.postings.get(t) for t in grams]
+            if any(p is None for p in postings):
+                return set()
+            nids = min(postings, key=len)
+        else:
+            nids = range(len(self.names))
+        found = set()
+        for nid in nids:
+            if self.name_md5s[nid] and text in self.names[nid]:
+                found.update(self.name_md5s[nid])
+        return found
+
+    def _lookup(self, facet, value):
+        if self._ready(facet):
+            return self.facet[facet].get(value, set())
+        return set(md5 for md5, entry in self.entries().items()
+                   if self._facet_value(facet, entry) == value)
+
+    def fingerprint(self, fingerprint):
+        """ md5sums of entries with this content fingerprint """
+        if not fingerprint:
+            return set()
+        return self._lookup('fingerprint', fingerprint)
+
+    def inode(self, dev, inode):
+        """ md5sums of entries last seen at this device and inode """
+        return self._lookup('inode', inode_key(dev, inode))
+
+    def search(self, text=None, show=None, season=None, episode=None,
+               year=None, resolution=None, ranges=None):
+        """ Set of md5sums that may match, or None if nothing narrows the
+            search down.  Callers still apply their own filters.  ranges
+            maps RAW_FIELDS to (low, high) bounds, see SortedIndex.range().
+        """
+        facets = {}  # facet -> values matching
+        if show:
+            facets['show'] = (show,)
+        if season:
+            facets['season'] = (int(season),)
+        if episode:
+            facets['episode'] = (int(episode),)
+        if year:
+            facets['year'] = (year,)
+        if resolution:
+            # Entries without a video track aren't filtered on resolution
+            facets['resolution'] = (resolution, None)
+        ranges = ranges or {}
+        text = (text or "").lower()
+        if not facets and not ranges and not text:
+            return None
+        tables = list(facets) + list(ranges)
+        if text and not tables:
+            tables.append('names')
+        if not all([self._ready(t) for t in tables]):
+            return self._scan(text, facets, ranges)
+        if tables == ['names']:
+            return self.text(text)
+        sets = [self.sorted[f].range(low, high) for f, (low, high) in ranges.items()]
+        for f, values in facets.items():
+            sets.append(set().union(*(self.facet[f].get(v, ()) for v in values)))
+        sets.sort(key=len)
+        found = sets[0]
+        for s in sets[1:]:
+            found &= s
+        if text:
+            if len(found) >= 64 and 'names' in self.built:
+                found &= self.text(text)
+            else:
+                # Cheaper to check a handful of names than walk postings
+                entries = self.entries()
+                found = set(md5 for md5 in found if self._matches(entries[md5], text))
+        return found
+
+    def _scan(self, text, facets, ranges):
+        """ search() by looking at every entry, for tables not built yet.
+            Each condition weeds out what the ones before it left.
+        """
+        found = self.entries().items()
+        for f, values in facets.items():
+            value = self._facet_value
+            found = [(m, e) for m, e in found if value(f, e) in values]
+        for f, (low, high) in ranges.items():
+            found = [(m, e) for m, e in found if _within(e.get(f), low, high)]
+        if text:
+            found = [(m, e) for m, e in found if text in (e.get('title') or "").lower() or
+                     text in (e.get('show') or "").lower()]
+        return set(m for m, e in found)
+
+    def ordered(self, field, md5s=None, top=None):
+        """ Yield md5s, or every md5sum, largest field first, those without
+            a value for field last.  With top, until the field's table is
+            built, only the top largest are picked out and the rest follow in
+            no particular order, which saves sorting everything for a listing.
+        """
+        if top and not self._ready(field):
+            entries = self.entries()
+            if md5s is None:
+                md5s = list(entries)
+            largest = helpers.largest(field)
+            best = heapq.nlargest(top, md5s, key=lambda md5: largest(entries[md5]))
+            for md5 in best:
+                yield md5
+            best = set(best)
+            for md5 in md5s:
+                if md5 not in best:
+                    yield md5
+            return
+        self.build((field,))  # Sorting is most of the work of building it
+        index = self.sorted[field]
+        for md5 in index.descending(md5s):
+            yield md5
+        for md5 in (list(self.entries()) if md5s is None else md5s):
+            if md5 not in index.values:
+                yield md5
+        return
+
+    def _matches(self, entry, text):
+        return any(text in value.lower() for value in
+                   (entry.get('title'), entry.get('show')) if value)
+
+
+def _within(value, low, high):
+    """ SortedIndex.range()'s test for one value """
+    return (value is not None and (low is None or value >= low) and
+            (high is None or value <= high))
@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+import os
+import json
+import heapq
+import logging
+import itertools
+import concurrent.futures
+import helpers
+from jsondb import JsonDB, gc_paused
+from locking import FileLock, LockTimeout
+
+
+class ShardedDB(object):
+    """ A directory of JsonDB shards, one per show, keyed by the show's
+        helpers.normalize_name(), with manifest.json listing them and their
+        entry counts.  Shards are loaded the first time they're needed, so
+        a search for one show only reads that show's file.  Anything that
+        isn't narrowed to a show (text searches, md5sum and path lookups,
+        scans) loads every shard, several at a time.  Saving only writes
+        the shards that changed, each through its own journal.
+
+        Each shard is locked like any JsonDB.  The manifest has a lock of
+        its own, and is merged with the one on disk when saved, so shows
+        another process added aren't lost.
+    """
+
+    extensions = ('.shards',)
+    manifest_version = 1
+
+    def __init__(self, filename, compact_records=False):
+        self.log = logging.getLogger()
+        self.filename = filename
+        self.manifestfile = os.path.join(filename, "manifest.json")
+        self.manifest = {}   # show key -> {"file", "show", "count"}
+        self.shards = {}     # show key -> loaded JsonDB
+        self.owner = {}      # md5sum -> show key, for the loaded shards
+        self.paths = {}      # filename -> show key, for the loaded shards
+        self.all_loaded = False
+        self.manifest_dirty = False
+        self.compact_records = compact_records
+        self.journal = True
+        self.snapshot_format = None  # Keep each shard's format
+        self.write_immediate = False
+        self.save_interval = 20
+        self.open = False
+        self.load_threads = 8
+        self.load(filename)
+
+    @classmethod
+    def handles(cls, filename):
+        """ True if filename should be opened with ShardedDB """
+        return filename.rstrip(os.sep).lower().endswith(cls.extensions)
+
+    @property
+    def dirty(self):
+        return self.manifest_dirty or any(s.dirty for s in self.shards.values())
+
+    def load(self, filename=None):
+        filename = filename or self.filename
+        try:
+            if os.path.isfile(self.manifestfile):
+                with self._manifestlock().shared():
+                    self.manifest = self._read_manifest()
+            self.open = True  # A missing directory is a new, empty database
+        except Exception as e:
+            self.log.error("unable to read db=%s: %s", filename, e)
+        return self.open
+
+    def _manifestlock(self):
+        return FileLock("%s.lock" % self.manifestfile, JsonDB.lock_timeout)
+
+    def _read_manifest(self):
+        with open(self.manifestfile, 'r') as fh:
+            manifest = json.load(fh)
+        if manifest.get("version") != self.manifest_version:
+            raise ValueError("unsupported manifest version %s" % manifest.get("version"))
+        return manifest["shards"]
+
+    def _merge_manifest(self):
+        """ Take in shards other processes added since we read the
+            manifest.  Our loaded shards know their own counts, the rest
+            keep what's on disk.
+        """
+        if not os.path.isfile(self.manifestfile):
+            return
+        for key, info in self._read_manifest().items():
+            if key in self.shards:
+                if self.manifest[key]['show'] is None:
+                    self.manifest[key]['show'] = info['show']
+            else:
+                if key not in self.manifest:
+                    self.all_loaded = False
+                self.manifest[key] = info
+        return
+
+    def index(self):
+        # Each shard indexes itself as it's loaded
+        return self.open
+
+    def key(self, struct):
+        return helpers.normalize_name(struct.get('show') or "")
+
+    def _open_shard(self, key):
+        info = self.manifest.get(key) or {"file": "%s.json" % (key or "_")}
+        shard = JsonDB(os.path.join(self.filename, info['file']),
+                       compact_records=self.compact_records)
+        shard.log = self.log
+        return shard
+
+    def _adopt(self, key, shard):
+        """ Make a freshly loaded shard part of the database """
+        shard.journal = self.journal
+        if self.snapshot_format:
+            shard.snapshot_format = self.snapshot_format
+        self.shards[key] = shard
+        for md5sum, details in shard.db.items():
+            self.owner[md5sum] = key
+        for path in shard.path_index:
+            self.paths[path] = key
+        return shard
+
+    def shard(self, key, create=False):
+        """ The JsonDB for show key, loading it if needed.  None if there's
+            no such shard, unless create is set.
+        """
+        if key in self.shards:
+            return self.shards[key]
+        if key not in self.manifest and not create:
+            return None
+        if not os.path.isdir(self.filename):
+            os.makedirs(self.filename)
+        shard = self._adopt(key, self._open_shard(key))
+        if key not in self.manifest:
+            self.manifest[key] = {"file": os.path.basename(shard.filename), "show": None,
+                                  "count": 0}
+            self.manifest_dirty = True
+        return shard
+
+    def load_all(self):
+        """ Load every shard not loaded yet, load_threads at a time """
+        if self.all_loaded:
+            return
+        keys = [k for k in self.manifest if k not in self.shards]
+        if keys:
+            with gc_paused(), concurrent.futures.ThreadPoolExecutor(self.load_threads) as pool:
+                for key, shard in zip(keys, pool.map(self._open_shard, keys)):
+                    self._adopt(key, shard)
+            self.log.debug("db: loaded (%d) shards from %s", len(keys), self.filename)
+        self.all_loaded = True
+        return
+
+    def _owner(self, md5sum):
+        """ The loaded shard holding md5sum, or None """
+        key = self.owner.get(md5sum)
+        if key is None and not self.all_loaded:
+            self.load_all()
+            key = self.owner.get(md5sum)
+        return self.shards[key] if key is not None else None
+
+    def _counted(self, key):
+        info = self.manifest[key]
+        shard = self.shards[key]
+        if info['count'] != shard.count():
+            info['count'] = shard.count()
+            self.manifest_dirty = True
+        return
+
+    def add(self, struct, filename, md5sum=""):
+        key = self.key(struct)
+        old = self._owner(md5sum) if md5sum else None
+        if old is not None and self.owner[md5sum] != key:
+            self.remove(md5sum)
+        shard = self.shard(key, create=True)
+        if not shard.add(struct, filename, md5sum):
+            return False
+        md5sum = md5sum or struct.get('md5sum')
+        self.owner[md5sum] = key
+        self.paths[filename] = key
+        info = self.manifest[key]
+        if info['show'] is None and struct.get('show'):
+            info['show'] = struct['show']
+        self._counted(key)
+        if self.write_immediate:
+            self.save()
+        return True
+
+    def remove(self, md5sum=None):
+        shard = self._owner(md5sum) if md5sum else None
+        if shard is not None:
+            details = shard.get(md5sum)
+            if self.paths.get(details['filename']) == self.owner[md5sum]:
+                del self.paths[details['filename']]
+            key = self.owner.pop(md5sum)
+            shard.remove(md5sum=md5sum)
+            self._counted(key)
+        elif md5sum:
+            self.log.error("db: remove hash=%s failed, no such hash!", md5sum)
+        if self.write_immediate:
+            self.save()
+        return
+
+    def get(self, md5sum):
+        shard = self._owner(md5sum)
+        return shard.get(md5sum) if shard is not None else None
+
+    def get_path(self, path):
+        key = self.paths.get(path)
+        if key is None and not self.all_loaded:
+            self.load_all()
+            key = self.paths.get(path)
+        return self.shards[key].get_path(path) if key is not None else None
+
+    def update(self, md5sum, struct):
+        """ Store changes made to an existing entry, moving it to another
+            shard if its show changed
+        """
+        key = self.key(struct)
+        if self.owner.get(md5sum, key) != key:
+            self.remove(md5sum)
+            self.add(struct, struct['filename'], md5sum)
+            return
+        self.shard(key, create=True).update(md5sum, struct)
+        self.owner[md5sum] = key
+        self.paths[struct['filename']] = key
+        self._counted(key)
+        if self.write_immediate:
+            self.save()
+        return
+
+    def get_inode(self, dev, inode):
+        """ Entries last seen at this device and inode """
+        self.load_all()
+        return list(itertools.chain.from_iterable(
+            s.get_inode(dev, inode) for s in self.shards.values()))
+
+    def get_fingerprint(self, fingerprint):
+        """ Entries whose content probably matches fingerprint """
+        self.load_all()
+        return list(itertools.chain.from_iterable(
+            s.get_fingerprint(fingerprint) for s in self.shards.values()))
+
+    def move(self, md5sum, struct, oldpath):
+        """ Store an entry whose filename changed from oldpath """
+        key = self.key(struct)
+        if self.owner.get(md5sum, key) != key:
+            self.remove(md5sum)
+            self.add(struct, struct['filename'], md5sum)
+            return
+        if self.paths.get(oldpath) == key:
+            del self.paths[oldpath]
+        self.paths[struct['filename']] = key
+        self.shards[key].move(md5sum, struct, oldpath)
+        if self.write_immediate:
+            self.save()
+        return
+
+    def entries(self):
+        """ Iterate over (md5sum, entry) for the whole database """
+        self.load_all()
+        return itertools.chain.from_iterable(
+            s.entries() for s in list(self.shards.values()))
+
+    def candidates(self, text=None, show=None, season=None, episode=None,
+                   year=None, resolution=None, ranges=None, order=None,
+                   top=None):
+        """ Entries that may match a search, see JsonDB.candidates().  A
+            show key only loads and searches that show's shard.  Otherwise
+            every shard is searched, and with an order their results are
+            merged, largest first.  Each shard's top largest are among its
+            first top results, so the merged first top are still in order.
+        """
+        if show:
+            shard = self.shard(show)
+            if shard is None:
+                return iter([])
+            shards = [shard]
+        else:
+            self.load_all()
+            shards = list(self.shards.values())
+        found = [s.candidates(text, show, season, episode, year, resolution,
+                              ranges, order, top) for s in shards]
+        if not order:
+            return itertools.chain.from_iterable(found)
+        return heapq.merge(*found, key=helpers.largest(order), reverse=True)
+
+    def count(self):
+        return sum(self.shards[k].count() if k in self.shards else info['count']
+                   for k, info in self.manifest.items())
+
+    def migrate(self, jsonfile):
+        """ One-shot import of every entry of a JsonDB database, journal
+            included, into shards
+        """
+        source = JsonDB(jsonfile)
+        if not source.open:
+            return 0
+        write_immediate, self.write_immediate = self.write_immediate, False
+        self.load_all()
+        try:
+            count = 0
+            for md5sum, struct in source.entries():
+                self.add(struct, struct['filename'], md5sum)
+                count += 1
+            self.save()
+        finally:
+            self.write_immediate = write_immediate
+        self.log.info("db: migrated (%d) entries from %s into (%d) shards in %s",
+                      count, jsonfile, len(self.manifest), self.filename)
+        return count
+
+    def _write_manifest(self):
+        if not os.path.isdir(self.filename):
+            os.makedirs(self.filename)
+        tmpfile = "%s.tmp" % self.manifestfile
+        try:
+            with self._manifestlock().exclusive():
+                self._merge_manifest()
+                with open(tmpfile, 'w') as fh:
+                    json.dump({"version": self.manifest_version, "shards": self.manifest},
+                              fh, indent=1, sort_keys=True)
+                    fh.flush()
+                    os.fsync(fh.fileno())
+                os.rename(tmpfile, self.manifestfile)
+            self.manifest_dirty = False
+        except LockTimeout as e:
+            self.log.error("db: manifest not saved, will retry on the next save: %s", e)
+        except Exception as e:
+            self.log.error("unable to write manifest=%s: %s", self.manifestfile, e)
+            if os.path.isfile(tmpfile):
+                os.unlink(tmpfile)
+        return
+
+    def save(self, filename=None):
+        """ Save the shards that changed, then the manifest """
+        if not self.open:
+            return
+        saved = 0
+        for key, shard in self.shards.items():
+            if self.snapshot_format:
+                shard.snapshot_format = self.snapshot_format
+            if shard.dirty or shard.snapshot_format != shard.loaded_format:
+                shard.save()
+                self._counted(key)  # The save merged in other processes' changes
+                saved += 1
+        if saved:
+            self.log.info("db: saved (%d) of (%d) shards", saved, len(self.manifest))
+        if self.manifest_dirty:
+            self._write_manifest()
+        return
+
+    def clean_invalid(self):
+        self.load_all()
+        for shard in self.shards.values():
+            shard.clean_invalid()
+        for key in self.shards:
+            self._counted(key)
+        return
+
+    def close(self, save=False):
+        if not self.open:
+            return
+        if save or self.dirty or self.snapshot_format:
+            self.save()
+        for shard in self.shards.values():
+            shard.clear()
+            shard.open = False
+        self.shards = {}
+        self.owner = {}
+        self.paths = {}
+        self.all_loaded = False
+        self.open = False
+        return
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+import time
+import json
+import heapq
+import cProfile
+import contextlib
+import collections
+import helpers
+from tables import Printer
+
+
+class Stats(object):
+    """ Where a run's time went: wall and cpu seconds, calls and bytes for
+        each phase (walk, sidecar, hash, probe, save, ...), plain counters,
+        and the slowest files of each phase.  Recording is cheap enough to
+        always be on, the tools only report it when asked with --stats or
+        --stats-file.
+
+        Phases timed in worker processes (hash, probe) are added up from
+        what the workers report, so their wall time can exceed the run's.
+    """
+
+    def __init__(self, slowest=10):
+        self.slowest = slowest
+        self.started = time.time()
+        self.phases = collections.OrderedDict()  # name -> [calls, wall, cpu, bytes]
+        self.counts = collections.Counter()
+        self.files = collections.defaultdict(list)  # name -> heap of (seconds, path, bytes)
+        self.profiler = None
+
+    def add(self, name, wall, cpu=None, calls=1, nbytes=None):
+        """ Account wall (and cpu) seconds, and bytes, to phase name """
+        phase = self.phases.get(name)
+        if phase is None:
+            phase = self.phases[name] = [0, 0.0, None, None]
+        phase[0] += calls
+        phase[1] += wall
+        if cpu is not None:
+            phase[2] = (phase[2] or 0.0) + cpu
+        if nbytes is not None:
+            phase[3] = (phase[3] or 0) + nbytes
+        return
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """ Time the with block as one call of phase name """
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - wall, time.process_time() - cpu)
+
+    def iterate(self, name, iterable):
+        """ Yield from iterable, timing only the work of producing each
+            item as phase name, one call per item
+        """
+        iterator = iter(iterable)
+        while True:
+            wall, cpu = time.perf_counter(), time.process_time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(name, time.perf_counter() - wall, time.process_time() - cpu, calls=0)
+                return
+            self.add(name, time.perf_counter() - wall, time.process_time() - cpu)
+            yield item
+
+    def file(self, name, path, seconds, nbytes=None):
+        """ Remember path if it's one of the slowest of phase name """
+        heap = self.files[name]
+        item = (seconds, path, nbytes)
+        if len(heap) < self.slowest:
+            heapq.heappush(heap, item)
+        elif seconds > heap[0][0]:
+            heapq.heapreplace(heap, item)
+        return
+
+    def count(self, name, n=1):
+        self.counts[name] += n
+        return
+
+    @contextlib.contextmanager
+    def profiling(self, filename):
+        """ Run the with block under cProfile if filename is set, adding to
+            the same profile on every use and writing it out to filename
+            in pstats format each time
+        """
+        if not filename:
+            yield
+            return
+        if self.profiler is None:
+            self.profiler = cProfile.Profile()
+        self.profiler.enable()
+        try:
+            yield
+        finally:
+            self.profiler.disable()
+            self.profiler.dump_stats(filename)
+
+    def ratios(self):
+        """ Share of walked files skipped as unchanged, and of MediaInfo
+            results that came from the cache
+        """
+        ratios = {}
+        walked = self.phases.get("walk", [0])[0]
+        if walked:
+            ratios["skipped"] = self.counts["skipped"] / float(walked)
+        probes = self.counts["cached"] + self.phases.get("probe", [0])[0]
+        if probes:
+            ratios["cache_hits"] = self.counts["cached"] / float(probes)
+        return ratios
+
+    def report(self):
+        phases = collections.OrderedDict()
+        for name, (calls, wall, cpu, nbytes) in self.phases.items():
+            phase = {"calls": calls, "wall": round(wall, 6)}
+            if cpu is not None:
+                phase["cpu"] = round(cpu, 6)
+            if nbytes is not None:
+                phase["bytes"] = nbytes
+                phase["mb_per_s"] = round(nbytes / 1048576.0 / max(wall, 0.000001), 3)
+            phases[name] = phase
+        slowest = dict((name, [{"path": p, "seconds": round(s, 6), "bytes": b}
+                               for s, p, b in sorted(heap, reverse=True)])
+                       for name, heap in self.files.items())
+        return {"elapsed": round(time.time() - self.started, 6), "phases": phases,
+                "counts": dict(self.counts), "ratios": self.ratios(),
+                "slowest": slowest}
+
+    def summary(self):
+        """ The report as text tables """
+        report = self.report()
+        t = Printer(sort=False)
+        t.set_header(["Phase", "Calls", "Wall", "CPU", "Size", "Rate"], justification=">")
+        t.justification["Phase"] = "<"
+        for name, p in report["phases"].items():
+            t.add_row([name, str(p["calls"]), "%.2fs" % p["wall"],
+                       "%.2fs" % p["cpu"] if "cpu" in p else "--",
+                       helpers.bytes_to_human(p["bytes"]) if "bytes" in p else "--",
+                       "%.1fMB/s" % p["mb_per_s"] if "bytes" in p else "--"])
+        output = "stats: elapsed %.1fs\n" % report["elapsed"]
+        output += t.dump(header_underline=True, footer=False) if t.count else ""
+        if report["counts"]:
+            output += "counts: %s\n" % " ".join(
+                "%s=%d" % kv for kv in sorted(report["counts"].items()))
+        if report["ratios"]:
+            output += "ratios: %s\n" % " ".join(
+                "%s=%.1f%%" % (k, 100 * v) for k, v in sorted(report["ratios"].items()))
+        for name, files in sorted(report["slowest"].items()):
+            output += "slowest %s:\n" % name
+            for f in files:
+                output += "  %8.2fs %10s  %s\n" % (
+                    f["seconds"], helpers.bytes_to_human(f["bytes"]) if f["bytes"] is not None else "--",
+                    f["path"])
+        return output
+
+    def write(self, filename):
+        with open(filename, 'w') as fh:
+            json.dump(self.report(), fh, indent=2)
+            fh.write("\n")
+        return
+
+
+# Shared by every module of a run, like the root logger
+STATS = Stats()
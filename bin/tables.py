@@ -1,16 +1,49 @@
+import csv
+import json
+import heapq
 import logging
+import itertools
+
+
+class _Descending(object):
+    """ Sort key wrapper that orders largest first, so a heap of them pops
+        the largest key and keeps the smallest ones
+    """
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        return self.key > other.key
 
 
 class Printer():
+    """ Tables of rows, sorted by key and padded to the widest value in each
+        column.  With a limit only the first offset + limit rows in sort
+        order are ever held, in a heap, so memory stays bounded however many
+        rows are added (only their keys are kept, to count them); limit and
+        offset page through the sorted rows.  A key added twice keeps its
+        last row either way.
+        write() streams the table to a file object, dump() returns it.
+    """
 
-    def __init__(self):
+    def __init__(self, limit=0, offset=0, sort=True, reverse=False):
         self.header = []
         self.columns = 0
         self.rows = 0
         self.width = 0
         self.lengths = {}
         self.justification = {}
-        self.data = {}
+        self.limit = limit
+        self.offset = offset
+        self.sort = sort
+        self.reverse = reverse
+        # key -> row, or with a limit a heap of (sort key, seq, row)
+        self.data = {} if not limit else []
+        self.keys = set()  # Keys added with a limit, the dict has them otherwise
+        self.count = 0   # Rows added, including any the limit dropped
+        self.seq = itertools.count()
 
     def clear(self):
         """ Clear, start over """
@@ -18,7 +51,9 @@ class Printer():
         self.columns = 0
         self.rows = 0
         self.lengths = {}
-        self.data = {}
+        self.data = {} if not self.limit else []
+        self.keys = set()
+        self.count = 0
         return
 
     def add_data(self, row_values, key=None):
@@ -30,14 +65,45 @@ class Printer():
             logging.error("add_row: failed, row_values=%d != columns=%d!",
                           len(row_values), self.columns)
             return False
-        self.update_lengths(row_values)
         if not key:
-            self.data[str(self.rows)] = row_values
+            key = str(self.rows)
             self.rows += 1
-        else:
+        if not self.limit:
+            # A key added twice keeps its last row, as it always has
+            self.count += key not in self.data
             self.data[key] = row_values
+            return self.rows
+        if key in self.keys:
+            self._replace(key, row_values)
+            return self.rows
+        self.keys.add(key)
+        self.count += 1
+        keep = self.offset + self.limit
+        if not self.sort:
+            if len(self.data) < keep:
+                self.data.append((key, row_values))
+            return self.rows
+        item = (key if self.reverse else _Descending(key), next(self.seq), row_values)
+        if len(self.data) < keep:
+            heapq.heappush(self.data, item)
+        else:
+            heapq.heappushpop(self.data, item)
         return self.rows
 
+    def _replace(self, key, row_values):
+        """ Swap in the row of a key added again, if the limit kept it.  It
+            sorts the same as before, so it stays wherever it is.
+        """
+        for idx, item in enumerate(self.data):
+            if not self.sort:
+                if item[0] == key:
+                    self.data[idx] = (key, row_values)
+                    return
+            elif (item[0] if self.reverse else item[0].key) == key:
+                self.data[idx] = (item[0], item[1], row_values)
+                return
+        return
+
     def update_lengths(self, row_values):
         """ Update column widths for given row values to max """
         for idx, v in enumerate(row_values):
@@ -54,6 +120,7 @@ class Printer():
     def add_header(self, name, justification="<", length=None):
         """ Build the header one column at a time, specifying justification """
         self.header.append(name)
+        self.columns = len(self.header)
         if length:
             self.lengths[name] = length
         else:
@@ -71,19 +138,56 @@ class Printer():
         for h in header:
             self.lengths[h] = len(h)
             self.justification[h] = justification
-        self.data = {}
+        self.data = {} if not self.limit else []
+        self.keys = set()
+        self.count = 0
         return
 
-    def dump(self, sort=True, reverse=False, header_underline=False, padding="  ",
+    def sorted_rows(self, sort=None, reverse=None):
+        """ The rows to print, in order, after offset and limit """
+        sort = self.sort if sort is None else sort
+        reverse = self.reverse if reverse is None else reverse
+        if not self.limit:
+            data = list(self.data.items())
+        elif self.sort:
+            data = [(k if self.reverse else k.key, r) for k, s, r in self.data]
+        else:
+            data = self.data
+        if sort:
+            data = sorted(data, key=lambda d: d[0], reverse=reverse)
+        return [r for k, r in data[self.offset:]]
+
+    def dump(self, sort=None, reverse=None, header_underline=False, padding="  ",
              footer=True, count=True):
         """ Dump the output """
+        return "".join(self.lines(sort, reverse, header_underline, padding,
+                                  footer, count))
+
+    def write(self, stream, sort=None, reverse=None, header_underline=False,
+              padding="  ", footer=True, count=True, batch=1000):
+        """ Write the output to stream, batch lines at a time """
+        lines = self.lines(sort, reverse, header_underline, padding, footer, count)
+        while True:
+            chunk = "".join(itertools.islice(lines, batch))
+            if not chunk:
+                break
+            stream.write(chunk)
+        return
+
+    def lines(self, sort=None, reverse=None, header_underline=False, padding="  ",
+              footer=True, count=True):
+        """ Yield the output a line at a time """
         if header_underline and padding == "  ":
             padding = " | "
-        output = self.dump_header(header_underline, padding)
-        output += self.dump_data(sort, reverse, padding)
+        rows = self.sorted_rows(sort, reverse)
+        for row in rows:
+            self.update_lengths(row)
+        yield self.dump_header(header_underline, padding)
+        for line in self.iter_data(rows, padding):
+            yield line
         if footer:
-            output += self.dump_footer(count)
-        return output
+            yield self.dump_footer(count)
+        return
 
     def dump_header(self, header_underline=False, padding="  "):
         """ Dump out just the header """
@@ -108,31 +212,80 @@ class Printer():
 
     def dump_footer(self, count=True):
         if count:
-            count_out = " Total (%d) --" % len(self.data)
+            count_out = " Total (%d) --" % self.count
             count_len = len(count_out)
             return "+" + "-" * (self.width - count_len) + count_out + "+\n"
         else:
             return "+" + "-" * (self.width) + "+\n"
 
-
-    def dump_data(self, sort=True, reverse=False, padding="  "):
+    def dump_data(self, sort=None, reverse=None, padding="  "):
         """ Dump out just the data """
-        output = ""
-        data_keys = self.data.keys()
-        if sort:
-            data_keys.sort(reverse=reverse)
-        for k in data_keys:
-            fields = []
-            for idx, d in enumerate(self.data[k]):
-                hdr = self.header[idx]
-                fields.append("{%d:%s%ds}" % (idx, self.justification[hdr],
-                                              self.lengths[hdr]))
-
-            format_line = padding.join(fields)
-            line = format_line.format(*self.stringify(self.data[k]))
-            output += "|%s|\n" % line
-        return output
+        rows = self.sorted_rows(sort, reverse)
+        return "".join(self.iter_data(rows, padding))
+
+    def iter_data(self, rows, padding="  "):
+        """ Yield each of rows as a line.  The format is compiled once;
+            widths count utf8 bytes, so rows with anything but ascii in them
+            are padded by hand to line up the same way.
+        """
+        specs = [(self.justification[h], self.lengths[h]) for h in self.header]
+        format_line = "|%s|\n" % padding.join(
+            "{%d:%s%ds}" % (idx, just, length)
+            for idx, (just, length) in enumerate(specs))
+        for row in rows:
+            values = self.stringify(row)
+            if all(v.isascii() for v in values):
+                yield format_line.format(*values)
+            else:
+                yield "|%s|\n" % padding.join(
+                    self.pad(v, just, length)
+                    for v, (just, length) in zip(values, specs))
+        return
+
+    def pad(self, value, justification, length):
+        """ Justify value in length utf8 bytes """
+        fill = length - len(value.encode("utf8"))
+        if fill <= 0:
+            return value
+        if justification == ">":
+            return " " * fill + value
+        if justification == "^":
+            return " " * (fill // 2) + value + " " * (fill - fill // 2)
+        return value + " " * fill
 
     def stringify(self, input_list):
         """ Convert a list of X to a list of strings """
-        return [i.encode("utf8").strip() for i in input_list]
+        return [("" if i is None else str(i)).strip() for i in input_list]
+
+
+class RecordWriter():
+    """ Results for other programs, written to stream one at a time as
+        they're produced: json lines, or csv or tsv with a header row.
+        Each record is a dict, only fields are written, in that order.
+    """
+
+    FORMATS = ("jsonl", "csv", "tsv")
+
+    def __init__(self, stream, format, fields):
+        if format not in self.FORMATS:
+            raise ValueError("unknown format %s, choose from %s" % (
+                format, ",".join(self.FORMATS)))
+        self.stream = stream
+        self.format = format
+        self.fields = fields
+        self.rows = 0
+        self.writer = None
+        if format == "csv":
+            self.writer = csv.writer(stream)
+        elif format == "tsv":
+            self.writer = csv.writer(stream, delimiter="\t", lineterminator="\n")
+        if self.writer:
+            self.writer.writerow(fields)
+
+    def write(self, record):
+        if self.writer:
+            self.writer.writerow([record.get(f) for f in self.fields])
+        else:
+            self.stream.write(json.dumps(dict((f, record.get(f)) for f in self.fields)) + "\n")
+        self.rows += 1
+        return self.rows
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+import os
+import stat
+import logging
+import concurrent.futures
+
+
+class FileEntry(object):
+    """ What the scan pipeline needs to know about one file, taken from a
+        single stat (the DirEntry's when walking)
+    """
+
+    __slots__ = ('path', 'dirpath', 'name', 'extension', 'size', 'mtime_ns',
+                 'inode', 'dev')
+
+    def __init__(self, dirpath, name, st):
+        self.path = os.path.join(dirpath, name)
+        self.dirpath = dirpath
+        self.name = name
+        self.extension = name.split('.')[-1].lower()
+        self.size = st.st_size
+        self.mtime_ns = st.st_mtime_ns
+        self.inode = st.st_ino
+        self.dev = st.st_dev
+
+    def stat_info(self):
+        """ The parts of the stat that tell us a file is unchanged """
+        return {"size": self.size, "mtime_ns": self.mtime_ns,
+                "inode": self.inode, "dev": self.dev}
+
+    def __repr__(self):
+        return "FileEntry(%r)" % self.path
+
+
+def entry(path):
+    """ FileEntry for a single path, None if it isn't a regular file """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    dirpath, name = os.path.split(path)
+    return FileEntry(dirpath, name, st)
+
+
+def listdir(path, extensions=None, ext_skip=(), on_skip=None):
+    """ One directory's (subdirs, FileEntries).  Extensions are filtered
+        on the name alone so skipped files never get a stat.  Unreadable
+        directories are skipped, same as os.walk.
+    """
+    dirs = []
+    files = []
+    try:
+        with os.scandir(path) as it:
+            for de in it:
+                if de.is_dir(follow_symlinks=False):
+                    dirs.append(de.path)
+                    continue
+                extension = de.name.split('.')[-1].lower()
+                if extension in ext_skip:
+                    continue
+                if extensions and extension not in extensions:
+                    if on_skip:
+                        on_skip(de.path)
+                    continue
+                try:
+                    if not de.is_file():
+                        continue
+                    files.append(FileEntry(path, de.name, de.stat()))
+                except OSError:
+                    continue  # Vanished or a dangling link
+    except OSError as e:
+        logging.getLogger().debug("walk: unable to list %s: %s", path, e)
+    return dirs, files
+
+
+def walk(top, extensions=None, ext_skip=(), threads=1, on_skip=None):
+    """ Yield a FileEntry for every file under top with one of extensions
+        (all files if extensions is None), never descending into symlinked
+        directories.  With threads > 1 directories are listed in parallel,
+        overlapping the round trips of network filesystems, and files come
+        out in no particular order.
+    """
+    top = os.path.abspath(top)
+    if threads <= 1:
+        stack = [top]
+        while stack:
+            dirs, files = listdir(stack.pop(), extensions, ext_skip, on_skip)
+            for f in files:
+                yield f
+            stack.extend(reversed(dirs))
+        return
+
+    pool = concurrent.futures.ThreadPoolExecutor(threads)
+    pending = set([pool.submit(listdir, top, extensions, ext_skip, on_skip)])
+    try:
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                dirs, files = future.result()
+                for d in dirs:
+                    pending.add(pool.submit(listdir, d, extensions, ext_skip, on_skip))
+                for f in files:
+                    yield f
+    finally:
+        for future in pending:
+            future.cancel()
+        pool.shutdown()
+    return
+
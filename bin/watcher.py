@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+import os
+import time
+import errno
+import struct
+import select
+import logging
+import ctypes
+import ctypes.util
+import walker
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+EVENT = struct.Struct("iIII")  # wd, mask, cookie, len
+
+
+class Inotify(object):
+    """ Just enough of inotify(7) through ctypes to watch directories """
+
+    mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                           use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self.fd = libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.paths = {}  # watch descriptor -> directory
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path):
+        wd = self._add_watch(self.fd, os.fsencode(path), self.mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, "%s: %s" % (os.strerror(err), path))
+        self.paths[wd] = path
+        return wd
+
+    def read(self):
+        """ Pending events as (directory, name, mask) """
+        events = []
+        try:
+            data = os.read(self.fd, 256 * 1024)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return events
+            raise
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if mask & IN_IGNORED:
+                self.paths.pop(wd, None)
+                continue
+            events.append((self.paths.get(wd), os.fsdecode(name), mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+        return
+
+
+class Watcher(object):
+    """ Wait for video files to land under top and hand them to callback
+        as a list of walker.FileEntry once they stop changing.
+
+        Uses inotify when it can, otherwise polls directory mtimes every
+        poll seconds (a directory's mtime moves when entries are added or
+        renamed in it).  Either way an idle library costs next to nothing.
+        A file is only handed over once its size and mtime have held still
+        for settle seconds, so files still being copied aren't hashed.
+    """
+
+    def __init__(self, top, callback, extensions=None, ext_skip=(),
+                 settle=5.0, poll=0, log=None):
+        self.top = os.path.abspath(top)
+        self.callback = callback
+        self.extensions = extensions
+        self.ext_skip = ext_skip
+        self.settle = settle
+        self.poll = poll
+        self.log = log or logging.getLogger()
+        self.inotify = None
+        self.dirs = {}     # directory -> mtime_ns, when polling
+        self.known = {}    # directory -> {name: (size, mtime_ns)}, when polling
+        self.pending = {}  # path -> (due, (size, mtime_ns) or None)
+        self.next_poll = 0
+        self.stopped = False
+
+    def start(self):
+        if not self.poll:
+            try:
+                self.inotify = Inotify()
+                self._watch_tree(self.top, queue=False)
+                self.log.info("watch: watching (%d) directories under %s with inotify",
+                              len(self.inotify.paths), self.top)
+                return
+            except (OSError, AttributeError) as e:
+                self.log.warning("watch: inotify unavailable (%s), polling instead", e)
+                if self.inotify:
+                    self.inotify.close()
+                    self.inotify = None
+                self.poll = 60
+        self._poll_tree([self.top], queue=False)
+        self.next_poll = time.time() + self.poll
+        self.log.info("watch: polling (%d) directories under %s every %ds",
+                      len(self.dirs), self.top, self.poll)
+        return
+
+    def stop(self):
+        self.stopped = True
+        return
+
+    def run(self):
+        self.start()
+        try:
+            while not self.stopped:
+                timeout = self._timeout()
+                if self.inotify:
+                    ready, _, _ = select.select([self.inotify], [], [], timeout)
+                    if ready:
+                        self._events()
+                else:
+                    if timeout:
+                        time.sleep(timeout)
+                    if time.time() >= self.next_poll:
+                        self._poll_tree(list(self.dirs))
+                        self.next_poll = time.time() + self.poll
+                self._flush()
+        finally:
+            if self.inotify:
+                self.inotify.close()
+        return
+
+    def _timeout(self):
+        """ Seconds until something is due, None to sleep until an event """
+        due = [d for d, sig in self.pending.values()]
+        if not self.inotify:
+            due.append(self.next_poll)
+        if not due:
+            return None
+        return max(0, min(due) - time.time())
+
+    def _wanted(self, name):
+        extension = name.split('.')[-1].lower()
+        if extension in self.ext_skip:
+            return False
+        return not self.extensions or extension in self.extensions
+
+    def _queue(self, path):
+        self.pending[path] = (time.time() + self.settle, None)
+        return
+
+    def _watch_tree(self, top, queue=True):
+        """ Watch top and every directory below it, queueing their files """
+        stack = [top]
+        while stack:
+            path = stack.pop()
+            self.inotify.add_watch(path)
+            dirs, files = walker.listdir(path, self.extensions, self.ext_skip)
+            stack.extend(dirs)
+            if queue:
+                for f in files:
+                    self._queue(f.path)
+        return
+
+    def _events(self):
+        for directory, name, mask in self.inotify.read():
+            if mask & IN_Q_OVERFLOW:
+                # Lost events, fall back to looking at everything again
+                self.log.warning("watch: inotify queue overflowed, rescanning %s", self.top)
+                self._rescan()
+                continue
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    try:
+                        self._watch_tree(path)
+                    except OSError as e:
+                        self.log.error("watch: unable to watch %s: %s", path, e)
+                continue
+            if self._wanted(name):
+                self._queue(path)
+        return
+
+    def _rescan(self):
+        for f in walker.walk(self.top, self.extensions, self.ext_skip):
+            self._queue(f.path)
+        return
+
+    def _poll_tree(self, dirs, queue=True):
+        stack = list(dirs)
+        while stack:
+            stack.extend(self._poll_dir(stack.pop(), queue))
+        return
+
+    def _poll_dir(self, path, queue=True):
+        """ Relist path if its mtime moved, queueing new or changed files.
+            Returns subdirectories seen for the first time.
+        """
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            self.dirs.pop(path, None)
+            self.known.pop(path, None)
+            return []
+        if self.dirs.get(path) == mtime:
+            return []
+        self.dirs[path] = mtime
+        dirs, files = walker.listdir(path, self.extensions, self.ext_skip)
+        before = self.known.get(path, {})
+        self.known[path] = dict((f.name, (f.size, f.mtime_ns)) for f in files)
+        if queue:
+            for f in files:
+                if before.get(f.name) != (f.size, f.mtime_ns):
+                    self._queue(f.path)
+        return [d for d in dirs if d not in self.dirs]
+
+    def _flush(self):
+        """ Hand files that have settled to the callback """
+        now = time.time()
+        ready = []
+        for path, (due, sig) in list(self.pending.items()):
+            if due > now:
+                continue
+            fe = walker.entry(path)
+            if fe is None:
+                del self.pending[path]  # Gone again, or renamed away
+                continue
+            current = (fe.size, fe.mtime_ns)
+            if current != sig:
+                # Still changing, or first look; check again after settle
+                self.pending[path] = (now + self.settle, current)
+                continue
+            del self.pending[path]
+            ready.append(fe)
+        if ready:
+            self.log.info("watch: (%d) new files settled", len(ready))
+            self.callback(ready)
+        return
@@ -0,0 +1,38 @@
+import os
+import sys
+import hashlib
+import tempfile
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+import hashing  # noqa: E402
+
+
+class DigestTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp()
+        self.data = os.urandom(3 * 1024 + 17)
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(self.data)
+
+    def tearDown(self):
+        os.unlink(self.filename)
+
+    def test_mmap_matches_read(self):
+        expected = {'md5': hashlib.md5(self.data).hexdigest(),
+                    'sha1': hashlib.sha1(self.data).hexdigest()}
+        for use_mmap in (False, True):
+            digests, size = hashing.digest(self.filename, ('md5', 'sha1'),
+                                           block_size=1024, use_mmap=use_mmap)
+            self.assertEqual(digests, expected)
+            self.assertEqual(size, len(self.data))
+
+    def test_mmap_empty_file(self):
+        open(self.filename, 'wb').close()
+        digests, size = hashing.digest(self.filename, use_mmap=True)
+        self.assertEqual(digests, {'md5': hashlib.md5(b"").hexdigest()})
+        self.assertEqual(size, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,189 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+try:
+    import jsondb
+    from jsondb import JsonDB, read_snapshot
+except ImportError as e:  # pymediainfo, through media
+    raise unittest.SkipTest("jsondb needs %s" % e.name)
+
+
+def entry(n, title=None):
+    md5 = "%032x" % n
+    return {'md5sum': md5, 'title': title or "Movie %d" % n, 'year': "2000",
+            'filename': "/movies/%d.mkv" % n, 'size_bytes': n * 1000}
+
+
+class Crash(BaseException):
+    """ Stands in for the process dying, nothing catches it """
+
+
+class JsonDBTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.workdir, "db.json")
+        db = JsonDB(self.filename)
+        for n in range(10):
+            db.add(entry(n), entry(n)['filename'], entry(n)['md5sum'])
+        db.journal = False
+        db.save()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def change(self, db):
+        """ One of each kind of journal record """
+        db.add(entry(100), entry(100)['filename'], entry(100)['md5sum'])
+        db.update(entry(2)['md5sum'], entry(2, "Changed"))
+        db.remove(md5sum=entry(3)['md5sum'])
+
+    def assertChanged(self, db):
+        self.assertIn(entry(100)['md5sum'], db.db)
+        self.assertNotIn(entry(3)['md5sum'], db.db)
+        self.assertEqual(db.get(entry(2)['md5sum'])['title'], "Changed")
+        self.assertEqual(db.get_path(entry(100)['filename'])['md5sum'], entry(100)['md5sum'])
+        self.assertIsNone(db.get_path(entry(3)['filename']))
+
+    def test_journal_replay(self):
+        db = JsonDB(self.filename)
+        snapshot = os.path.getsize(self.filename)
+        self.change(db)
+        db.save()
+        self.assertTrue(os.path.isfile(db.journalfile))
+        self.assertEqual(os.path.getsize(self.filename), snapshot)
+        db = JsonDB(self.filename)
+        self.assertChanged(db)
+        self.assertEqual(len(db.db), 10)
+
+    def test_torn_journal(self):
+        db = JsonDB(self.filename)
+        self.change(db)
+        db.save()
+        with open(db.journalfile, 'a') as fh:
+            fh.write('{"put": "%s", "entry": {"tit' % entry(200)['md5sum'])
+        db = JsonDB(self.filename)
+        self.assertTrue(db.journal_torn)
+        self.assertChanged(db)
+        # The next save folds the journal into a snapshot, dropping the tear
+        db.add(entry(201), entry(201)['filename'], entry(201)['md5sum'])
+        db.save()
+        self.assertFalse(os.path.exists(db.journalfile))
+        db = JsonDB(self.filename)
+        self.assertFalse(db.journal_torn)
+        self.assertIn(entry(201)['md5sum'], db.db)
+        self.assertNotIn(entry(200)['md5sum'], db.db)
+
+    def test_compaction(self):
+        db = JsonDB(self.filename)
+        self.change(db)
+        db.save()
+        db = JsonDB(self.filename)
+        db.journal_min = db.journal_ratio = 0
+        db.add(entry(101), entry(101)['filename'], entry(101)['md5sum'])
+        db.save()
+        self.assertFalse(os.path.exists(db.journalfile))
+        self.assertFalse(os.path.exists(db.oldjournalfile))
+        db = JsonDB(self.filename)
+        self.assertChanged(db)
+        self.assertIn(entry(101)['md5sum'], db.db)
+        self.assertEqual(len(db.db), 11)
+
+    def crash_compacting(self, when):
+        """ Compact with a journal in place, the process dying at when """
+        db = JsonDB(self.filename)
+        self.change(db)
+        db.save()
+        db = JsonDB(self.filename)
+        db.journal = False
+        db.remove(md5sum=entry(4)['md5sum'])
+        rename, unlink = os.rename, os.unlink
+
+        def crash_rename(src, dst):
+            if when == "before" and src.endswith(".tmp"):
+                raise Crash()
+            return rename(src, dst)
+
+        def crash_unlink(path):
+            if when == "after" and path == db.oldjournalfile:
+                raise Crash()
+            return unlink(path)
+        with mock.patch("os.rename", crash_rename), mock.patch("os.unlink", crash_unlink):
+            with self.assertRaises(Crash):
+                db.save()
+
+    def test_crash_before_snapshot(self):
+        self.crash_compacting("before")
+        db = JsonDB(self.filename)
+        self.assertChanged(db)
+        db.add(entry(102), entry(102)['filename'], entry(102)['md5sum'])
+        db.save()
+        self.assertFalse(os.path.exists(db.oldjournalfile))
+        db = JsonDB(self.filename)
+        self.assertChanged(db)
+        self.assertIn(entry(102)['md5sum'], db.db)
+
+    def test_crash_after_snapshot(self):
+        self.crash_compacting("after")
+        db = JsonDB(self.filename)
+        self.assertNotIn(entry(4)['md5sum'], db.db)
+        self.assertEqual(len(db.db), 9)
+        db.add(entry(102), entry(102)['filename'], entry(102)['md5sum'])
+        db.save()
+        self.assertFalse(os.path.exists(db.oldjournalfile))
+        db = JsonDB(self.filename)
+        self.assertEqual(len(db.db), 10)
+        self.assertNotIn(entry(4)['md5sum'], db.db)
+
+    def test_merge_journals(self):
+        a = JsonDB(self.filename)
+        b = JsonDB(self.filename)
+        self.change(a)
+        b.add(entry(300), entry(300)['filename'], entry(300)['md5sum'])
+        b.update(entry(2)['md5sum'], entry(2, "Ours"))
+        a.save()
+        b.save()
+        self.assertIn(entry(100)['md5sum'], b.db)
+        self.assertNotIn(entry(3)['md5sum'], b.db)
+        self.assertEqual(b.get(entry(2)['md5sum'])['title'], "Ours")
+        db = JsonDB(self.filename)
+        self.assertIn(entry(100)['md5sum'], db.db)
+        self.assertIn(entry(300)['md5sum'], db.db)
+        self.assertNotIn(entry(3)['md5sum'], db.db)
+        # The later save wins for an entry both changed
+        self.assertEqual(db.get(entry(2)['md5sum'])['title'], "Ours")
+
+    def test_merge_snapshot(self):
+        a = JsonDB(self.filename)
+        b = JsonDB(self.filename)
+        a.journal = False
+        self.change(a)
+        a.save()
+        b.add(entry(300), entry(300)['filename'], entry(300)['md5sum'])
+        b.save()
+        self.assertEqual(sorted(b.db), sorted(JsonDB(self.filename).db))
+        db = JsonDB(self.filename)
+        self.assertIn(entry(100)['md5sum'], db.db)
+        self.assertIn(entry(300)['md5sum'], db.db)
+        self.assertNotIn(entry(3)['md5sum'], db.db)
+        self.assertEqual(b.get_path(entry(100)['filename'])['md5sum'], entry(100)['md5sum'])
+
+    def test_snapshot_formats(self):
+        expected = JsonDB(self.filename).db
+        for format in ["json"] + list(jsondb.SNAPSHOT_FORMATS):
+            db = JsonDB(self.filename)
+            db.snapshot_format = format
+            db.save()
+            self.assertEqual(read_snapshot(self.filename)[0], format)
+            db = JsonDB(self.filename)
+            self.assertEqual(db.loaded_format, format)
+            self.assertEqual(db.db, expected)
+            self.assertEqual(db.get_path(entry(5)['filename'])['md5sum'], entry(5)['md5sum'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import os
+import sys
+import random
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+import helpers  # noqa: E402
+from searchindex import SearchIndex  # noqa: E402
+
+
+class OrderedTest(unittest.TestCase):
+
+    def setUp(self):
+        rand = random.Random(7)
+        self.db = {}
+        for i in range(500):
+            md5 = "%032x" % rand.getrandbits(128)
+            self.db[md5] = {'md5sum': md5, 'title': "Movie %d" % i,
+                            'year': 1990 + i % 30,
+                            # Some repeated sizes, some missing
+                            'size_bytes': rand.choice([None, rand.randrange(50) * 1000,
+                                                       rand.randrange(10 ** 9)])}
+
+    def index(self, built):
+        index = SearchIndex(lambda: self.db)
+        if built:
+            index.build()
+        return index
+
+    def sizes(self, md5s):
+        return [self.db[m]['size_bytes'] for m in md5s]
+
+    def expected(self, md5s=None):
+        """ Plain sort, largest first and those without a size last """
+        md5s = list(self.db) if md5s is None else md5s
+        return sorted(self.sizes(md5s), key=lambda v: (v is not None, v or 0),
+                      reverse=True)
+
+    def test_ordered(self):
+        for built in (False, True):
+            found = list(self.index(built).ordered('size_bytes'))
+            self.assertEqual(sorted(found), sorted(self.db))
+            self.assertEqual(self.sizes(found), self.expected())
+
+    def test_ordered_top(self):
+        for built in (False, True):
+            for top in (1, 20, 499, 500, 1000):
+                found = list(self.index(built).ordered('size_bytes', top=top))
+                self.assertEqual(sorted(found), sorted(self.db))
+                self.assertEqual(self.sizes(found[:top]), self.expected()[:top])
+
+    def test_ordered_subset(self):
+        md5s = set(m for m, e in self.db.items() if e['year'] == 2000)
+        for built in (False, True):
+            for top in (None, 5):
+                found = list(self.index(built).ordered('size_bytes', md5s, top))
+                self.assertEqual(set(found), md5s)
+                self.assertEqual(self.sizes(found[:top]), self.expected(md5s)[:top])
+
+    def test_ranges(self):
+        for low, high in ((None, 25000), (10 ** 6, None), (0, 0), (5000, 5 * 10 ** 8)):
+            expected = set(m for m, e in self.db.items() if e['size_bytes'] is not None and
+                           (low is None or e['size_bytes'] >= low) and
+                           (high is None or e['size_bytes'] <= high))
+            for built in (False, True):
+                found = self.index(built).search(ranges={'size_bytes': (low, high)})
+                self.assertEqual(found, expected)
+
+    def test_largest_entries(self):
+        entries = list(self.db.values())
+        found, total = helpers.largest_entries(entries + entries[:10], 'size_bytes', 20)
+        self.assertEqual(total, len(self.db))
+        self.assertEqual(self.sizes(e['md5sum'] for e in found), self.expected()[:20])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+try:
+    from shardeddb import ShardedDB
+except ImportError as e:  # pymediainfo, through media
+    raise unittest.SkipTest("shardeddb needs %s" % e.name)
+
+
+def episode(n, show):
+    md5 = "%032x" % n
+    return {'md5sum': md5, 'show': show, 'title': "Episode %d" % n, 'season': 1,
+            'episode': n, 'filename': "/tv/%s/%d.mkv" % (show, n)}
+
+
+class ManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.workdir, "tv.shards")
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def add(self, db, n, show):
+        e = episode(n, show)
+        db.add(e, e['filename'], e['md5sum'])
+
+    def test_merge_manifest(self):
+        a = ShardedDB(self.filename)
+        b = ShardedDB(self.filename)
+        self.add(a, 1, "Firefly")
+        self.add(b, 2, "Farscape")
+        self.add(b, 3, "Firefly")
+        a.save()
+        b.save()
+        db = ShardedDB(self.filename)
+        self.assertEqual(sorted(info['show'] for info in db.manifest.values()),
+                         ["Farscape", "Firefly"])
+        # Counts are read from the manifest, without loading the shards
+        self.assertEqual(db.count(), 3)
+        self.assertEqual(db.shards, {})
+        firefly = [e['md5sum'] for e in db.candidates(show=db.key({'show': "Firefly"}))]
+        self.assertEqual(sorted(firefly), [episode(1, "")['md5sum'], episode(3, "")['md5sum']])
+        self.assertEqual(list(db.shards), ["firefly"])
+
+
+if __name__ == '__main__':
+    unittest.main()